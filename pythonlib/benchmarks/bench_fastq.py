@@ -0,0 +1,82 @@
+"""Compare FASTQ reading throughput for the parsers in sample_registry.util
+
+Usage: python bench_fastq.py [FASTQ_GZ]
+
+If no file is given, a gzipped FASTQ file of random reads is written
+to a temporary directory first.
+"""
+
+import gzip
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from sample_registry.util import (
+    parse_fastq, parse_fastq_batches, count_fastq, open_gzip,
+)
+
+
+def write_random_fastq(fp, num_reads, read_length=150):
+    rng = random.Random(0)
+    seqs = [
+        "".join(rng.choice("ACGT") for _ in range(read_length))
+        for _ in range(1000)]
+    qual = "F" * read_length
+    with gzip.open(fp, "wt", compresslevel=1) as f:
+        for n in range(num_reads):
+            f.write("@M03543:47:C8LJ2ANXX:1:2209:{0}:2044 1:N:0:1\n".format(n))
+            f.write(seqs[n % 1000] + "\n+\n" + qual + "\n")
+
+
+def line_generator(fp):
+    with gzip.open(fp, "rt") as f:
+        return sum(1 for _ in parse_fastq(f))
+
+
+def batches(fp, method):
+    with open_gzip(fp, method) as f:
+        return sum(len(b) for b in parse_fastq_batches(f))
+
+
+def count(fp, method):
+    with open_gzip(fp, method) as f:
+        return count_fastq(f)
+
+
+BENCHMARKS = [
+    ("parse_fastq (text lines)", line_generator),
+    ("parse_fastq_batches, thread", lambda fp: batches(fp, "thread")),
+    ("parse_fastq_batches, pipe", lambda fp: batches(fp, "pipe")),
+    ("count_fastq, thread", lambda fp: count(fp, "thread")),
+]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    tmp_dir = None
+    if argv:
+        fp = argv[0]
+    else:
+        tmp_dir = tempfile.mkdtemp()
+        fp = os.path.join(tmp_dir, "reads.fastq.gz")
+        write_random_fastq(fp, 2000000)
+    try:
+        with gzip.open(fp, "rb") as f:
+            size = sum(len(b) for b in iter(lambda: f.read(1 << 22), b""))
+        print("Uncompressed size: {0:.1f} MB".format(size / 1e6))
+        for desc, fcn in BENCHMARKS:
+            t0 = time.time()
+            nreads = fcn(fp)
+            secs = time.time() - t0
+            print("{0:32s}{1:10d} reads{2:8.2f} s{3:8.1f} MB/s".format(
+                desc, nreads, secs, size / 1e6 / secs))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""DNA barcode sequences for the indices in sequencing library kits"""
+
+import os.path
+
+
+class IndexKitRegistry(object):
+    """Barcode sequences for named indices, collected from index kits.
+
+    Index names must be unique across all kits in the registry, so
+    that a sample table may refer to an index by name alone.
+    """
+
+    def __init__(self):
+        self.kits = {}
+        self.barcodes = {}
+
+    def copy(self):
+        """Return a new registry with the same kits."""
+        kits = IndexKitRegistry()
+        for kit_name, barcodes in self.kits.items():
+            kits.add_kit(kit_name, barcodes)
+        return kits
+
+    def add_kit(self, kit_name, barcodes):
+        """Add a kit, given as (index name, barcode sequence) pairs."""
+        barcodes = dict(barcodes)
+        for index_name, seq in barcodes.items():
+            existing_seq = self.barcodes.get(index_name)
+            if existing_seq is not None and existing_seq != seq:
+                raise ValueError(
+                    "Index {0} in kit {1} conflicts with existing "
+                    "barcode {2}".format(index_name, kit_name, existing_seq))
+        self.kits[kit_name] = barcodes
+        self.barcodes.update(barcodes)
+
+    def load_kit(self, f, kit_name=None):
+        """Add a kit from a file of index names and barcode sequences.
+
+        Each line holds an index name and a barcode sequence,
+        separated by whitespace.  Blank lines and lines beginning with
+        '#' are ignored.  If no kit name is given, the file name is
+        used.
+        """
+        if kit_name is None:
+            kit_name = os.path.splitext(os.path.basename(f.name))[0]
+        self.add_kit(kit_name, parse_index_kit(f))
+
+    def resolve_pairs(self, index_pairs):
+        """Look up dual-index barcodes for (forward, reverse) index names.
+
+        Returns a list of barcodes in the form "FWD-REV", with None for
+        pairs that could not be resolved, and a list of the positions
+        of unresolved pairs.
+        """
+        get = self.barcodes.get
+        resolved = []
+        unresolved = []
+        for n, (fwd_index, rev_index) in enumerate(index_pairs):
+            fwd_barcode = get(fwd_index)
+            rev_barcode = get(rev_index)
+            if fwd_barcode is None or rev_barcode is None:
+                resolved.append(None)
+                unresolved.append(n)
+            else:
+                resolved.append(fwd_barcode + "-" + rev_barcode)
+        return resolved, unresolved
+
+
+def parse_index_kit(f):
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        index_name, seq = line.split()[:2]
+        yield index_name, seq.upper()
+
+
+_index_kits = None
+
+
+def index_kits():
+    """Return the registry of standard index kits, building it on first use.
+
+    The registry is shared, so add kits to a copy of it.
+    """
+    global _index_kits
+    if _index_kits is None:
+        _index_kits = IndexKitRegistry()
+        _index_kits.add_kit(
+            "Nextera XT", parse_index_kit(NEXTERA_BARCODES.splitlines()))
+    return _index_kits
+
+
+NEXTERA_BARCODES = u"""\
+N701	TAAGGCGA
+N702	CGTACTAG
+N703	AGGCAGAA
+N704	TCCTGAGC
+N705	GGACTCCT
+N706	TAGGCATG
+N707	CTCTCTAC
+N708	CAGAGAGG
+N709	GCTACGCT
+N710	CGAGGCTG
+N711	AAGAGGCA
+N712	GTAGAGGA
+N714	GCTCATGA
+N715	ATCTCAGG
+N716	ACTCGCTA
+N718	GGAGCTAC
+N719	GCGTAGTA
+N720	CGGAGCCT
+N721	TACGCTGC
+N722	ATGCGCAG
+N723	TAGCGCTC
+N724	ACTGAGCG
+N726	CCTAAGAC
+N727	CGATCAGT
+N728	TGCAGCTA
+N729	TCGACGTC
+S501	TAGATCGC
+S502	CTCTCTAT
+S503	TATCCTCT
+S504	AGAGTAGA
+S505	GTAAGGAG
+S506	ACTGCATA
+S507	AAGGAGTA
+S508	CTAAGCCT
+S510	CGTCTAAT
+S511	TCTCTCCG
+S513	TCGACTAG
+S515	TTCTAGCT
+S516	CCTAGAGT
+S517	GCGTAAGA
+S518	CTATTAAG
+S520	AAGGCTAT
+S521	GAGCCTTA
+S522	TTATGCGA
+"""
@@ -1,43 +1,248 @@
 import collections
-import os.path
+import contextlib
+import datetime
+import itertools
+import numbers
 import sqlite3
 
+from sample_registry import migrations
+from sample_registry.util import typed_value
+
+
+# SQLite limits the number of host parameters in a single statement
+# (SQLITE_MAX_VARIABLE_NUMBER is 999 in older builds).
+SQLITE_MAX_VARIABLE_NUMBER = 999
+
+
+def _chunks(xs, n):
+    """Split a list into consecutive pieces of at most n items."""
+    for i in range(0, len(xs), n):
+        yield xs[i:i + n]
+
+
+SEARCH_FIELDS = ("sample_name", "subject_id", "annotation_values")
+
+
+def search_expression(text, fields=None):
+    """Build an FTS5 query to find samples matching some text.
+
+    Each word in the text must match the start of a word in one of the
+    fields, in any order.  Words are quoted, so that punctuation in
+    the text is not interpreted as query syntax; a word containing
+    punctuation matches a sequence of words, such as the parts of a
+    sample name.
+    """
+    terms = [
+        '"{0}"*'.format(word.replace('"', '""')) for word in text.split()]
+    if not terms:
+        raise ValueError("No words to search for")
+    expr = " ".join(terms)
+    if fields is not None:
+        for field in fields:
+            if field not in SEARCH_FIELDS:
+                raise ValueError("Unknown search field: {0}".format(field))
+        expr = "{{{0}}} : ({1})".format(" ".join(fields), expr)
+    return expr
+
+
+def _typed_bound(bound):
+    if bound is None:
+        return None
+    if isinstance(bound, numbers.Real):
+        return "num_val", float(bound)
+    if isinstance(bound, datetime.datetime):
+        bound = bound.date()
+    if isinstance(bound, datetime.date):
+        return "date_val", bound.isoformat()
+    typed = typed_value(bound)
+    if typed is None:
+        raise ValueError("Not a number or date: {0}".format(bound))
+    if typed[0] is not None:
+        return "num_val", typed[0]
+    return "date_val", typed[1]
+
+
+def typed_range(low=None, high=None):
+    """Find the typed column and values for the bounds of a range.
+
+    Bounds may be numbers, dates, or strings that look like either
+    one.  Returns the name of the column in typed_annotations, and
+    the bounds as stored in that column, with None for an open end.
+    """
+    bounds = [_typed_bound(b) for b in (low, high)]
+    cols = set(b[0] for b in bounds if b is not None)
+    if not cols:
+        raise ValueError("A range needs at least one bound")
+    if len(cols) > 1:
+        raise ValueError("Range bounds must both be numbers or dates")
+    col = cols.pop()
+    low, high = [b[1] if b is not None else None for b in bounds]
+    return col, low, high
+
 
 class RegistryDatabase(object):
-    def __init__(self, database_fp):
+    """Access to the registry database.
+
+    The connection is opened on first use.  Keyword arguments set
+    SQLite pragmas on the new connection; a value of None leaves the
+    SQLite default in place.  Write-ahead logging lets the website
+    read from the database while samples are being registered.
+    """
+    def __init__(
+            self, database_fp, journal_mode="WAL", synchronous="NORMAL",
+            busy_timeout=5000, cache_size=-16000, mmap_size=268435456,
+            foreign_keys=True):
         self.db = database_fp
-        self.con = sqlite3.connect(self.db)
+        self.pragmas = [
+            ("journal_mode", journal_mode),
+            ("synchronous", synchronous),
+            ("busy_timeout", busy_timeout),
+            ("cache_size", cache_size),
+            ("mmap_size", mmap_size),
+            ("foreign_keys", foreign_keys),
+        ]
+        self._con = None
+        self._transaction_depth = 0
+
+    @property
+    def con(self):
+        if self._con is None:
+            self._con = self._connect()
+        return self._con
+
+    def _connect(self):
+        con = sqlite3.connect(self.db)
+        for name, val in self.pragmas:
+            if val is None:
+                continue
+            if val is True:
+                val = "ON"
+            elif val is False:
+                val = "OFF"
+            con.execute("PRAGMA {0} = {1}".format(name, val))
+        return con
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Group several operations into a single transaction.
+
+        Transactions may be nested.  Changes are committed when the
+        outermost transaction exits, or rolled back if it exits with
+        an exception.
+        """
+        if self._transaction_depth == 0 and not self.con.in_transaction:
+            self.con.execute("BEGIN")
+        self._transaction_depth += 1
+        try:
+            yield
+        except BaseException:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.con.rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if self._transaction_depth == 0:
+                self.con.commit()
 
     select_run_fp = "SELECT run_accession FROM runs WHERE data_uri = ?"
+
+    select_run_fingerprint = (
+        "SELECT run_accession FROM runs WHERE data_fingerprint = ?"
+        )
+
+    select_runs_without_fingerprint = (
+        "SELECT run_accession, data_uri FROM runs "
+        "WHERE data_fingerprint IS NULL ORDER BY run_accession"
+        )
+
+    select_duplicate_fingerprints = (
+        "SELECT data_fingerprint, run_accession FROM runs "
+        "WHERE data_fingerprint IN ("
+        "SELECT data_fingerprint FROM runs "
+        "WHERE data_fingerprint IS NOT NULL "
+        "GROUP BY data_fingerprint HAVING COUNT(*) > 1) "
+        "ORDER BY data_fingerprint, run_accession"
+        )
+
+    update_run_fingerprint = (
+        "UPDATE runs SET data_fingerprint = ? WHERE run_accession = ?"
+        )
     
     select_run = (
         "SELECT data_uri FROM runs WHERE run_accession = ?"
         )
 
-    select_sample_bc = (
-        "SELECT sample_accession FROM samples WHERE "
-        "run_accession = ? AND "
-        "sample_name = ? AND "
-        "barcode_sequence = ?"
+    select_run_info = (
+        "SELECT run_accession, run_date, machine_type, machine_kit, lane, "
+        "data_uri, comment, admin_comment "
+        "FROM runs WHERE run_accession = ?"
         )
 
     select_samples = (
-        "SELECT sample_accession FROM samples WHERE run_accession = ?"
+        "SELECT sample_accession FROM samples WHERE run_accession = ? "
+        "ORDER BY sample_accession"
     )
 
     select_sample_names_and_bc = (
         "SELECT sample_name, barcode_sequence FROM samples WHERE "
-        "run_accession = ?"
+        "run_accession = ? ORDER BY sample_accession"
+    )
+
+    select_run_annotation_keys = (
+        "SELECT `key` FROM annotations JOIN samples "
+        "ON annotations.sample_accession = samples.sample_accession "
+        "WHERE samples.run_accession = ? "
+        "GROUP BY `key` ORDER BY MIN(annotations.rowid)"
+    )
+
+    select_run_samples_with_annotations = (
+        "SELECT samples.sample_accession, sample_name, run_accession, "
+        "barcode_sequence, primer_sequence, sample_type, subject_id, "
+        "host_species, `key`, `val` "
+        "FROM samples LEFT JOIN annotations "
+        "ON samples.sample_accession = annotations.sample_accession "
+        "WHERE samples.run_accession = ? "
+        "ORDER BY sample_name, samples.sample_accession, annotations.rowid"
+    )
+
+    # SQLite cannot flatten the annotations view into the right side
+    # of a LEFT JOIN, so the encoded tables are joined here directly
+    select_run_samples_with_encoded_annotations = (
+        "SELECT samples.sample_accession, sample_name, run_accession, "
+        "barcode_sequence, primer_sequence, sample_type, subject_id, "
+        "host_species, annotation_key_ids.`key`, "
+        "COALESCE(annotation_val_ids.`val`, annotation_values.`val`) "
+        "FROM samples LEFT JOIN annotation_values "
+        "ON samples.sample_accession = annotation_values.sample_accession "
+        "LEFT JOIN annotation_key_ids "
+        "ON annotation_key_ids.key_id = annotation_values.key_id "
+        "LEFT JOIN annotation_val_ids "
+        "ON annotation_val_ids.val_id = annotation_values.val_id "
+        "WHERE samples.run_accession = ? "
+        "ORDER BY sample_name, samples.sample_accession, "
+        "annotation_values.rowid"
     )
 
+    sample_columns = [
+        "sample_accession", "sample_name", "run_accession",
+        "barcode_sequence", "primer_sequence", "sample_type", "subject_id",
+        "host_species"]
+
     delete_sample = (
         "DELETE FROM samples WHERE sample_accession = ?"
     )
 
     insert_run = (
         "INSERT INTO runs "
-        "(run_date, machine_type, machine_kit, lane, data_uri, comment) "
-        "VALUES (?, ?, ?, ?, ?, ?)"
+        "(run_date, machine_type, machine_kit, lane, data_uri, comment, "
+        "data_fingerprint) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)"
         )
 
     insert_sample = (
@@ -46,6 +251,57 @@ class RegistryDatabase(object):
         "VALUES (?, ?, ?)"
         )
 
+    select_runs_to_audit = (
+        "SELECT runs.run_accession, data_uri, data_fingerprint, file_size "
+        "FROM runs LEFT JOIN run_file_audits "
+        "ON runs.run_accession = run_file_audits.run_accession "
+        "WHERE checked_at IS NULL OR checked_at < ? OR status != 'ok' "
+        "ORDER BY runs.run_accession"
+        )
+
+    insert_file_audit = (
+        "INSERT OR REPLACE INTO run_file_audits "
+        "(run_accession, file_path, file_size, status, checked_at) "
+        "VALUES (?, ?, ?, ?, ?)"
+        )
+
+    select_file_audits = (
+        "SELECT run_accession, file_path, file_size, status, checked_at "
+        "FROM run_file_audits ORDER BY run_accession"
+        )
+
+    insert_read_stats = (
+        "INSERT OR REPLACE INTO run_read_stats "
+        "(run_accession, lane, read_number, read_count, base_count, "
+        "mean_quality) VALUES (?, ?, ?, ?, ?, ?)"
+        )
+
+    insert_read_length = (
+        "INSERT INTO run_read_lengths "
+        "(run_accession, lane, read_number, read_length, read_count) "
+        "VALUES (?, ?, ?, ?, ?)"
+        )
+
+    delete_read_stats = (
+        "DELETE FROM run_read_stats WHERE run_accession = ?"
+        )
+
+    delete_read_lengths = (
+        "DELETE FROM run_read_lengths WHERE run_accession = ?"
+        )
+
+    select_read_stats = (
+        "SELECT lane, read_number, read_count, base_count, mean_quality "
+        "FROM run_read_stats WHERE run_accession = ? "
+        "ORDER BY lane, read_number"
+        )
+
+    select_read_lengths = (
+        "SELECT lane, read_number, read_length, read_count "
+        "FROM run_read_lengths WHERE run_accession = ? "
+        "ORDER BY lane, read_number, read_length"
+        )
+
     standard_annotation_keys = [
         "SampleType", "SubjectID", "HostSpecies"]
         
@@ -54,6 +310,29 @@ class RegistryDatabase(object):
         "FROM samples WHERE sample_accession = ?"
         )
 
+    select_run_standard_annotations = (
+        "SELECT sample_accession, sample_type, subject_id, host_species "
+        "FROM samples WHERE run_accession = ? "
+        "ORDER BY sample_accession"
+        )
+
+    select_run_nonstandard_annotations = (
+        "SELECT annotations.sample_accession, `key`, `val` "
+        "FROM annotations JOIN samples "
+        "ON annotations.sample_accession = samples.sample_accession "
+        "WHERE samples.run_accession = ?"
+        )
+
+    select_multisample_standard_annotations = (
+        "SELECT sample_accession, sample_type, subject_id, host_species "
+        "FROM samples WHERE sample_accession IN ({0})"
+        )
+
+    select_multisample_nonstandard_annotations = (
+        "SELECT sample_accession, `key`, `val` "
+        "FROM annotations WHERE sample_accession IN ({0})"
+        )
+
     insert_standard_annotations = (
         "UPDATE samples "
         "SET sample_type = ?, subject_id = ?, host_species = ? "
@@ -82,6 +361,52 @@ class RegistryDatabase(object):
         "WHERE sample_accession = ?"
         )
 
+    insert_typed_annotation = (
+        "INSERT INTO typed_annotations "
+        "(sample_accession, `key`, num_val, date_val) "
+        "VALUES (?, ?, ?, ?)"
+        )
+
+    delete_typed_annotations = (
+        "DELETE FROM typed_annotations "
+        "WHERE sample_accession = ?"
+        )
+
+    select_annotation_range = (
+        "SELECT sample_accession, {0} FROM typed_annotations "
+        "WHERE `key` = ? AND {0} IS NOT NULL{1} "
+        "ORDER BY {0}, sample_accession"
+        )
+
+    insert_annotation_key_id = (
+        "INSERT OR IGNORE INTO annotation_key_ids (`key`, intern_values) "
+        "VALUES (?, ?)"
+        )
+
+    select_annotation_key_ids = (
+        "SELECT `key`, key_id, intern_values FROM annotation_key_ids "
+        "WHERE `key` IN ({0})"
+        )
+
+    select_annotation_val_ids = (
+        "SELECT `val`, val_id FROM annotation_val_ids WHERE `val` IN ({0})"
+        )
+
+    insert_annotation_val_id = (
+        "INSERT OR IGNORE INTO annotation_val_ids (`val`) VALUES (?)"
+        )
+
+    insert_encoded_annotation = (
+        "INSERT INTO annotation_values "
+        "(sample_accession, key_id, val_id, `val`) "
+        "VALUES (?, ?, ?, ?)"
+        )
+
+    delete_encoded_annotations = (
+        "DELETE FROM annotation_values "
+        "WHERE sample_accession = ?"
+        )
+
     select_standard_sample_types = (
         "SELECT sample_type, host_associated, comment "
         "FROM standard_sample_types"
@@ -117,76 +442,218 @@ class RegistryDatabase(object):
     def query_standard_sample_types(self):
         cur = self.con.cursor()
         cur.execute(self.select_standard_sample_types)
-        self.con.commit()
         res = cur.fetchall()
         cur.close()
         return res
 
     def register_standard_sample_types(self, sample_types):
-        cur = self.con.cursor()
-        cur.executemany(self.insert_standard_sample_type, sample_types)
-        self.con.commit()
-        cur.close()
+        with self.transaction():
+            cur = self.con.cursor()
+            cur.executemany(self.insert_standard_sample_type, sample_types)
+            cur.close()
 
     def remove_standard_sample_types(self):
-        cur = self.con.cursor()
-        cur.execute(self.delete_standard_sample_types)
-        self.con.commit()
-        cur.close()
+        with self.transaction():
+            cur = self.con.cursor()
+            cur.execute(self.delete_standard_sample_types)
+            cur.close()
 
     def query_standard_host_species(self):
         cur = self.con.cursor()
         cur.execute(self.select_standard_host_species)
-        self.con.commit()
         res = cur.fetchall()
         cur.close()
         return res
 
     def register_standard_host_species(self, host_species):
-        cur = self.con.cursor()
-        cur.executemany(self.insert_standard_host_species, host_species)
-        self.con.commit()
-        cur.close()
+        with self.transaction():
+            cur = self.con.cursor()
+            cur.executemany(self.insert_standard_host_species, host_species)
+            cur.close()
 
     def remove_standard_host_species(self):
-        cur = self.con.cursor()
-        cur.execute(self.delete_standard_host_species)
-        self.con.commit()
-        cur.close()
+        with self.transaction():
+            cur = self.con.cursor()
+            cur.execute(self.delete_standard_host_species)
+            cur.close()
 
     def create_tables(self):
         """Creates the necessary tables in a new database file.
         """
-        this_dir = os.path.dirname(os.path.abspath(__file__))
-        base_dir = os.path.dirname(os.path.dirname(this_dir))
-        schema = open(os.path.join(base_dir, "schema.sql")).read()
+        self.migrate()
+
+    def migrate(self, target=migrations.LATEST_VERSION):
+        """Upgrades the database schema in place.
+
+        Returns a list of the schema versions applied.
+        """
+        return migrations.migrate(self.con, target)
+
+    def query_schema_version(self):
+        return migrations.schema_version(self.con)
+
+    def encode_annotations(self):
+        """Store annotation keys and repeated values as integer ids.
+
+        Reads and writes through this class, and reads from the
+        annotations view, work the same with either layout.  Returns
+        False if the annotations were already encoded.
+        """
+        return migrations.encode_annotations(self.con)
+
+    def decode_annotations(self):
+        """Store annotations as plain text, as in the baseline schema.
+
+        Returns False if the annotations were not encoded.
+        """
+        return migrations.decode_annotations(self.con)
+
+    def query_annotations_encoded(self):
+        return migrations.annotations_encoded(self.con)
+
+    select_registry_counts = "SELECT name, value FROM registry_counts"
+
+    select_sample_value_counts = (
+        "SELECT value, sample_count FROM sample_value_counts "
+        "WHERE field = ? ORDER BY sample_count DESC, value"
+        )
+
+    select_run_sample_count = (
+        "SELECT sample_count FROM run_sample_counts WHERE run_accession = ?"
+        )
+
+    select_annotation_key_counts = (
+        "SELECT `key`, key_count FROM annotation_key_counts ORDER BY `key`"
+        )
+
+    def rebuild_statistics(self):
+        """Recompute the summary tables from scratch.
+
+        The summary tables are kept up to date by triggers as samples
+        and annotations are written.  This is only needed to repair
+        them, for example after the triggers were bypassed.
+        """
+        with self.transaction():
+            cur = self.con.cursor()
+            for sql in migrations.STATISTICS_REBUILD:
+                cur.execute(sql)
+            cur.close()
+
+    def query_registry_counts(self):
+        """Get the summary counts of samples in the registry, by name."""
         cur = self.con.cursor()
-        cur.executescript(schema)
-        self.con.commit()
+        cur.execute(self.select_registry_counts)
+        res = dict(cur.fetchall())
         cur.close()
+        return res
+
+    def query_sample_value_counts(self, field):
+        """Count samples for each value of sample_type or host_species.
 
-    def register_run(self, date, mach_type, mach_kit, lane, fp, comment):
+        Returns an OrderedDict, with the most common values first.
+        """
+        cur = self.con.cursor()
+        cur.execute(self.select_sample_value_counts, (field,))
+        res = collections.OrderedDict(cur.fetchall())
+        cur.close()
+        return res
+
+    def query_run_sample_count(self, run_accession):
+        cur = self.con.cursor()
+        cur.execute(self.select_run_sample_count, (run_accession,))
+        res = cur.fetchone()
+        cur.close()
+        if res is not None:
+            return res[0]
+        else:
+            return None
+
+    def query_annotation_key_counts(self):
+        cur = self.con.cursor()
+        cur.execute(self.select_annotation_key_counts)
+        res = collections.OrderedDict(cur.fetchall())
+        cur.close()
+        return res
+
+    def register_run(
+            self, date, mach_type, mach_kit, lane, fp, comment,
+            fingerprint=None):
         """Register a new sequencing run.
 
+        If a content fingerprint is given for the data file, the run is
+        rejected if another run has the same fingerprint, even if the
+        data was registered under a different file path.
+
         Returns the accession number of the new run.
         """
-        existing_run_acc = self._query_run_from_file(fp)
-        if existing_run_acc:
-            raise ValueError(
-                "Run data already registered as %s" % existing_run_acc)
+        with self.transaction():
+            existing_run_acc = self._query_run_from_file(fp)
+            if existing_run_acc:
+                raise ValueError(
+                    "Run data already registered as %s" % existing_run_acc)
+            if fingerprint is not None:
+                existing_run_acc = self.query_run_from_fingerprint(
+                    fingerprint)
+                if existing_run_acc:
+                    raise ValueError(
+                        "Run data already registered as %s "
+                        "(matching fingerprint)" % existing_run_acc)
+            cur = self.con.cursor()
+            cur.execute(
+                self.insert_run,
+                (date, mach_type, mach_kit, lane, fp, comment, fingerprint))
+            accession = cur.lastrowid
+            cur.close()
+        return accession
+
+    def query_run_from_fingerprint(self, fingerprint):
+        cur = self.con.cursor()
+        cur.execute(self.select_run_fingerprint, (fingerprint,))
+        res = cur.fetchone()
+        cur.close()
+        if res is not None:
+            return res[0]
+        else:
+            return None
+
+    def query_runs_without_fingerprint(self):
+        """List (run accession, data file) for runs with no fingerprint."""
+        cur = self.con.cursor()
+        cur.execute(self.select_runs_without_fingerprint)
+        res = cur.fetchall()
+        cur.close()
+        return res
+
+    def query_duplicate_fingerprints(self):
+        """Find runs that share a data file fingerprint.
+
+        Returns a list of lists of run accessions, one list for each
+        fingerprint shared by more than one run.
+        """
         cur = self.con.cursor()
-        cur.execute(
-            self.insert_run,
-            (date, mach_type, mach_kit, lane, fp, comment))
-        self.con.commit()
-        accession = cur.lastrowid
+        cur.execute(self.select_duplicate_fingerprints)
+        groups = [
+            [acc for _, acc in rows] for _, rows in
+            itertools.groupby(cur.fetchall(), key=lambda row: row[0])]
         cur.close()
-        return accession
+        return groups
+
+    def register_run_fingerprints(self, fingerprints):
+        """Store data file fingerprints for existing runs.
+
+        The fingerprints argument is a sequence of (run accession,
+        fingerprint) pairs.
+        """
+        with self.transaction():
+            cur = self.con.cursor()
+            cur.executemany(
+                self.update_run_fingerprint,
+                [(fingerprint, acc) for acc, fingerprint in fingerprints])
+            cur.close()
 
     def _query_run_from_file(self, fp):
         cur = self.con.cursor()
         cur.execute(self.select_run_fp, (fp,))
-        self.con.commit()
         res = cur.fetchone()
         cur.close()
         if res is not None:
@@ -194,13 +661,30 @@ class RegistryDatabase(object):
         else:
             return None
 
+    def query_runs_from_files(self, fps):
+        """Find runs registered for any of a sequence of file paths.
+
+        Returns a dict mapping file path to run accession, for the
+        paths that are registered.
+        """
+        fps = list(fps)
+        found = {}
+        cur = self.con.cursor()
+        for chunk in _chunks(fps, SQLITE_MAX_VARIABLE_NUMBER):
+            placeholders = ", ".join("?" for _ in chunk)
+            cur.execute(
+                "SELECT data_uri, run_accession FROM runs "
+                "WHERE data_uri IN ({0})".format(placeholders), chunk)
+            found.update(cur.fetchall())
+        cur.close()
+        return found
+
     def query_run_exists(self, run_accession):
         return self.query_run_file(run_accession) is not None
 
     def query_run_file(self, run_accession):
         cur = self.con.cursor()
         cur.execute(self.select_run, (run_accession,))
-        self.con.commit()
         res = cur.fetchone()
         cur.close()
         if res is not None:
@@ -208,49 +692,237 @@ class RegistryDatabase(object):
         else:
             return None
 
-    def register_samples(self, run_accession, sample_bcs):
-        """Registers samples from tuples of SampleID, BarcodeSequence.
+    def query_run(self, run_accession):
+        """Get info for a run, as a dict of column values.
 
-        Returns a list of sample accessions.
+        Returns None if the run does not exist.
         """
-        sample_tups = [(run_accession, n, b) for n, b in sample_bcs]
-        for s in sample_tups:
+        cur = self.con.cursor()
+        cur.execute(self.select_run_info, (run_accession,))
+        res = cur.fetchone()
+        keys = [d[0] for d in cur.description]
+        cur.close()
+        if res is not None:
+            return dict(zip(keys, res))
+        else:
+            return None
+
+    def query_runs_to_audit(self, checked_before):
+        """List runs whose data files are due to be checked.
+
+        A run is due if its data file has never been checked, was last
+        checked before the given timestamp, or had a problem on the
+        last check.  Returns a list of (run accession, data file,
+        fingerprint, file size at last check) tuples.
+        """
+        cur = self.con.cursor()
+        cur.execute(self.select_runs_to_audit, (checked_before,))
+        res = cur.fetchall()
+        cur.close()
+        return res
+
+    def register_file_audits(self, audits):
+        """Record the results of checking run data files.
+
+        The audits argument is a sequence of (run accession, file path,
+        file size, status, timestamp) tuples.  Each replaces the
+        previous result for the run.
+        """
+        with self.transaction():
             cur = self.con.cursor()
-            cur.execute(self.select_sample_bc, s)
-            self.con.commit()
-            res = cur.fetchone()
+            cur.executemany(self.insert_file_audit, audits)
             cur.close()
-            if res is not None:
-                raise ValueError("Sample already registered: {0}".format(s))
-        accessions = []
+
+    def query_file_audits(self):
         cur = self.con.cursor()
-        for s in sample_tups:
-            cur.execute(self.insert_sample, s)
-            self.con.commit()
-            accessions.append(cur.lastrowid)
+        cur.execute(self.select_file_audits)
+        keys = [d[0] for d in cur.description]
+        res = [dict(zip(keys, row)) for row in cur.fetchall()]
         cur.close()
-        return accessions
+        return res
 
-    def query_barcoded_sample_accessions(self, run_accession, sample_bcs):
-        """Looks up sample accessions from tuples of name, bc.
+    def register_read_stats(self, run_accession, stats):
+        """Store read statistics for a run.
+
+        The stats argument is a dict mapping (lane, read number) to an
+        object with read_count, base_count, mean_quality, and lengths
+        attributes, as returned by illumina.read_fastq_stats().  Any
+        statistics previously stored for the run are replaced.
+        """
+        with self.transaction():
+            cur = self.con.cursor()
+            cur.execute(self.delete_read_stats, (run_accession,))
+            cur.execute(self.delete_read_lengths, (run_accession,))
+            cur.executemany(self.insert_read_stats, [
+                (run_accession, lane, read_number, s.read_count,
+                 s.base_count, s.mean_quality)
+                for (lane, read_number), s in sorted(stats.items())])
+            cur.executemany(self.insert_read_length, [
+                (run_accession, lane, read_number, length, count)
+                for (lane, read_number), s in sorted(stats.items())
+                for length, count in sorted(s.lengths.items())])
+            cur.close()
+
+    def query_read_stats(self, run_accession):
+        """Get read statistics for a run.
+
+        Returns a list of dicts, one per lane and read number, each
+        with a "lengths" entry mapping read length to read count.
+        """
+        cur = self.con.cursor()
+        cur.execute(self.select_read_stats, (run_accession,))
+        keys = [d[0] for d in cur.description]
+        stats = collections.OrderedDict()
+        for row in cur.fetchall():
+            s = dict(zip(keys, row))
+            s["lengths"] = collections.OrderedDict()
+            stats[(s["lane"], s["read_number"])] = s
+        cur.execute(self.select_read_lengths, (run_accession,))
+        for lane, read_number, length, count in cur.fetchall():
+            stats[(lane, read_number)]["lengths"][length] = count
+        cur.close()
+        return list(stats.values())
+
+    delete_search_index = "DELETE FROM sample_search WHERE rowid IN ({0})"
+
+    insert_search_index = (
+        migrations.SEARCH_INDEX_INSERT +
+        " WHERE samples.sample_accession IN ({0})"
+        )
+
+    select_search_samples = (
+        "SELECT samples.sample_accession, samples.sample_name, "
+        "barcode_sequence, primer_sequence, sample_type, samples.subject_id, "
+        "host_species, runs.run_accession, run_date, machine_type, "
+        "machine_kit, lane, data_uri, runs.comment AS run_comment "
+        "FROM sample_search "
+        "JOIN samples ON samples.sample_accession = sample_search.rowid "
+        "LEFT JOIN runs ON runs.run_accession = samples.run_accession "
+        "WHERE sample_search MATCH ? AND sample_search.rowid < ? "
+        "ORDER BY sample_search.rowid DESC LIMIT ? OFFSET ?"
+        )
+
+    def reindex_samples(self, sample_accessions):
+        """Bring the search index up to date for some samples.
+
+        Use this after changing samples or annotations with reindex
+        set to False, once for the whole transaction.
+        """
+        with self.transaction():
+            cur = self.con.cursor()
+            self._reindex_samples(cur, sample_accessions)
+            cur.close()
+
+    def _reindex_samples(self, cur, sample_accessions):
+        """Rebuild the search index rows for some samples."""
+        for chunk in _chunks(
+                sorted(set(sample_accessions)), SQLITE_MAX_VARIABLE_NUMBER):
+            placeholders = ", ".join("?" for _ in chunk)
+            cur.execute(self.delete_search_index.format(placeholders), chunk)
+            cur.execute(self.insert_search_index.format(placeholders), chunk)
+
+    def search_samples(
+            self, text, fields=None, limit=100, offset=0, before=None):
+        """Find samples by the start of words in their names, subject
+        IDs, or annotation values.
+
+        Results are returned one page at a time, most recently
+        registered samples first, as a list of dicts with the sample
+        and run info.  To get the next page quickly, pass the last
+        sample accession on this page as the before argument, rather
+        than increasing the offset.
+        """
+        expr = search_expression(text, fields)
+        if before is None:
+            before = 2 ** 63 - 1
+        cur = self.con.cursor()
+        cur.execute(
+            self.select_search_samples, (expr, before, limit, offset))
+        keys = [d[0] for d in cur.description]
+        res = [dict(zip(keys, row)) for row in cur.fetchall()]
+        cur.close()
+        return res
+
+    def register_samples(self, run_accession, sample_bcs, reindex=True):
+        """Registers samples from tuples of SampleID, BarcodeSequence.
+
+        All samples are registered in a single transaction.  If any
+        sample is already registered, no samples are added.  If
+        reindex is False, the search index is left for the caller to
+        update with reindex_samples.
 
-        Returns a list of sample accessions.
+        Returns a list of sample accessions, in the same order as the
+        input.
         """
+        sample_bcs = [tuple(x) for x in sample_bcs]
+        if len(set(sample_bcs)) < len(sample_bcs):
+            raise ValueError("Duplicated samples in input")
         sample_tups = [(run_accession, n, b) for n, b in sample_bcs]
-        res = []
-        for s in sample_tups:
+        with self.transaction():
             cur = self.con.cursor()
-            cur.execute(self.select_sample_bc, s)
-            self.con.commit()
-            res.append(cur.fetchone())
+            existing = self._select_barcoded_sample_accessions(
+                cur, run_accession, sample_bcs)
+            for s in sample_bcs:
+                if s in existing:
+                    raise ValueError("Sample already registered: {0}".format(
+                        (run_accession, ) + s))
+            cur.executemany(self.insert_sample, sample_tups)
+            registered = self._select_barcoded_sample_accessions(
+                cur, run_accession, sample_bcs)
+            if reindex:
+                self._reindex_samples(cur, registered.values())
             cur.close()
-        return [r[0] if r else None for r in res]
+        return [registered[s] for s in sample_bcs]
+
+    def _select_barcoded_sample_accessions(
+            self, cur, run_accession, sample_bcs):
+        """Find accessions for (name, barcode) pairs in a run.
+
+        The pairs are matched against the samples table in chunks of
+        literal VALUES rows, so that a whole run is resolved in one
+        query per chunk rather than one query per sample.
+
+        Returns a dict mapping (name, barcode) to sample accession,
+        containing only the pairs that were found.
+        """
+        found = {}
+        # Two parameters per sample, plus one for the run accession
+        chunk_size = (SQLITE_MAX_VARIABLE_NUMBER - 1) // 2
+        for chunk in _chunks(sample_bcs, chunk_size):
+            values = ", ".join("(?, ?)" for _ in chunk)
+            params = [x for pair in chunk for x in pair]
+            params.append(run_accession)
+            cur.execute(
+                "WITH query_samples (sample_name, barcode_sequence) AS "
+                "(VALUES {0}) "
+                "SELECT samples.sample_name, samples.barcode_sequence, "
+                "samples.sample_accession "
+                "FROM query_samples JOIN samples ON "
+                "samples.sample_name = query_samples.sample_name AND "
+                "samples.barcode_sequence = query_samples.barcode_sequence "
+                "WHERE samples.run_accession = ?".format(values),
+                params)
+            for name, bc, accession in cur:
+                found[(name, bc)] = accession
+        return found
+
+    def query_barcoded_sample_accessions(self, run_accession, sample_bcs):
+        """Looks up sample accessions from tuples of name, bc.
+
+        Returns a list of sample accessions, with None for samples
+        that are not registered.
+        """
+        sample_bcs = [tuple(x) for x in sample_bcs]
+        cur = self.con.cursor()
+        found = self._select_barcoded_sample_accessions(
+            cur, run_accession, sample_bcs)
+        cur.close()
+        return [found.get(s) for s in sample_bcs]
 
     def query_sample_accessions(self, run_accession):
         """Find all sample accessions for a run."""
         cur = self.con.cursor()
         cur.execute(self.select_samples, (run_accession, ))
-        self.con.commit()
         res = cur.fetchall()
         cur.close()
         return [r[0] for r in res]
@@ -259,30 +931,83 @@ class RegistryDatabase(object):
         """Find sample names and barcodes for a run."""
         cur = self.con.cursor()
         cur.execute(self.select_sample_names_and_bc, (run_accession, ))
-        self.con.commit()
         res = cur.fetchall()
         cur.close()
         return list(res)
 
-    def remove_samples(self, sample_accessions):
-        """Removes samples by accession number."""
+    def query_run_annotation_keys(self, run_accession):
+        """Find the non-standard annotation keys used in a run.
+
+        Keys are returned in the order they were first registered.
+        """
         cur = self.con.cursor()
-        sample_accession_vals = [(acc,) for acc in sample_accessions]
-        cur.executemany(self.delete_sample, sample_accession_vals)
-        self.con.commit()
+        cur.execute(self.select_run_annotation_keys, (run_accession, ))
+        res = cur.fetchall()
         cur.close()
+        return [r[0] for r in res]
 
-    def remove_annotations(self, sample_accessions):
-        """Removes annotations from a sequence of sample accessions.
+    def iter_run_samples(self, run_accession):
+        """Iterate over the samples in a run, with their annotations.
+
+        Samples are read from a single cursor, ordered by sample name,
+        so that only one sample is held in memory at a time.  The
+        samples_run_name_accession index gives the rows in this order,
+        so SQLite does not sort them and the first sample is returned
+        right away.
+
+        Yields a dict of sample column values and a dict of
+        non-standard annotations for each sample.
         """
+        if migrations.annotations_encoded(self.con):
+            sql = self.select_run_samples_with_encoded_annotations
+        else:
+            sql = self.select_run_samples_with_annotations
         cur = self.con.cursor()
-        sample_accession_vals = [(acc,) for acc in sample_accessions]
-        cur.executemany(
-            self.delete_standard_annotations, sample_accession_vals)
-        cur.executemany(
-            self.delete_nonstandard_annotations, sample_accession_vals)
-        self.con.commit()
-        cur.close()
+        try:
+            cur.execute(sql, (run_accession, ))
+            ncols = len(self.sample_columns)
+            for _, rows in itertools.groupby(cur, lambda r: r[0]):
+                rows = list(rows)
+                sample = dict(zip(self.sample_columns, rows[0][:ncols]))
+                annotations = collections.OrderedDict(
+                    (r[ncols], r[ncols + 1]) for r in rows
+                    if r[ncols] is not None and r[ncols + 1] is not None)
+                yield sample, annotations
+        finally:
+            cur.close()
+
+    def remove_samples(self, sample_accessions):
+        """Removes samples by accession number."""
+        with self.transaction():
+            sample_accession_vals = [(acc,) for acc in sample_accessions]
+            cur = self.con.cursor()
+            cur.executemany(self.delete_sample, sample_accession_vals)
+            self._reindex_samples(cur, sample_accessions)
+            cur.close()
+
+    def remove_annotations(self, sample_accessions, reindex=True):
+        """Removes annotations from a sequence of sample accessions.
+
+        If reindex is False, the search index is left for the caller
+        to update with reindex_samples.
+        """
+        with self.transaction():
+            sample_accession_vals = [(acc,) for acc in sample_accessions]
+            cur = self.con.cursor()
+            cur.executemany(
+                self.delete_standard_annotations, sample_accession_vals)
+            if migrations.annotations_encoded(self.con):
+                cur.executemany(
+                    self.delete_encoded_annotations, sample_accession_vals)
+            else:
+                cur.executemany(
+                    self.delete_nonstandard_annotations,
+                    sample_accession_vals)
+            cur.executemany(
+                self.delete_typed_annotations, sample_accession_vals)
+            if reindex:
+                self._reindex_samples(cur, sample_accessions)
+            cur.close()
 
     def query_sample_annotations(self, sample_accession):
         """Get annotations for a sample, given an accession number.
@@ -296,11 +1021,71 @@ class RegistryDatabase(object):
             self._query_nonstandard_annotations(sample_accession))
         return annotations
 
+    def query_run_annotations(self, run_accession):
+        """Get annotations for every sample in a run.
+
+        Returns a dict mapping sample accession to a dict of
+        annotations, ordered by sample accession.
+        """
+        cur = self.con.cursor()
+        cur.execute(self.select_run_standard_annotations, (run_accession,))
+        standard = cur.fetchall()
+        cur.execute(
+            self.select_run_nonstandard_annotations, (run_accession,))
+        nonstandard = cur.fetchall()
+        cur.close()
+        return self._merge_annotations(standard, nonstandard)
+
+    def query_multisample_annotations(self, sample_accessions):
+        """Get annotations for a sequence of sample accessions.
+
+        Accessions are queried in chunks, to stay within the SQLite
+        limit on the number of parameters in a statement.
+
+        Returns a dict mapping sample accession to a dict of
+        annotations, in the order given.  Accessions that are not
+        found in the database are omitted.
+        """
+        sample_accessions = list(sample_accessions)
+        standard = []
+        nonstandard = []
+        cur = self.con.cursor()
+        for chunk in _chunks(sample_accessions, SQLITE_MAX_VARIABLE_NUMBER):
+            placeholders = ", ".join("?" for _ in chunk)
+            cur.execute(
+                self.select_multisample_standard_annotations.format(
+                    placeholders), chunk)
+            standard.extend(cur.fetchall())
+            cur.execute(
+                self.select_multisample_nonstandard_annotations.format(
+                    placeholders), chunk)
+            nonstandard.extend(cur.fetchall())
+        cur.close()
+        # Restore input order
+        standard_by_acc = dict((r[0], r) for r in standard)
+        standard = [
+            standard_by_acc[acc] for acc in sample_accessions
+            if acc in standard_by_acc]
+        return self._merge_annotations(standard, nonstandard)
+
+    @classmethod
+    def _merge_annotations(cls, standard_rows, nonstandard_rows):
+        """Combine standard and EAV annotations into one dict per sample.
+        """
+        annotations = collections.OrderedDict()
+        for row in standard_rows:
+            pairs = zip(cls.standard_annotation_keys, row[1:])
+            annotations[row[0]] = dict(
+                (k, v) for k, v in pairs if v is not None)
+        for acc, k, v in nonstandard_rows:
+            if v is not None and acc in annotations:
+                annotations[acc][k] = v
+        return annotations
+
     def _query_standard_annotations(self, sample_accession):
         cur = self.con.cursor()
         cur.execute(
             self.select_standard_annotations, (sample_accession,))
-        self.con.commit()
         res = cur.fetchone()
         cur.close()
         pairs = zip(self.standard_annotation_keys, res)
@@ -311,18 +1096,53 @@ class RegistryDatabase(object):
         cur = self.con.cursor()
         cur.execute(
             self.select_nonstandard_annotations, (sample_accession,))
-        self.con.commit()
         res = cur.fetchall()
         cur.close()
         annotations = dict((k, v) for k, v in res if v is not None)
         return annotations
 
-    def register_annotations(self, annotations):
+    def query_annotation_range(self, key, low=None, high=None):
+        """Find samples with a number or date annotation in a range.
+
+        Both bounds are included in the range; a bound of None leaves
+        that end open.  Numbers in the bounds match annotation values
+        that are numbers, and dates match values that are dates.
+        Returns a list of (sample accession, value) tuples, ordered by
+        value.  Dates are returned as YYYY-MM-DD strings.
+        """
+        col, low, high = typed_range(low, high)
+        conditions = []
+        params = [key]
+        if low is not None:
+            conditions.append(" AND {0} >= ?".format(col))
+            params.append(low)
+        if high is not None:
+            conditions.append(" AND {0} <= ?".format(col))
+            params.append(high)
+        cur = self.con.cursor()
+        cur.execute(
+            self.select_annotation_range.format(col, "".join(conditions)),
+            params)
+        res = cur.fetchall()
+        cur.close()
+        return res
+
+    def register_annotations(self, annotations, reindex=True):
         """Registers annotations (expects triple of accession, key, val).
+
+        If reindex is False, the search index is left for the caller
+        to update with reindex_samples.
         """
         standard, nonstandard = self._split_standard_annotations(annotations)
-        self._register_standard_annotations(standard)
-        self._register_nonstandard_annotations(nonstandard)
+        with self.transaction():
+            self._register_standard_annotations(standard)
+            self._register_nonstandard_annotations(nonstandard)
+            cur = self.con.cursor()
+            self._register_typed_annotations(cur, nonstandard)
+            if reindex:
+                self._reindex_samples(
+                    cur, [acc for acc, _, _ in standard + nonstandard])
+            cur.close()
 
     @classmethod
     def _split_standard_annotations(cls, annotations):
@@ -342,7 +1162,6 @@ class RegistryDatabase(object):
             vals + [acc] for acc, vals in sample_vals.items()]
         cur = self.con.cursor()
         cur.executemany(self.insert_standard_annotations, sample_updates)
-        self.con.commit()
         cur.close()
 
     @classmethod
@@ -368,6 +1187,55 @@ class RegistryDatabase(object):
 
     def _register_nonstandard_annotations(self, annotations):
         cur = self.con.cursor()
-        cur.executemany(self.insert_nonstandard_annotation, annotations)
-        self.con.commit()
+        if migrations.annotations_encoded(self.con):
+            self._register_encoded_annotations(cur, annotations)
+        else:
+            cur.executemany(self.insert_nonstandard_annotation, annotations)
         cur.close()
+
+    def _register_typed_annotations(self, cur, annotations):
+        rows = []
+        for acc, key, val in annotations:
+            typed = typed_value(val)
+            if typed is not None:
+                rows.append((acc, key) + typed)
+        cur.executemany(self.insert_typed_annotation, rows)
+
+    def _select_in_chunks(self, cur, sql, vals):
+        rows = []
+        for chunk in _chunks(vals, SQLITE_MAX_VARIABLE_NUMBER):
+            placeholders = ", ".join("?" for _ in chunk)
+            cur.execute(sql.format(placeholders), chunk)
+            rows.extend(cur.fetchall())
+        return rows
+
+    def _register_encoded_annotations(self, cur, annotations):
+        # Encode in bulk here, rather than row by row through the
+        # triggers on the annotations view
+        key_vals = collections.defaultdict(list)
+        for _, key, val in annotations:
+            key_vals[key].append(val)
+        # As for existing annotations, values of a new key are interned
+        # if each value is used at least twice, on average
+        cur.executemany(self.insert_annotation_key_id, [
+            (key, len(set(vals)) * 2 <= len(vals))
+            for key, vals in key_vals.items()])
+        key_ids = {}
+        interned_keys = set()
+        for key, key_id, intern_values in self._select_in_chunks(
+                cur, self.select_annotation_key_ids, list(key_vals)):
+            key_ids[key] = key_id
+            if intern_values:
+                interned_keys.add(key)
+        vals = sorted(set(
+            val for key in interned_keys for val in key_vals[key]))
+        cur.executemany(self.insert_annotation_val_id, [(v,) for v in vals])
+        val_ids = dict(self._select_in_chunks(
+            cur, self.select_annotation_val_ids, vals))
+        rows = []
+        for acc, key, val in annotations:
+            if key in interned_keys:
+                rows.append((acc, key_ids[key], val_ids[val], None))
+            else:
+                rows.append((acc, key_ids[key], None, val))
+        cur.executemany(self.insert_encoded_annotation, rows)
@@ -0,0 +1,481 @@
+"""Assign sequencing reads to registered samples by barcode"""
+
+import argparse
+import collections
+import gzip
+import itertools
+import multiprocessing
+import os
+import random
+import sys
+
+from sample_registry.register import REGISTRY_DATABASE, SampleRegistry
+from sample_registry.util import (
+    parse_fastq_batches, open_gzip, reverse_complement, local_filepath,
+)
+
+
+class BarcodeIndex(object):
+    """Look up samples by barcode, allowing for sequencing errors.
+
+    Every sequence within max_mismatches substitutions of a barcode is
+    precomputed and stored in a dict, so each read is assigned with a
+    single lookup.  Sequences within range of more than one barcode
+    are not assigned to any sample.  Dual-index barcodes are written
+    with a '-' or '+' between the two indices.
+    """
+    bases = "ACGTN"
+
+    def __init__(self, sample_barcodes, max_mismatches=1):
+        self.sample_names = []
+        self.max_mismatches = max_mismatches
+        exact = {}
+        for n, (sample_name, barcode) in enumerate(sample_barcodes):
+            self.sample_names.append(sample_name)
+            barcode = self.normalize(barcode)
+            if barcode in exact:
+                raise ValueError(
+                    "Samples {0} and {1} have the same barcode {2}".format(
+                        self.sample_names[exact[barcode]], sample_name,
+                        barcode))
+            exact[barcode] = n
+        self.index = {}
+        ambiguous = set()
+        for barcode, n in exact.items():
+            for seq in self._neighbors(barcode, max_mismatches):
+                if seq in exact:
+                    continue
+                other = self.index.get(seq)
+                if other is not None and other != n:
+                    ambiguous.add(seq)
+                self.index[seq] = n
+        for seq in ambiguous:
+            del self.index[seq]
+        self.index.update(exact)
+
+    @staticmethod
+    def normalize(barcode):
+        return barcode.upper().replace("+", "-")
+
+    @classmethod
+    def _neighbors(cls, barcode, max_mismatches):
+        positions = [i for i, x in enumerate(barcode) if x != "-"]
+        for k in range(1, max_mismatches + 1):
+            for idxs in itertools.combinations(positions, k):
+                choices = [
+                    [b for b in cls.bases if b != barcode[i]] for i in idxs]
+                seq = list(barcode)
+                for subs in itertools.product(*choices):
+                    for i, b in zip(idxs, subs):
+                        seq[i] = b
+                    yield "".join(seq)
+
+    def assign(self, seq):
+        """Return the index of the sample for a sequence, or None."""
+        return self.index.get(self.normalize(seq))
+
+
+def header_index_seq(desc):
+    """Get the index sequence from an Illumina FASTQ header."""
+    _, _, word2 = desc.partition(" ")
+    return word2.rsplit(":", 1)[-1]
+
+
+def _revcomp_header_i2(seq):
+    i1, sep, i2 = BarcodeIndex.normalize(seq).partition("-")
+    if not sep:
+        return seq
+    try:
+        return i1 + "-" + reverse_complement(i2)
+    except KeyError:
+        # Not a DNA sequence, so it will not be assigned anyway
+        return seq
+
+
+def batch_index_seqs(batch, num_reads, has_index_reads, revcomp_i2=False):
+    """Get the index sequence for each set of records in a batch.
+
+    Index sequences are taken from the header of the first read, or
+    from the index reads that follow the num_reads reads.  If
+    revcomp_i2 is set, the second index is reverse complemented in
+    either case.
+    """
+    if not has_index_reads:
+        seqs = [header_index_seq(recs[0][0].decode("ascii")) for recs in batch]
+        if revcomp_i2:
+            seqs = [_revcomp_header_i2(seq) for seq in seqs]
+        return seqs
+    seqs = []
+    for recs in batch:
+        index_recs = recs[num_reads:]
+        i1 = index_recs[0][1].decode("ascii")
+        if len(index_recs) < 2:
+            seqs.append(i1)
+            continue
+        i2 = index_recs[1][1]
+        if revcomp_i2:
+            i2 = reverse_complement(i2)
+        seqs.append(i1 + "-" + i2.decode("ascii"))
+    return seqs
+
+
+def compress_sample_reads(sample_recs, num_reads):
+    """Format and compress the reads assigned to each sample.
+
+    Returns a dict mapping (sample index, read index) to a gzip member
+    with the FASTQ records.
+    """
+    compressed = {}
+    for sample_idx, recs in sample_recs.items():
+        for read_idx in range(num_reads):
+            data = b"".join(
+                b"@" + r[read_idx][0] + b"\n" + r[read_idx][1] +
+                b"\n+\n" + r[read_idx][2] + b"\n" for r in recs)
+            compressed[(sample_idx, read_idx)] = gzip.compress(
+                data, compresslevel=1)
+    return compressed
+
+
+_worker_args = None
+
+
+def _init_worker(index, num_reads, has_index_reads, revcomp_i2, write):
+    global _worker_args
+    _worker_args = (index, num_reads, has_index_reads, revcomp_i2, write)
+
+
+def _demultiplex_batch(batch):
+    """Assign a batch of records to samples.
+
+    Returns a Counter of records per sample index, and the compressed
+    reads for each sample if they are to be written.
+    """
+    index, num_reads, has_index_reads, revcomp_i2, write = _worker_args
+    seqs = batch_index_seqs(batch, num_reads, has_index_reads, revcomp_i2)
+    counts = collections.Counter()
+    sample_recs = collections.defaultdict(list)
+    for recs, seq in zip(batch, seqs):
+        sample_idx = index.assign(seq)
+        counts[sample_idx] += 1
+        if write and sample_idx is not None:
+            sample_recs[sample_idx].append(recs)
+    compressed = None
+    if write:
+        compressed = compress_sample_reads(sample_recs, num_reads)
+    return counts, compressed
+
+
+def read_fastq_records(fp):
+    if fp.endswith(".gz"):
+        f = open_gzip(fp)
+    else:
+        f = open(fp, "rb")
+    try:
+        for batch in parse_fastq_batches(f):
+            for rec in batch:
+                yield rec
+    finally:
+        f.close()
+
+
+_MISSING = object()
+
+
+def _record_batches(read_fps, index_fps, batch_size):
+    """Read records from several files in step, in batches.
+
+    Yields lists of tuples, with one record from each file.  Raises a
+    ValueError if the files do not have the same number of records.
+    """
+    fps = read_fps + index_fps
+    readers = [read_fastq_records(fp) for fp in fps]
+    records = itertools.zip_longest(*readers, fillvalue=_MISSING)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            break
+        # Once a file runs out, every later tuple is missing a record
+        if any(rec is _MISSING for rec in batch[-1]):
+            short_fps = [
+                fp for fp, rec in zip(fps, batch[-1]) if rec is _MISSING]
+            raise ValueError(
+                "FASTQ files {0} have fewer records than {1}".format(
+                    ", ".join(short_fps),
+                    ", ".join(fp for fp in fps if fp not in short_fps)))
+        yield batch
+
+
+class SampleFastqWriter(object):
+    """Write reads to a gzipped FASTQ file for each sample.
+
+    The files are created, or emptied, when the writer starts.  Each
+    batch of compressed reads is appended to the files as a separate
+    gzip member, so that only one file is open at a time.
+    """
+
+    def __init__(self, output_dir, sample_names, num_reads):
+        self.output_dir = output_dir
+        self.sample_names = sample_names
+        self.num_reads = num_reads
+        empty = gzip.compress(b"")
+        for sample_name in sample_names:
+            for read_idx in range(num_reads):
+                with open(self.fastq_fp(sample_name, read_idx + 1), "wb") as f:
+                    f.write(empty)
+
+    def fastq_fp(self, sample_name, read_num):
+        filename = "{0}_R{1}.fastq.gz".format(sample_name, read_num)
+        return os.path.join(self.output_dir, filename)
+
+    def write(self, compressed):
+        """Append reads from compress_sample_reads to the files."""
+        for (sample_idx, read_idx), data in sorted(compressed.items()):
+            sample_name = self.sample_names[sample_idx]
+            fp = self.fastq_fp(sample_name, read_idx + 1)
+            with open(fp, "ab") as f:
+                f.write(data)
+
+
+def demultiplex(
+        index, read_fps, index_fps=(), revcomp_i2=False, output_dir=None,
+        processes=4, batch_size=100000):
+    """Assign reads to samples.
+
+    Index sequences are taken from the headers of the first read file,
+    or from the index read files if given.  If output_dir is given,
+    reads are also written to a pair of gzipped FASTQ files per
+    sample, replacing any files from an earlier run.
+
+    Records are read in the main process.  If reads are written, the
+    records are sent in batches to worker processes, which assign them
+    to samples and format and compress the output, which is most of
+    the work.  Counting alone takes a dict lookup per read, less than
+    the cost of sending the read to a worker, so it is done in the
+    main process.
+
+    Returns a Counter of reads per sample name, with unassigned reads
+    counted under None.
+    """
+    read_fps = list(read_fps)
+    index_fps = list(index_fps)
+    nreads = len(read_fps)
+    writer = None
+    if output_dir is not None:
+        writer = SampleFastqWriter(output_dir, index.sample_names, nreads)
+    worker_args = (
+        index, nreads, bool(index_fps), revcomp_i2, writer is not None)
+
+    counts = collections.Counter()
+
+    def tally(result):
+        batch_counts, compressed = result
+        counts.update(batch_counts)
+        if writer is not None:
+            writer.write(compressed)
+
+    batches = _record_batches(read_fps, index_fps, batch_size)
+    if processes > 1 and writer is not None:
+        # Keep a bounded number of batches in flight, so that memory
+        # use does not grow with the size of the input files.  Results
+        # are taken in order, so reads are written in input order.
+        pool = multiprocessing.Pool(processes, _init_worker, worker_args)
+        pending = collections.deque()
+        try:
+            for batch in batches:
+                pending.append(pool.apply_async(_demultiplex_batch, (batch, )))
+                if len(pending) > 2 * processes:
+                    tally(pending.popleft().get())
+            while pending:
+                tally(pending.popleft().get())
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        _init_worker(*worker_args)
+        for batch in batches:
+            tally(_demultiplex_batch(batch))
+
+    sample_counts = collections.Counter()
+    for sample_idx, count in counts.items():
+        if sample_idx is None:
+            sample_counts[None] += count
+        else:
+            sample_counts[index.sample_names[sample_idx]] += count
+    return sample_counts
+
+
+def demultiplex_run(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Assign reads to the samples registered for a run, and report "
+        "the number of reads for each sample"))
+    p.add_argument("run_accession", type=int, help="Run accession number")
+    p.add_argument(
+        "fastq", nargs="+",
+        help="FASTQ files for the run (R1, optionally R2), in step")
+    p.add_argument(
+        "--index-fastq", nargs="+", default=[],
+        help=(
+            "FASTQ files for the index reads (I1, optionally I2).  If not "
+            "given, index sequences are read from the FASTQ headers."))
+    p.add_argument(
+        "--revcomp-i2", action="store_true",
+        help=(
+            "Reverse complement the second index, from the index reads or "
+            "the FASTQ headers"))
+    p.add_argument(
+        "--mismatches", type=int, default=1,
+        help="Mismatches allowed in barcode (default: %(default)s)")
+    p.add_argument(
+        "--output-dir",
+        help="Write reads to a gzipped FASTQ file per sample in this folder")
+    p.add_argument(
+        "--processes", type=int, default=4,
+        help=(
+            "Number of worker processes to compress the output files "
+            "(default: %(default)s)"))
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(db)
+    registry.check_run_accession(args.run_accession)
+    sample_barcodes = db.query_sample_barcodes(args.run_accession)
+    index = BarcodeIndex(sample_barcodes, args.mismatches)
+    if args.output_dir is not None and not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    counts = demultiplex(
+        index, args.fastq, args.index_fastq, args.revcomp_i2,
+        args.output_dir, args.processes)
+
+    out.write("SampleID\tread_count\n")
+    for sample_name, _ in sample_barcodes:
+        out.write("{0}\t{1}\n".format(sample_name, counts[sample_name]))
+    out.write("Unassigned\t{0}\n".format(counts[None]))
+
+
+def sample_index_seqs(fp, max_reads=1000000, sample_size=100000, seed=0):
+    """Reservoir-sample index sequences from the start of a FASTQ file.
+
+    Only the first max_reads records are read, so the time taken does
+    not depend on the size of the file.  Index sequences are taken
+    from the FASTQ headers.
+
+    Returns a list of up to sample_size index sequences.
+    """
+    rng = random.Random(seed)
+    reservoir = []
+    n = 0
+    records = read_fastq_records(fp)
+    try:
+        for desc, _, _ in records:
+            if n >= max_reads:
+                break
+            index_seq = header_index_seq(desc.decode("ascii"))
+            if n < sample_size:
+                reservoir.append(index_seq)
+            else:
+                k = rng.randint(0, n)
+                if k < sample_size:
+                    reservoir[k] = index_seq
+            n += 1
+    finally:
+        records.close()
+    return reservoir
+
+
+def compare_index_seqs(index, index_seqs, min_fraction=0.01):
+    """Compare observed index sequences to the barcodes for a run.
+
+    Returns a Counter of reads per sample name, a list of
+    (sequence, fraction) for unassigned sequences seen in at least
+    min_fraction of reads, and a list of sample names with no reads.
+    """
+    observed = collections.Counter(
+        BarcodeIndex.normalize(seq) for seq in index_seqs)
+    total = sum(observed.values())
+    sample_counts = collections.Counter()
+    unexpected = []
+    for seq, count in observed.most_common():
+        sample_idx = index.assign(seq)
+        if sample_idx is not None:
+            sample_counts[index.sample_names[sample_idx]] += count
+        elif count >= min_fraction * total:
+            unexpected.append((seq, float(count) / total))
+    missing = [s for s in index.sample_names if s not in sample_counts]
+    return sample_counts, unexpected, missing
+
+
+def _reversed_i2_match(index, seq):
+    """Find a sample whose barcode matches with the second index reversed.
+    """
+    i1, sep, i2 = seq.partition("-")
+    if not sep:
+        return None
+    try:
+        sample_idx = index.assign(i1 + "-" + reverse_complement(i2))
+    except KeyError:
+        return None
+    if sample_idx is not None:
+        return index.sample_names[sample_idx]
+    return None
+
+
+def verify_barcodes(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Check the barcodes registered for a run against a sample of "
+        "reads from the start of the run's FASTQ file"))
+    p.add_argument("run_accession", type=int, help="Run accession number")
+    p.add_argument(
+        "fastq", nargs="?",
+        help="FASTQ file to sample (default: data file for the run)")
+    p.add_argument(
+        "--max-reads", type=int, default=1000000,
+        help="Number of reads to scan (default: %(default)s)")
+    p.add_argument(
+        "--sample-size", type=int, default=100000,
+        help="Number of reads to sample (default: %(default)s)")
+    p.add_argument(
+        "--min-fraction", type=float, default=0.01,
+        help=(
+            "Report unregistered barcodes found in at least this fraction "
+            "of reads (default: %(default)s)"))
+    p.add_argument(
+        "--mismatches", type=int, default=1,
+        help="Mismatches allowed in barcode (default: %(default)s)")
+    p.add_argument(
+        "--local-mount",
+        help="Local directory where the data files are mounted")
+    p.add_argument(
+        "--remote-mount",
+        help="Directory of the data files, as registered in the database")
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(db)
+    registry.check_run_accession(args.run_accession)
+    fastq_fp = args.fastq
+    if fastq_fp is None:
+        fastq_fp = local_filepath(
+            db.query_run_file(args.run_accession), args.local_mount,
+            args.remote_mount)
+    sample_barcodes = db.query_sample_barcodes(args.run_accession)
+    index = BarcodeIndex(sample_barcodes, args.mismatches)
+
+    index_seqs = sample_index_seqs(
+        fastq_fp, args.max_reads, args.sample_size)
+    sample_counts, unexpected, missing = compare_index_seqs(
+        index, index_seqs, args.min_fraction)
+
+    num_assigned = sum(sample_counts.values())
+    out.write(
+        "Sampled {0} reads, {1} assigned to registered samples\n".format(
+            len(index_seqs), num_assigned))
+    for seq, fraction in unexpected:
+        note = ""
+        sample_name = _reversed_i2_match(index, seq)
+        if sample_name is not None:
+            note = (
+                " (matches {0} with second index reverse "
+                "complemented)".format(sample_name))
+        out.write("Unexpected barcode {0} in {1:.1%} of reads{2}\n".format(
+            seq, fraction, note))
+    for sample_name in missing:
+        out.write("No reads for sample {0}\n".format(sample_name))
@@ -0,0 +1,124 @@
+"""Export samples and annotations from the registry"""
+
+import argparse
+import json
+import os.path
+import sys
+
+from sample_registry.register import REGISTRY_DATABASE, SampleRegistry
+
+
+def format_sample_accession(n):
+    return "CMS{0:06d}".format(n)
+
+
+def format_run_accession(n):
+    return "CMR{0:06d}".format(n)
+
+
+# Renamed on export for compatibility with QIIME
+QIIME_KEYS = {
+    "ReversePrimerSequence": "ReversePrimer",
+}
+
+
+def _core_vals(sample):
+    return [
+        sample["sample_name"],
+        (sample["barcode_sequence"] or "").upper(),
+        (sample["primer_sequence"] or "").upper(),
+        sample["sample_type"] or "NA",
+        sample["host_species"] or "NA",
+        sample["subject_id"] or "NA",
+    ]
+
+
+def _table_rows(samples, keys, missing="NA"):
+    for sample, annotations in samples:
+        vals = _core_vals(sample)
+        vals.extend(annotations.get(k, missing) for k in keys)
+        vals.append(format_sample_accession(sample["sample_accession"]))
+        yield vals
+
+
+def write_tsv(f, run, keys, samples):
+    """Write samples as a tab-delimited table."""
+    header = [
+        "SampleID", "Barcode", "Primer", "SampleType", "HostSpecies",
+        "SubjectID"] + keys + ["sample_accession"]
+    f.write(u"\t".join(header) + u"\n")
+    for vals in _table_rows(samples, keys):
+        f.write(u"\t".join(vals) + u"\n")
+
+
+def write_qiime(f, run, keys, samples):
+    """Write samples as a QIIME mapping file."""
+    qiime_keys = [QIIME_KEYS.get(k, k) for k in keys]
+    header = [
+        "#SampleID", "BarcodeSequence", "LinkerPrimerSequence",
+        "SampleType", "HostSpecies", "SubjectID"] + qiime_keys + [
+        "Description"]
+    f.write(u"\t".join(header) + u"\n")
+    comment = run["comment"].replace("\n", "").replace("\r", "")
+    f.write(u"#{0}\n".format(comment))
+    f.write(u"#Sequencing date: {0}\n".format(run["run_date"]))
+    f.write(u"#File name: {0}\n".format(os.path.basename(run["data_uri"])))
+    f.write(u"#Lane: {0}\n".format(run["lane"]))
+    f.write(u"#Platform: {0} {1}\n".format(
+        run["machine_type"], run["machine_kit"]))
+    f.write(u"#Run accession: {0}\n".format(
+        format_run_accession(run["run_accession"])))
+    for vals in _table_rows(samples, keys):
+        f.write(u"\t".join(vals) + u"\n")
+
+
+def write_json(f, run, keys, samples):
+    """Write the run and its samples as a JSON document.
+
+    Samples are written one at a time, so the document is never held
+    in memory as a whole.
+    """
+    f.write(u'{"run": ')
+    f.write(json.dumps(run))
+    f.write(u', "samples": [')
+    for n, (sample, annotations) in enumerate(samples):
+        vals = dict(sample)
+        vals.update(annotations)
+        if n > 0:
+            f.write(u", ")
+        f.write(json.dumps(vals))
+    f.write(u"]}\n")
+
+
+EXPORT_FORMATS = {
+    "tsv": write_tsv,
+    "qiime": write_qiime,
+    "json": write_json,
+}
+
+
+def export_run(db, run_accession, f, fmt="tsv"):
+    """Stream the samples and annotations for a run to a file."""
+    write_fcn = EXPORT_FORMATS[fmt]
+    run = db.query_run(run_accession)
+    keys = db.query_run_annotation_keys(run_accession)
+    samples = db.iter_run_samples(run_accession)
+    write_fcn(f, run, keys, samples)
+
+
+def export_samples(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Export samples and annotations for a sequencing run"))
+    p.add_argument("run_accession", type=int, help="Run accession number")
+    p.add_argument(
+        "--format", default="tsv", choices=sorted(EXPORT_FORMATS),
+        help="Output format (default: %(default)s)")
+    p.add_argument(
+        "--output", type=argparse.FileType("w"),
+        help="Output file (default: standard output)")
+    args = p.parse_args(argv)
+
+    registry = SampleRegistry(db)
+    registry.check_run_accession(args.run_accession)
+    f = args.output or out
+    export_run(db, args.run_accession, f, args.format)
@@ -1,7 +1,10 @@
+import collections
 import gzip
 import os.path
 import re
 
+from sample_registry.util import parse_fastq_batches, open_gzip
+
 
 class IlluminaFastq(object):
     machine_types = {"D": "Illumina-HiSeq", "M": "Illumina-MiSeq", "A": "Illumina-NovaSeq"}
@@ -53,6 +56,90 @@ class IlluminaFastq(object):
         return self.file.name
 
 
+def read_fastq_info(fp):
+    """Read run info from the first header of a gzipped FASTQ file.
+
+    Returns a dict of the header fields, along with the file path,
+    machine type, and run date.
+    """
+    with gzip.open(fp, "rt") as f:
+        fq = IlluminaFastq(f)
+        info = dict(fq.fastq_info)
+        info["filepath"] = fq.filepath
+        info["machine_type"] = fq.machine_type
+        info["date"] = fq.date
+    return info
+
+
+class ReadStats(object):
+    """Summary of the reads for one lane and read number."""
+
+    def __init__(self):
+        self.read_count = 0
+        self.base_count = 0
+        self.quality_sum = 0
+        self.lengths = collections.Counter()
+
+    def add_batch(self, seqs, quals):
+        self.read_count += len(seqs)
+        self.lengths.update(map(len, seqs))
+        quals = b"".join(quals)
+        self.base_count += len(quals)
+        # Quality scores are encoded as Phred + 33
+        self.quality_sum += sum(quals) - 33 * len(quals)
+
+    def update(self, other):
+        self.read_count += other.read_count
+        self.base_count += other.base_count
+        self.quality_sum += other.quality_sum
+        self.lengths.update(other.lengths)
+
+    @property
+    def mean_quality(self):
+        if self.base_count == 0:
+            return None
+        return float(self.quality_sum) / self.base_count
+
+
+def _lane_and_read(desc):
+    word1, _, word2 = desc.partition(b" ")
+    return int(word1.split(b":")[3]), int(word2.split(b":", 1)[0])
+
+
+def read_fastq_stats(fp):
+    """Compute read statistics for a gzipped Illumina FASTQ file.
+
+    The file is decompressed once, in large blocks.  Statistics are
+    kept separately for each lane and read number found in the FASTQ
+    headers.
+
+    Returns a dict mapping (lane, read number) to ReadStats.
+    """
+    stats = collections.defaultdict(ReadStats)
+    with open_gzip(fp) as f:
+        for batch in parse_fastq_batches(f):
+            keys = [_lane_and_read(desc) for desc, _, _ in batch]
+            if keys[0] == keys[-1] and len(set(keys)) == 1:
+                groups = {keys[0]: batch}
+            else:
+                groups = collections.defaultdict(list)
+                for key, rec in zip(keys, batch):
+                    groups[key].append(rec)
+            for key, recs in groups.items():
+                _, seqs, quals = zip(*recs)
+                stats[key].add_batch(seqs, quals)
+    return dict(stats)
+
+
+def merge_read_stats(stats_list):
+    """Combine read statistics from several files."""
+    merged = collections.defaultdict(ReadStats)
+    for stats in stats_list:
+        for key, s in stats.items():
+            merged[key].update(s)
+    return dict(merged)
+
+
 # From https://www.safaribooksonline.com/library/view/python-cookbook/0596001673/ch04s16.html
 def splitall(path):
     allparts = []
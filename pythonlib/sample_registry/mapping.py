@@ -1,6 +1,73 @@
 """Read, validate, and write sample info tables"""
 
-import string
+import collections
+import re
+import sys
+
+from sample_registry.barcodes import index_kits
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+class SampleFields(object):
+    """Field names shared by all the records in a sample table."""
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.index = dict((n, i) for i, n in enumerate(self.names))
+
+    def add(self, name):
+        if name not in self.index:
+            self.index[name] = len(self.names)
+            self.names.append(name)
+        return self.index[name]
+
+
+class SampleRecord(MutableMapping):
+    """A record in a sample table, stored as a list of values.
+
+    The field names are held in a SampleFields object shared with the
+    other records from the same table, so that each record costs one
+    list rather than one dict.  Missing values are stored as None.
+    The record behaves as a dict of the values that are present.
+    """
+    __slots__ = ["fields", "vals"]
+
+    def __init__(self, fields, vals):
+        self.fields = fields
+        self.vals = vals
+
+    def __getitem__(self, key):
+        idx = self.fields.index[key]
+        if idx >= len(self.vals) or self.vals[idx] is None:
+            raise KeyError(key)
+        return self.vals[idx]
+
+    def __setitem__(self, key, val):
+        idx = self.fields.add(key)
+        if idx >= len(self.vals):
+            self.vals.extend(None for _ in range(idx + 1 - len(self.vals)))
+        self.vals[idx] = val
+
+    def __delitem__(self, key):
+        idx = self.fields.index.get(key)
+        if idx is None or idx >= len(self.vals) or self.vals[idx] is None:
+            raise KeyError(key)
+        self.vals[idx] = None
+
+    def __iter__(self):
+        for name, val in zip(self.fields.names, self.vals):
+            if val is not None:
+                yield name
+
+    def __len__(self):
+        return sum(1 for v in self.vals if v is not None)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
 
 
 class SampleTable(object):
@@ -29,35 +96,79 @@ class SampleTable(object):
 
     @property
     def annotations(self):
+        core_fields = set(self.CORE_FIELDS)
         for r in self.recs:
-            annotation_keys = set(r.keys()) - set(self.CORE_FIELDS)
-            yield [(k, r[k]) for k in annotation_keys]
+            yield [(k, v) for k, v in r.items() if k not in core_fields]
 
     def validate(self):
-        _validate_sample_ids(self.recs)
-        _validate_barcodes(self.recs)
+        """Raise ValueError if any record is invalid.
+
+        The error lists every problem found in the table.
+        """
+        self.check(max_barcode_distance=0).raise_for_errors()
+
+    def check(self, max_barcode_distance=2):
+        """Check all records and return a ValidationReport."""
+        validator = SampleTableValidator(max_barcode_distance)
+        for r in self.recs:
+            validator.check(r)
+        return validator.finish()
 
     def write(self, f):
-        rows = _cast(self.recs, self.CORE_FIELDS, [])
-        for row in rows:
-            f.write(u"\t".join(row))
-            f.write(u"\n")
+        header = _cast_header(self.recs, self.CORE_FIELDS, [])
+        write_records(f, self.recs, header)
 
     @classmethod
-    def load(cls, f):
-        recs = list(cls._parse(f))
+    def load(cls, f, compact=False):
+        """Load a sample table from a file.
+
+        If compact is True, records are stored as SampleRecord objects
+        that share a single list of field names, rather than as dicts.
+        """
+        if compact:
+            recs = list(cls._parse_compact(f))
+        else:
+            recs = list(cls._parse(f))
         if not recs:
             raise ValueError(
                 "No records found in sample info file. "
                 "Problem with windows line endings?")
         return cls(recs)
 
+    @classmethod
+    def stream(cls, f, kits=None, validator=None):
+        """Parse, look up barcodes for, and validate records in one pass.
+
+        Records are yielded as SampleRecord objects as soon as they
+        pass validation.  Validation errors for a record are raised
+        when that record is reached.  After the last record, the
+        validator is finished, so warnings about near barcodes are in
+        validator.report, as they are for check().
+        """
+        if kits is None:
+            kits = index_kits()
+        if validator is None:
+            validator = SampleTableValidator()
+        n = 0
+        for r in cls._parse_compact(f):
+            if "Description" in r:
+                del r["Description"]
+            _look_up_barcodes([r], kits)
+            errors = validator.check(r)
+            if errors:
+                raise ValueError("\n".join(errors))
+            n += 1
+            yield r
+        if n == 0:
+            raise ValueError(
+                "No records found in sample info file. "
+                "Problem with windows line endings?")
+        validator.finish()
+
     @classmethod
     def _parse(cls, f):
         """Parse mapping file, return each record as a dict."""
-        header = next(f).lstrip("#")
-        keys = cls._tokenize(header)
-        assert(all(keys)) # No blank fields in header
+        keys = cls._parse_header(f)
         for line in f:
             if line.startswith("#"):
                 continue
@@ -66,6 +177,29 @@ class SampleTable(object):
             vals = cls._tokenize(line)
             yield dict([(k, v) for k, v in zip(keys, vals) if v not in cls.NAs])
 
+    @classmethod
+    def _parse_compact(cls, f):
+        """Parse mapping file, return each record as a SampleRecord."""
+        fields = SampleFields(cls._parse_header(f))
+        NAs = cls.NAs
+        # Annotation values repeat often, so store one copy of each
+        intern = sys.intern
+        for line in f:
+            if line.startswith("#"):
+                continue
+            if not line.strip():
+                continue
+            vals = cls._tokenize(line)[:len(fields.names)]
+            yield SampleRecord(
+                fields, [None if v in NAs else intern(v) for v in vals])
+
+    @classmethod
+    def _parse_header(cls, f):
+        header = next(f).lstrip("#")
+        keys = cls._tokenize(header)
+        assert(all(keys)) # No blank fields in header
+        return keys
+
     @classmethod
     def _tokenize(cls, line):
         """Tokenize a single line"""
@@ -73,26 +207,63 @@ class SampleTable(object):
         toks = line.split("\t")
         return [t.strip() for t in toks]
 
-    def look_up_nextera_barcodes(self):
-        barcodes = dict(x.split() for x in NEXTERA_BARCODES.splitlines())
-        for r in self.recs:
-            if "BarcodeSequence" in r:
-                continue
-            try:
-                fwd_index = r["barcode_index_fwd"]
-                fwd_barcode = barcodes[fwd_index]
-                rev_index = r["barcode_index_rev"]
-                rev_barcode = barcodes[rev_index]
-                r["BarcodeSequence"] = fwd_barcode + "-" + rev_barcode
-            except KeyError as e:
-                raise KeyError(
-                    "Could not find DNA barcode sequence for this record:\n"
-                    "%s\n%s" % (r, e)
-                )
+    def look_up_nextera_barcodes(self, kits=None):
+        """Fill in missing barcodes from the names of the index pair.
+
+        Index names are read from the barcode_index_fwd and
+        barcode_index_rev fields and looked up in the registry of
+        index kits.  Every record that cannot be resolved is reported
+        in a single error.
+        """
+        if kits is None:
+            kits = index_kits()
+        _look_up_barcodes(self.recs, kits)
+
+
+def _look_up_barcodes(recs, kits):
+    recs = [r for r in recs if "BarcodeSequence" not in r]
+    index_pairs = [
+        (r.get("barcode_index_fwd"), r.get("barcode_index_rev"))
+        for r in recs]
+    barcodes, unresolved = kits.resolve_pairs(index_pairs)
+    if unresolved:
+        raise KeyError(
+            "Could not find DNA barcode sequence for these records:\n" +
+            "\n".join(str(recs[n]) for n in unresolved))
+    for r, barcode in zip(recs, barcodes):
+        r["BarcodeSequence"] = barcode
+
+
+def write_records(f, records, header, missing="NA", batch_size=1000):
+    """Write records as a tab-delimited table with the given header.
+
+    Records are consumed one at a time and written in batches of
+    lines, so the table is never built in memory.
+    """
+    _write_lines(f, [header])
+    batch = []
+    for row in _cast_rows(records, header, missing):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            _write_lines(f, batch)
+            batch = []
+    if batch:
+        _write_lines(f, batch)
+
+
+def _write_lines(f, rows):
+    f.write(u"".join(u"\t".join(row) + u"\n" for row in rows))
 
 
 def _cast(records, left_cols, right_cols, missing="NA"):
     records = list(records)
+    header = _cast_header(records, left_cols, right_cols)
+    yield header
+    for row in _cast_rows(records, header, missing):
+        yield row
+
+
+def _cast_header(records, left_cols, right_cols):
     # Make a copy for appending
     left_cols = list(left_cols)
     all_cols = set(left_cols + right_cols)
@@ -101,88 +272,132 @@ def _cast(records, left_cols, right_cols, missing="NA"):
             if key not in all_cols:
                 left_cols.append(key)
                 all_cols.add(key)
+    return left_cols + right_cols
 
-    header = left_cols + right_cols
-    yield header
 
+def _cast_rows(records, header, missing="NA"):
+    col_idx = dict((key, idx) for idx, key in enumerate(header))
+    ncols = len(header)
     for r in records:
-        row = [missing for _ in header]
+        row = [missing] * ncols
         for key, val in r.items():
-            idx = header.index(key)
-            row[idx] = val
+            row[col_idx[key]] = val
         yield row
 
 
-def _validate_sample_ids(recs):
-    seen = set()
-    allowed = set("." + string.ascii_letters + string.digits)
-    allowed_start = set(string.ascii_letters)
-    for r in recs:
-        sample_id = r["SampleID"]
-        if sample_id in seen:
-            raise ValueError("Duplicated sample ID: %s" % r)
-        seen.add(sample_id)
-        if not all(char in allowed for char in sample_id):
-            raise ValueError("Illegal characters in sample ID: %s" % r)
-        if not sample_id[0] in allowed_start:
-            raise ValueError("Sample ID must begin with a letter: %s" % r)
-
-
-def _validate_barcodes(recs):
-    seen = set()
-    allowed = set("AGCT-")
-    for r in recs:
-        barcode = r["BarcodeSequence"]
-        if barcode in seen:
-            raise ValueError("Duplicated barcode: %s" % r)
-        seen.add(barcode)
-        if not all(char in allowed for char in barcode):
-            raise ValueError("Illegal characters in barcode: %s" % r)
-
-
-NEXTERA_BARCODES = u"""\
-N701	TAAGGCGA
-N702	CGTACTAG
-N703	AGGCAGAA
-N704	TCCTGAGC
-N705	GGACTCCT
-N706	TAGGCATG
-N707	CTCTCTAC
-N708	CAGAGAGG
-N709	GCTACGCT
-N710	CGAGGCTG
-N711	AAGAGGCA
-N712	GTAGAGGA
-N714	GCTCATGA
-N715	ATCTCAGG
-N716	ACTCGCTA
-N718	GGAGCTAC
-N719	GCGTAGTA
-N720	CGGAGCCT
-N721	TACGCTGC
-N722	ATGCGCAG
-N723	TAGCGCTC
-N724	ACTGAGCG
-N726	CCTAAGAC
-N727	CGATCAGT
-N728	TGCAGCTA
-N729	TCGACGTC
-S501	TAGATCGC
-S502	CTCTCTAT
-S503	TATCCTCT
-S504	AGAGTAGA
-S505	GTAAGGAG
-S506	ACTGCATA
-S507	AAGGAGTA
-S508	CTAAGCCT
-S510	CGTCTAAT
-S511	TCTCTCCG
-S513	TCGACTAG
-S515	TTCTAGCT
-S516	CCTAGAGT
-S517	GCGTAAGA
-S518	CTATTAAG
-S520	AAGGCTAT
-S521	GAGCCTTA
-S522	TTATGCGA
-"""
+class ValidationReport(object):
+    """Problems found in a sample table.
+
+    Errors prevent the table from being registered.  Warnings, such as
+    barcodes that differ by only one or two bases, are reported for
+    the user to review.
+    """
+
+    def __init__(self):
+        self.errors = []
+        self.warnings = []
+
+    def raise_for_errors(self):
+        if self.errors:
+            raise ValueError(
+                "Found {0} errors in sample table:\n{1}".format(
+                    len(self.errors), self))
+
+    def __str__(self):
+        lines = ["Error: {0}".format(e) for e in self.errors]
+        lines.extend("Warning: {0}".format(w) for w in self.warnings)
+        return "\n".join(lines)
+
+
+class SampleTableValidator(object):
+    """Check records for valid sample IDs and barcodes in a single pass.
+
+    Records are checked one at a time with check(), which collects
+    every error rather than stopping at the first one.  After the last
+    record, finish() searches for pairs of barcodes within
+    max_barcode_distance mismatches of each other.
+    """
+    sample_id_re = re.compile(r"[A-Za-z][A-Za-z0-9.]*$")
+    sample_id_chars_re = re.compile(r"[A-Za-z0-9.]*$")
+    barcode_re = re.compile(r"[AGCT-]+$")
+
+    def __init__(self, max_barcode_distance=2):
+        self.max_barcode_distance = max_barcode_distance
+        self.report = ValidationReport()
+        self.sample_ids = set()
+        self.barcodes = {}
+
+    def check(self, r):
+        """Check a single record.
+
+        Returns a list of errors found in the record.
+        """
+        errors = []
+        sample_id = r.get("SampleID")
+        if sample_id is None:
+            errors.append("Missing sample ID: %s" % r)
+        else:
+            if sample_id in self.sample_ids:
+                errors.append("Duplicated sample ID: %s" % r)
+            self.sample_ids.add(sample_id)
+            if not self.sample_id_re.match(sample_id):
+                if not self.sample_id_chars_re.match(sample_id):
+                    errors.append("Illegal characters in sample ID: %s" % r)
+                else:
+                    errors.append(
+                        "Sample ID must begin with a letter: %s" % r)
+        barcode = r.get("BarcodeSequence")
+        if barcode is None:
+            errors.append("Missing barcode: %s" % r)
+        else:
+            if barcode in self.barcodes:
+                errors.append("Duplicated barcode: %s" % r)
+            else:
+                self.barcodes[barcode] = sample_id
+            if not self.barcode_re.match(barcode):
+                errors.append("Illegal characters in barcode: %s" % r)
+        self.report.errors.extend(errors)
+        return errors
+
+    def finish(self):
+        """Complete the checks and return the report."""
+        pairs = near_barcode_pairs(
+            self.barcodes.keys(), self.max_barcode_distance)
+        for bc1, bc2, dist in pairs:
+            self.report.warnings.append(
+                "Barcodes for samples {0} ({1}) and {2} ({3}) differ at "
+                "only {4} position(s)".format(
+                    self.barcodes[bc1], bc1, self.barcodes[bc2], bc2, dist))
+        return self.report
+
+
+def near_barcode_pairs(barcodes, max_distance):
+    """Find pairs of barcodes within a Hamming distance of each other.
+
+    If two equal-length barcodes differ at no more than max_distance
+    positions, then after dividing them into max_distance + 1
+    segments, at least one segment matches exactly.  Barcodes are
+    indexed by segment, and only barcodes sharing a segment are
+    compared, instead of comparing every pair.
+
+    Returns a sorted list of (barcode1, barcode2, distance) for pairs
+    at distance 1 to max_distance.
+    """
+    if max_distance < 1:
+        return []
+    nseg = max_distance + 1
+    segment_index = collections.defaultdict(list)
+    pairs = set()
+    for bc in sorted(set(barcodes)):
+        n = len(bc)
+        bounds = [(n * k) // nseg for k in range(nseg + 1)]
+        candidates = set()
+        for k in range(nseg):
+            key = (n, k, bc[bounds[k]:bounds[k + 1]])
+            candidates.update(segment_index[key])
+            segment_index[key].append(bc)
+        for other in candidates:
+            dist = sum(1 for a, b in zip(bc, other) if a != b)
+            if 0 < dist <= max_distance:
+                pairs.add((other, bc, dist))
+    return sorted(pairs)
@@ -0,0 +1,747 @@
+"""Versioned upgrades to the registry database schema
+
+The schema version of a database is stored in SQLite's user_version
+pragma.  Each entry in MIGRATIONS upgrades the database by one
+version; a database at version N has had the first N migrations
+applied.  Databases created before versioning was introduced have
+user_version 0 but already contain the baseline tables.
+"""
+
+import os.path
+import timeit
+
+from sample_registry.util import typed_value
+
+
+def _baseline_schema():
+    this_dir = os.path.dirname(os.path.abspath(__file__))
+    base_dir = os.path.dirname(os.path.dirname(this_dir))
+    with open(os.path.join(base_dir, "schema.sql")) as f:
+        return f.read()
+
+
+# Statements to recompute the summary tables from scratch.  They are
+# run when the tables are created, and by RegistryDatabase to repair
+# the tables if needed.
+STATISTICS_REBUILD = [
+    "DELETE FROM registry_counts",
+    """\
+WITH c AS (
+  SELECT
+    COUNT(*) AS n,
+    COUNT(sample_type) AS sample_type,
+    COUNT(host_species) AS host_species,
+    COUNT(subject_id) AS subject_id,
+    COALESCE(SUM(
+      subject_id IS NOT NULL AND host_species IS NOT NULL), 0)
+      AS subject_id_and_host_species,
+    COALESCE(SUM(COALESCE(primer_sequence, '') != ''), 0) AS primer
+  FROM samples)
+INSERT INTO registry_counts (name, value)
+  SELECT 'samples', n FROM c
+  UNION ALL SELECT 'samples_with_sample_type', sample_type FROM c
+  UNION ALL SELECT 'samples_with_host_species', host_species FROM c
+  UNION ALL SELECT 'samples_with_subject_id', subject_id FROM c
+  UNION ALL SELECT 'samples_with_subject_id_and_host_species',
+    subject_id_and_host_species FROM c
+  UNION ALL SELECT 'samples_with_primer', primer FROM c""",
+    "DELETE FROM sample_value_counts",
+    """\
+INSERT INTO sample_value_counts (field, value, sample_count)
+  SELECT 'sample_type', sample_type, COUNT(*) FROM samples
+  WHERE sample_type IS NOT NULL GROUP BY sample_type
+  UNION ALL
+  SELECT 'host_species', host_species, COUNT(*) FROM samples
+  WHERE host_species IS NOT NULL GROUP BY host_species""",
+    "DELETE FROM run_sample_counts",
+    """\
+INSERT INTO run_sample_counts (run_accession, sample_count)
+  SELECT runs.run_accession, COUNT(samples.sample_accession)
+  FROM runs LEFT JOIN samples
+  ON runs.run_accession = samples.run_accession
+  GROUP BY runs.run_accession""",
+    "DELETE FROM annotation_key_counts",
+    """\
+INSERT INTO annotation_key_counts (`key`, key_count)
+  SELECT `key`, COUNT(*) FROM annotations GROUP BY `key`""",
+]
+
+
+# Columns of the samples table with a count in registry_counts: the
+# column name, the name of the count, an expression that is true if
+# the column is filled in for the row {0}, and whether the number of
+# samples with each value is kept in sample_value_counts.
+SAMPLE_COUNT_FIELDS = [
+    ("sample_type", "samples_with_sample_type",
+     "{0}.sample_type IS NOT NULL", True),
+    ("host_species", "samples_with_host_species",
+     "{0}.host_species IS NOT NULL", True),
+    ("subject_id", "samples_with_subject_id",
+     "{0}.subject_id IS NOT NULL", False),
+    ("primer_sequence", "samples_with_primer",
+     "COALESCE({0}.primer_sequence, '') != ''", False),
+]
+
+
+def _sample_count_triggers():
+    # Each trigger fires only for rows where its column is filled in
+    # or has changed, so that registering samples and annotations in
+    # bulk does as little extra work as possible.
+    add_value = (
+        "  INSERT INTO sample_value_counts (field, value, sample_count)\n"
+        "    SELECT '{0}', NEW.{0}, 1 WHERE NEW.{0} IS NOT NULL\n"
+        "    ON CONFLICT (field, value) DO UPDATE\n"
+        "    SET sample_count = sample_count + 1;\n")
+    remove_value = (
+        "  UPDATE sample_value_counts SET sample_count = sample_count - 1\n"
+        "    WHERE field = '{0}' AND value = OLD.{0};\n"
+        "  DELETE FROM sample_value_counts\n"
+        "    WHERE field = '{0}' AND value = OLD.{0} AND sample_count <= 0;\n")
+    triggers = ["""\
+CREATE TRIGGER IF NOT EXISTS samples_insert_counts
+AFTER INSERT ON samples BEGIN
+  UPDATE registry_counts SET value = value + 1 WHERE name = 'samples';
+  UPDATE run_sample_counts SET sample_count = sample_count + 1
+    WHERE run_accession = NEW.run_accession;
+END;
+CREATE TRIGGER IF NOT EXISTS samples_delete_counts
+AFTER DELETE ON samples BEGIN
+  UPDATE registry_counts SET value = value - 1 WHERE name = 'samples';
+  UPDATE run_sample_counts SET sample_count = sample_count - 1
+    WHERE run_accession = OLD.run_accession;
+END;
+CREATE TRIGGER IF NOT EXISTS samples_update_run_counts
+AFTER UPDATE OF run_accession ON samples
+WHEN OLD.run_accession IS NOT NEW.run_accession BEGIN
+  UPDATE run_sample_counts SET sample_count = sample_count - 1
+    WHERE run_accession = OLD.run_accession;
+  UPDATE run_sample_counts SET sample_count = sample_count + 1
+    WHERE run_accession = NEW.run_accession;
+END;
+"""]
+    for col, count_name, filled, keep_values in SAMPLE_COUNT_FIELDS:
+        old_filled = filled.format("OLD")
+        new_filled = filled.format("NEW")
+        triggers.append(
+            "CREATE TRIGGER IF NOT EXISTS samples_insert_{0}_counts\n"
+            "AFTER INSERT ON samples WHEN {1} BEGIN\n"
+            "  UPDATE registry_counts SET value = value + 1 "
+            "WHERE name = '{2}';\n".format(col, new_filled, count_name) +
+            (add_value.format(col) if keep_values else "") +
+            "END;\n")
+        triggers.append(
+            "CREATE TRIGGER IF NOT EXISTS samples_delete_{0}_counts\n"
+            "AFTER DELETE ON samples WHEN {1} BEGIN\n"
+            "  UPDATE registry_counts SET value = value - 1 "
+            "WHERE name = '{2}';\n".format(col, old_filled, count_name) +
+            (remove_value.format(col) if keep_values else "") +
+            "END;\n")
+        triggers.append(
+            "CREATE TRIGGER IF NOT EXISTS samples_update_{0}_counts\n"
+            "AFTER UPDATE OF {0} ON samples "
+            "WHEN OLD.{0} IS NOT NEW.{0} BEGIN\n"
+            "  UPDATE registry_counts SET value = value + ({1}) - ({2})\n"
+            "    WHERE name = '{3}' AND ({1}) != ({2});\n".format(
+                col, new_filled, old_filled, count_name) +
+            (remove_value.format(col) + add_value.format(col)
+             if keep_values else "") +
+            "END;\n")
+    both_old = "OLD.subject_id IS NOT NULL AND OLD.host_species IS NOT NULL"
+    both_new = "NEW.subject_id IS NOT NULL AND NEW.host_species IS NOT NULL"
+    name = "samples_with_subject_id_and_host_species"
+    triggers.append("""\
+CREATE TRIGGER IF NOT EXISTS samples_insert_subject_host_counts
+AFTER INSERT ON samples WHEN {0} BEGIN
+  UPDATE registry_counts SET value = value + 1 WHERE name = '{2}';
+END;
+CREATE TRIGGER IF NOT EXISTS samples_delete_subject_host_counts
+AFTER DELETE ON samples WHEN {1} BEGIN
+  UPDATE registry_counts SET value = value - 1 WHERE name = '{2}';
+END;
+CREATE TRIGGER IF NOT EXISTS samples_update_subject_host_counts
+AFTER UPDATE OF subject_id, host_species ON samples
+WHEN ({0}) != ({1}) BEGIN
+  UPDATE registry_counts SET value = value + ({0}) - ({1})
+    WHERE name = '{2}';
+END;
+""".format(both_new, both_old, name))
+    return "\n".join(triggers)
+
+
+# Rows for the full-text sample search index, one per sample.  The
+# standard SampleType and HostSpecies values are indexed along with
+# the other annotation values.
+SEARCH_INDEX_INSERT = """\
+INSERT INTO sample_search (rowid, sample_name, subject_id, annotation_values)
+  SELECT
+    samples.sample_accession, sample_name, subject_id,
+    COALESCE(sample_type, '') || ' ' || COALESCE(host_species, '') || ' ' ||
+    COALESCE((
+      SELECT group_concat(`val`, ' ') FROM annotations
+      WHERE annotations.sample_accession = samples.sample_accession), '')
+  FROM samples"""
+
+
+# Triggers to keep annotation_key_counts up to date when annotations
+# are stored as plain text, as in the baseline schema.
+ANNOTATION_COUNT_TRIGGERS = """\
+CREATE TRIGGER IF NOT EXISTS annotations_insert_counts
+AFTER INSERT ON annotations BEGIN
+  INSERT INTO annotation_key_counts (`key`, key_count)
+    SELECT NEW.`key`, 1 WHERE 1
+    ON CONFLICT (`key`) DO UPDATE SET key_count = key_count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS annotations_delete_counts
+AFTER DELETE ON annotations BEGIN
+  UPDATE annotation_key_counts SET key_count = key_count - 1
+    WHERE `key` = OLD.`key`;
+  DELETE FROM annotation_key_counts
+    WHERE `key` = OLD.`key` AND key_count <= 0;
+END;
+CREATE TRIGGER IF NOT EXISTS annotations_update_counts
+AFTER UPDATE OF `key` ON annotations BEGIN
+  UPDATE annotation_key_counts SET key_count = key_count - 1
+    WHERE `key` = OLD.`key`;
+  DELETE FROM annotation_key_counts
+    WHERE `key` = OLD.`key` AND key_count <= 0;
+  INSERT INTO annotation_key_counts (`key`, key_count)
+    SELECT NEW.`key`, 1 WHERE 1
+    ON CONFLICT (`key`) DO UPDATE SET key_count = key_count + 1;
+END;
+"""
+
+
+MIGRATIONS = [
+    # Version 1: baseline tables and views, read from schema.sql
+    None,
+    # Version 2: indexes for sample lookups, annotations, and run files
+    """\
+CREATE INDEX IF NOT EXISTS samples_run_name_barcode
+  ON samples (run_accession, sample_name, barcode_sequence);
+CREATE INDEX IF NOT EXISTS annotations_sample_accession
+  ON annotations (sample_accession);
+CREATE INDEX IF NOT EXISTS annotations_key_val
+  ON annotations (`key`, `val`);
+CREATE INDEX IF NOT EXISTS runs_data_uri
+  ON runs (data_uri);
+""",
+    # Version 3: read statistics for each lane and read of a run
+    """\
+CREATE TABLE IF NOT EXISTS run_read_stats (
+  run_accession INTEGER NOT NULL
+    REFERENCES runs(run_accession)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+  lane INTEGER NOT NULL,
+  read_number INTEGER NOT NULL,
+  read_count INTEGER NOT NULL,
+  base_count INTEGER NOT NULL,
+  mean_quality REAL DEFAULT NULL,
+  PRIMARY KEY (run_accession, lane, read_number)
+);
+CREATE TABLE IF NOT EXISTS run_read_lengths (
+  run_accession INTEGER NOT NULL
+    REFERENCES runs(run_accession)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+  lane INTEGER NOT NULL,
+  read_number INTEGER NOT NULL,
+  read_length INTEGER NOT NULL,
+  read_count INTEGER NOT NULL,
+  PRIMARY KEY (run_accession, lane, read_number, read_length)
+);
+""",
+    # Version 4: content fingerprint of the data file for each run
+    """\
+ALTER TABLE runs ADD COLUMN data_fingerprint TEXT DEFAULT NULL;
+CREATE INDEX IF NOT EXISTS runs_data_fingerprint
+  ON runs (data_fingerprint);
+""",
+    # Version 5: results of checking that run data files are available
+    """\
+CREATE TABLE IF NOT EXISTS run_file_audits (
+  run_accession INTEGER PRIMARY KEY
+    REFERENCES runs(run_accession)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+  file_path TEXT NOT NULL,
+  file_size INTEGER DEFAULT NULL,
+  status TEXT NOT NULL,
+  checked_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS run_file_audits_checked_at
+  ON run_file_audits (checked_at);
+""",
+    # Version 6: summary tables for the statistics and run list pages,
+    # kept up to date by triggers
+    """\
+CREATE TABLE IF NOT EXISTS registry_counts (
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sample_value_counts (
+  field TEXT NOT NULL,
+  value TEXT NOT NULL,
+  sample_count INTEGER NOT NULL,
+  PRIMARY KEY (field, value)
+);
+CREATE TABLE IF NOT EXISTS run_sample_counts (
+  run_accession INTEGER PRIMARY KEY,
+  sample_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS annotation_key_counts (
+  `key` TEXT PRIMARY KEY,
+  key_count INTEGER NOT NULL
+);
+
+CREATE TRIGGER IF NOT EXISTS runs_insert_counts
+AFTER INSERT ON runs BEGIN
+  INSERT OR IGNORE INTO run_sample_counts (run_accession, sample_count)
+    VALUES (NEW.run_accession, 0);
+END;
+CREATE TRIGGER IF NOT EXISTS runs_delete_counts
+AFTER DELETE ON runs BEGIN
+  DELETE FROM run_sample_counts WHERE run_accession = OLD.run_accession;
+END;
+
+""" + _sample_count_triggers() + """\
+""" + ANNOTATION_COUNT_TRIGGERS + """
+DROP VIEW IF EXISTS runs_samplecounts;
+CREATE VIEW runs_samplecounts AS
+  SELECT
+    `runs`.`run_accession` AS `run_accession`,
+    `runs`.`run_date` AS `run_date`,
+    `runs`.`machine_type` AS `machine_type`,
+    `runs`.`machine_kit` AS `machine_kit`,
+    `runs`.`lane` AS `lane`,
+    `runs`.`data_uri` AS `data_uri`,
+    `runs`.`comment` AS `comment`,
+    COALESCE(`run_sample_counts`.`sample_count`, 0) AS `sample_count`
+  FROM (
+    `runs` LEFT OUTER JOIN `run_sample_counts` ON (
+      `runs`.`run_accession` = `run_sample_counts`.`run_accession`))
+  ORDER BY
+      `runs`.`run_date` DESC,
+      `runs`.`machine_type`,
+      `runs`.`machine_kit`,
+      `runs`.`lane`;
+
+DROP VIEW IF EXISTS annotation_keys;
+CREATE VIEW annotation_keys AS
+  SELECT
+    `annotation_key_counts`.`key` AS `key`,
+    `annotation_key_counts`.`key_count` AS `key_counts`
+  FROM `annotation_key_counts`;
+""" + ";\n".join(STATISTICS_REBUILD) + ";\n",
+    # Version 7: full-text search index over sample names, subject IDs,
+    # and annotation values, with prefix indexes for short queries.
+    # Punctuation separates words, so a sample named PCMP_Stool.12 is
+    # found by searching for stool, or for the phrase pcmp_sto.
+    """\
+CREATE VIRTUAL TABLE IF NOT EXISTS sample_search USING fts5(
+  sample_name, subject_id, annotation_values,
+  prefix = '2 3'
+);
+""" + SEARCH_INDEX_INSERT + ";\n",
+    # Version 8: numeric and date values of annotations, for range
+    # queries.  Each index covers the sample accession, so a range
+    # query is answered from the index alone.  The values are inferred
+    # by the typed_number and typed_date SQL functions.
+    """\
+CREATE TABLE IF NOT EXISTS typed_annotations (
+  sample_accession INTEGER NOT NULL
+    REFERENCES samples(sample_accession)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+  `key` TEXT NOT NULL,
+  num_val REAL DEFAULT NULL,
+  date_val TEXT DEFAULT NULL
+);
+CREATE INDEX IF NOT EXISTS typed_annotations_sample_accession
+  ON typed_annotations (sample_accession);
+CREATE INDEX IF NOT EXISTS typed_annotations_key_num
+  ON typed_annotations (`key`, num_val, sample_accession)
+  WHERE num_val IS NOT NULL;
+CREATE INDEX IF NOT EXISTS typed_annotations_key_date
+  ON typed_annotations (`key`, date_val, sample_accession)
+  WHERE date_val IS NOT NULL;
+INSERT INTO typed_annotations (sample_accession, `key`, num_val, date_val)
+  SELECT sample_accession, `key`, num_val, date_val FROM (
+    SELECT
+      sample_accession, `key`,
+      typed_number(`val`) AS num_val, typed_date(`val`) AS date_val
+    FROM annotations)
+  WHERE num_val IS NOT NULL OR date_val IS NOT NULL;
+""",
+    # Version 9: indexes for samples by standard annotation value
+    """\
+CREATE INDEX IF NOT EXISTS samples_sample_type
+  ON samples (sample_type);
+CREATE INDEX IF NOT EXISTS samples_subject_id
+  ON samples (subject_id);
+CREATE INDEX IF NOT EXISTS samples_host_species
+  ON samples (host_species);
+""",
+    # Version 10: samples of a run in the order they are exported, so
+    # the export reads them without sorting
+    """\
+CREATE INDEX IF NOT EXISTS samples_run_name_accession
+  ON samples (run_accession, sample_name, sample_accession);
+""",
+]
+
+
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def _migration_script(version):
+    script = MIGRATIONS[version - 1]
+    if script is None:
+        return _baseline_schema()
+    return script
+
+
+def schema_version(con):
+    """Return the schema version of a database connection."""
+    return con.execute("PRAGMA user_version").fetchone()[0]
+
+
+def _typed_number(val):
+    typed = typed_value(val) if val is not None else None
+    return typed[0] if typed else None
+
+
+def _typed_date(val):
+    typed = typed_value(val) if val is not None else None
+    return typed[1] if typed else None
+
+
+def _create_functions(con):
+    """Add the SQL functions used by the migrations to a connection."""
+    con.create_function("typed_number", 1, _typed_number, deterministic=True)
+    con.create_function("typed_date", 1, _typed_date, deterministic=True)
+
+
+def _has_baseline_tables(con):
+    res = con.execute(
+        "SELECT COUNT(*) FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'runs'").fetchone()
+    return res[0] > 0
+
+
+def _execute_in_transaction(con, script):
+    """Run a script in a transaction, rolling it back if it fails."""
+    try:
+        con.executescript("BEGIN;\n{0}\nCOMMIT;".format(script))
+    except BaseException:
+        if con.in_transaction:
+            con.rollback()
+        raise
+
+
+def migrate(con, target=LATEST_VERSION):
+    """Upgrade a database to the target schema version.
+
+    Each migration is applied in its own transaction, together with
+    the update to user_version, so an interrupted upgrade leaves the
+    database at a well-defined version.
+
+    Returns a list of the versions applied.
+    """
+    if target > LATEST_VERSION:
+        raise ValueError("Unknown schema version: {0}".format(target))
+    current = schema_version(con)
+    if current == 0 and _has_baseline_tables(con):
+        # Unversioned database created from the baseline schema
+        con.execute("PRAGMA user_version = 1")
+        current = 1
+    _create_functions(con)
+    applied = []
+    for version in range(current + 1, target + 1):
+        script = _migration_script(version)
+        _execute_in_transaction(
+            con, "{0}\nPRAGMA user_version = {1};".format(script, version))
+        applied.append(version)
+    return applied
+
+
+# Optional dictionary-encoded layout for annotations.  Keys, and the
+# values of keys whose values repeat, are stored once in lookup tables
+# and referred to by integer id.  A view named annotations decodes the
+# rows, so code that reads the baseline annotations table still works.
+# Unlike the versioned migrations, the layout can be switched either
+# way at any time.  Migrations that change the annotations table must
+# handle both layouts.
+
+ENCODED_ANNOTATIONS_VIEWS = """\
+CREATE VIEW annotations AS
+  SELECT
+    annotation_values.rowid AS rowid,
+    annotation_values.sample_accession AS sample_accession,
+    annotation_key_ids.`key` AS `key`,
+    COALESCE(annotation_val_ids.`val`, annotation_values.`val`) AS `val`
+  FROM annotation_values
+  JOIN annotation_key_ids
+    ON annotation_key_ids.key_id = annotation_values.key_id
+  LEFT JOIN annotation_val_ids
+    ON annotation_val_ids.val_id = annotation_values.val_id;
+
+CREATE VIEW annotation_vals_by_run AS
+  SELECT
+    counts.run_accession AS run_accession,
+    runs.run_date AS run_date,
+    runs.comment AS run_comment,
+    counts.`key` AS `key`,
+    COALESCE(annotation_val_ids.`val`, counts.`val`) AS `val`,
+    counts.sample_count AS sample_count
+  FROM (
+    SELECT
+      samples.run_accession AS run_accession,
+      annotation_key_ids.`key` AS `key`,
+      annotation_values.val_id AS val_id,
+      annotation_values.`val` AS `val`,
+      COUNT(annotation_values.sample_accession) AS sample_count
+    FROM annotation_values
+    JOIN annotation_key_ids
+      ON annotation_key_ids.key_id = annotation_values.key_id
+    JOIN samples
+      ON samples.sample_accession = annotation_values.sample_accession
+    GROUP BY samples.run_accession, annotation_key_ids.`key`,
+      annotation_values.val_id, annotation_values.`val`) AS counts
+  JOIN runs ON runs.run_accession = counts.run_accession
+  LEFT JOIN annotation_val_ids ON annotation_val_ids.val_id = counts.val_id
+  ORDER BY
+    counts.`key`,
+    runs.run_date DESC,
+    counts.run_accession,
+    counts.sample_count DESC,
+    COALESCE(annotation_val_ids.`val`, counts.`val`);
+
+CREATE TRIGGER annotations_insert INSTEAD OF INSERT ON annotations BEGIN
+  INSERT OR IGNORE INTO annotation_key_ids (`key`) VALUES (NEW.`key`);
+  INSERT OR IGNORE INTO annotation_val_ids (`val`)
+    SELECT NEW.`val` FROM annotation_key_ids
+    WHERE `key` = NEW.`key` AND intern_values;
+  INSERT INTO annotation_values (sample_accession, key_id, val_id, `val`)
+    SELECT
+      NEW.sample_accession, annotation_key_ids.key_id,
+      annotation_val_ids.val_id,
+      CASE WHEN annotation_val_ids.val_id IS NULL THEN NEW.`val` END
+    FROM annotation_key_ids
+    LEFT JOIN annotation_val_ids
+      ON annotation_key_ids.intern_values
+      AND annotation_val_ids.`val` = NEW.`val`
+    WHERE annotation_key_ids.`key` = NEW.`key`;
+END;
+
+CREATE TRIGGER annotations_delete INSTEAD OF DELETE ON annotations BEGIN
+  DELETE FROM annotation_values WHERE rowid = OLD.rowid;
+END;
+
+CREATE TRIGGER annotation_values_insert_counts
+AFTER INSERT ON annotation_values BEGIN
+  INSERT INTO annotation_key_counts (`key`, key_count)
+    SELECT `key`, 1 FROM annotation_key_ids WHERE key_id = NEW.key_id
+    ON CONFLICT (`key`) DO UPDATE SET key_count = key_count + 1;
+END;
+
+CREATE TRIGGER annotation_values_delete_counts
+AFTER DELETE ON annotation_values BEGIN
+  UPDATE annotation_key_counts SET key_count = key_count - 1
+    WHERE `key` = (
+      SELECT `key` FROM annotation_key_ids WHERE key_id = OLD.key_id);
+  DELETE FROM annotation_key_counts WHERE key_count <= 0 AND `key` = (
+    SELECT `key` FROM annotation_key_ids WHERE key_id = OLD.key_id);
+END;
+"""
+
+ENCODE_ANNOTATIONS = """\
+CREATE TABLE annotation_key_ids (
+  key_id INTEGER PRIMARY KEY,
+  `key` TEXT NOT NULL UNIQUE,
+  intern_values INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE annotation_val_ids (
+  val_id INTEGER PRIMARY KEY,
+  `val` TEXT NOT NULL UNIQUE
+);
+CREATE TABLE annotation_values (
+  sample_accession INTEGER
+    REFERENCES samples(sample_accession)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+  key_id INTEGER NOT NULL REFERENCES annotation_key_ids(key_id),
+  val_id INTEGER DEFAULT NULL REFERENCES annotation_val_ids(val_id),
+  `val` TEXT DEFAULT NULL
+);
+
+-- Values are interned for keys where each value is used at least
+-- twice, on average
+INSERT INTO annotation_key_ids (`key`, intern_values)
+  SELECT `key`, COUNT(DISTINCT `val`) * 2 <= COUNT(*) FROM annotations
+  GROUP BY `key` ORDER BY MIN(rowid);
+INSERT INTO annotation_val_ids (`val`)
+  SELECT DISTINCT annotations.`val` FROM annotations
+  JOIN annotation_key_ids ON annotation_key_ids.`key` = annotations.`key`
+  WHERE annotation_key_ids.intern_values;
+INSERT INTO annotation_values (rowid, sample_accession, key_id, val_id, `val`)
+  SELECT
+    annotations.rowid, annotations.sample_accession,
+    annotation_key_ids.key_id, annotation_val_ids.val_id,
+    CASE WHEN annotation_val_ids.val_id IS NULL THEN annotations.`val` END
+  FROM annotations
+  JOIN annotation_key_ids ON annotation_key_ids.`key` = annotations.`key`
+  LEFT JOIN annotation_val_ids
+    ON annotation_key_ids.intern_values
+    AND annotation_val_ids.`val` = annotations.`val`
+  ORDER BY annotations.rowid;
+
+DROP VIEW annotation_vals_by_run;
+DROP TABLE annotations;
+CREATE INDEX annotation_values_sample_accession
+  ON annotation_values (sample_accession);
+CREATE INDEX annotation_values_key_val
+  ON annotation_values (key_id, val_id, `val`);
+""" + ENCODED_ANNOTATIONS_VIEWS
+
+PLAIN_ANNOTATIONS_VIEWS = """\
+CREATE VIEW annotation_vals_by_run AS
+  SELECT
+    `samples`.`run_accession` AS `run_accession`,
+    `runs`.`run_date` AS `run_date`,
+    `runs`.`comment` AS `run_comment`,
+    `annotations`.`key` AS `key`,
+    `annotations`.`val` AS `val`,
+    COUNT(`annotations`.`sample_accession`) AS `sample_count`
+  FROM ((`annotations` JOIN `samples` ON (
+    `annotations`.`sample_accession` = `samples`.`sample_accession`))
+    JOIN `runs` ON (
+      `samples`.`run_accession` = `runs`.`run_accession`))
+  GROUP BY
+    `samples`.`run_accession`,
+    `annotations`.`key`,
+    `annotations`.`val`
+  ORDER BY
+    `annotations`.`key`,
+    `runs`.`run_date` DESC,
+    `samples`.`run_accession`,
+    COUNT(`annotations`.`sample_accession`) DESC,
+    `annotations`.`val`;
+"""
+
+DECODE_ANNOTATIONS = """\
+CREATE TABLE plain_annotations (
+  `sample_accession` INTEGER
+    REFERENCES samples(sample_accession)
+    ON UPDATE CASCADE
+    ON DELETE CASCADE,
+  `key` TEXT NOT NULL,
+  `val` TEXT NOT NULL
+);
+INSERT INTO plain_annotations (rowid, sample_accession, `key`, `val`)
+  SELECT rowid, sample_accession, `key`, `val` FROM annotations
+  ORDER BY rowid;
+DROP VIEW annotation_vals_by_run;
+DROP VIEW annotations;
+DROP TABLE annotation_values;
+DROP TABLE annotation_val_ids;
+DROP TABLE annotation_key_ids;
+ALTER TABLE plain_annotations RENAME TO annotations;
+CREATE INDEX annotations_sample_accession
+  ON annotations (sample_accession);
+CREATE INDEX annotations_key_val
+  ON annotations (`key`, `val`);
+""" + ANNOTATION_COUNT_TRIGGERS + PLAIN_ANNOTATIONS_VIEWS
+
+
+def annotations_encoded(con):
+    """Return True if annotations are stored in the encoded layout."""
+    res = con.execute(
+        "SELECT COUNT(*) FROM sqlite_master "
+        "WHERE type = 'table' AND name = 'annotation_values'").fetchone()
+    return res[0] > 0
+
+
+def encode_annotations(con):
+    """Switch to the dictionary-encoded layout for annotations.
+
+    Returns False if the annotations were already encoded.
+    """
+    if annotations_encoded(con):
+        return False
+    if schema_version(con) < LATEST_VERSION:
+        raise ValueError(
+            "Upgrade the database to the latest schema version before "
+            "encoding annotations")
+    _execute_in_transaction(con, ENCODE_ANNOTATIONS)
+    return True
+
+
+def decode_annotations(con):
+    """Switch back to storing annotations as plain text.
+
+    Returns False if the annotations were not encoded.
+    """
+    if not annotations_encoded(con):
+        return False
+    _execute_in_transaction(con, DECODE_ANNOTATIONS)
+    return True
+
+
+# Queries issued for every sample or page view, used to measure the
+# effect of a migration.  Parameters are filled in from an existing
+# sample in the database.
+HOT_QUERIES = [
+    ("Sample by name and barcode",
+     "SELECT sample_accession FROM samples WHERE run_accession = "
+     ":run_accession AND sample_name = :sample_name AND "
+     "barcode_sequence = :barcode_sequence"),
+    ("Annotations for sample",
+     "SELECT `key`, `val` FROM annotations "
+     "WHERE sample_accession = :sample_accession"),
+    ("Samples by annotation value",
+     "SELECT sample_accession FROM annotations "
+     "WHERE `key` = :key AND `val` = :val"),
+    ("Run by data file",
+     "SELECT run_accession FROM runs WHERE data_uri = :data_uri"),
+]
+
+
+def _hot_query_params(con):
+    row = con.execute(
+        "SELECT samples.run_accession, sample_name, barcode_sequence, "
+        "samples.sample_accession, data_uri "
+        "FROM samples JOIN runs "
+        "ON samples.run_accession = runs.run_accession "
+        "ORDER BY samples.sample_accession DESC LIMIT 1").fetchone()
+    if row is None:
+        return None
+    keys = (
+        "run_accession", "sample_name", "barcode_sequence",
+        "sample_accession", "data_uri")
+    params = dict(zip(keys, row))
+    ann = con.execute(
+        "SELECT `key`, `val` FROM annotations "
+        "ORDER BY rowid DESC LIMIT 1").fetchone()
+    params["key"], params["val"] = ann if ann else ("", "")
+    return params
+
+
+def time_hot_queries(con, number=10):
+    """Time each of the HOT_QUERIES against a database.
+
+    Returns a list of (description, milliseconds per query), or None
+    if the database has no samples to query.
+    """
+    if schema_version(con) == 0 and not _has_baseline_tables(con):
+        return None
+    params = _hot_query_params(con)
+    if params is None:
+        return None
+    timings = []
+    for desc, sql in HOT_QUERIES:
+        def run_query():
+            con.execute(sql, params).fetchall()
+        secs = timeit.timeit(run_query, number=number)
+        timings.append((desc, 1000.0 * secs / number))
+    return timings
@@ -0,0 +1,363 @@
+"""Find samples by their annotations, across all runs
+
+A query is built from predicates on single annotations, combined with
+All and Any.  The standard annotations, SampleType, SubjectID, and
+HostSpecies, are matched against columns of the samples table, and
+other annotations against the annotations table, in either layout.
+
+Each predicate is answered from an index as a posting list: the
+sorted accession numbers of the samples that match.  For a
+conjunction, only the smallest posting list is read in full.  The
+other predicates check just the samples on that list, looking them up
+by accession, from the most to the least selective.
+"""
+
+import argparse
+import re
+import sys
+
+from sample_registry import migrations
+from sample_registry.db import (
+    SQLITE_MAX_VARIABLE_NUMBER, _chunks, typed_range,
+    )
+from sample_registry.export import (
+    format_sample_accession, format_run_accession,
+    )
+from sample_registry.register import REGISTRY_DATABASE
+
+
+# Standard annotations, by key and by column name
+STANDARD_COLUMNS = {
+    "SampleType": "sample_type",
+    "SubjectID": "subject_id",
+    "HostSpecies": "host_species",
+    "sample_type": "sample_type",
+    "subject_id": "subject_id",
+    "host_species": "host_species",
+}
+
+# Posting lists are counted up to this many samples to decide the
+# order in which predicates are checked.
+ESTIMATE_LIMIT = 10000
+
+
+class _Predicate(object):
+    """A condition on a single annotation, answered from an index.
+
+    Subclasses provide _sql, which returns SQL selecting the accession
+    numbers of matching samples, and its parameters, or None if no
+    sample can match.  For the check form, the SQL starts with a
+    placeholder for a list of accession numbers to check.  Columns in
+    the other conditions are prefixed with a unary plus in that form,
+    so that SQLite looks up the samples by accession rather than
+    reading the whole posting list.
+    """
+    def _sql(self, query, check=False):
+        raise NotImplementedError()
+
+    def _estimate(self, query):
+        sql = self._sql(query)
+        if sql is None:
+            return 0
+        sql, params = sql
+        return query.fetch_value(
+            "SELECT COUNT(*) FROM ({0} LIMIT {1})".format(
+                sql, ESTIMATE_LIMIT), params)
+
+    def _postings(self, query):
+        sql = self._sql(query)
+        if sql is None:
+            return []
+        sql, params = sql
+        return sorted(set(query.fetch_column(sql, params)))
+
+    def _check(self, query, sample_accessions):
+        sql = self._sql(query, check=True)
+        if sql is None:
+            return []
+        sql, params = sql
+        # The other parameters share the limit with the accessions
+        chunk_size = SQLITE_MAX_VARIABLE_NUMBER - len(params)
+        matches = set()
+        for chunk in _chunks(sample_accessions, chunk_size):
+            placeholders = ", ".join("?" for _ in chunk)
+            matches.update(query.fetch_column(
+                sql.format(placeholders), list(chunk) + params))
+        return sorted(matches)
+
+
+class Equals(_Predicate):
+    """Samples where an annotation has a given value."""
+    def __init__(self, key, val):
+        self.key = key
+        self.val = val
+
+    def __repr__(self):
+        return "Equals({0!r}, {1!r})".format(self.key, self.val)
+
+    def _sql(self, query, check=False):
+        col = STANDARD_COLUMNS.get(self.key)
+        if col is not None:
+            if check:
+                sql = (
+                    "SELECT sample_accession FROM samples "
+                    "WHERE sample_accession IN ({{0}}) AND +{0} = ?")
+            else:
+                sql = "SELECT sample_accession FROM samples WHERE {0} = ?"
+            return sql.format(col), [self.val]
+        if query.annotations_encoded:
+            return self._encoded_sql(query, check)
+        if check:
+            sql = (
+                "SELECT sample_accession FROM annotations "
+                "WHERE sample_accession IN ({0}) "
+                "AND +`key` = ? AND +`val` = ?")
+        else:
+            sql = (
+                "SELECT sample_accession FROM annotations "
+                "WHERE `key` = ? AND `val` = ?")
+        return sql, [self.key, self.val]
+
+    def _encoded_sql(self, query, check):
+        # Look up the ids here, so the index on annotation_values is
+        # used directly
+        key = query.fetch_row(
+            "SELECT key_id, intern_values FROM annotation_key_ids "
+            "WHERE `key` = ?", [self.key])
+        if key is None:
+            return None
+        key_id, intern_values = key
+        if intern_values:
+            val_id = query.fetch_value(
+                "SELECT val_id FROM annotation_val_ids WHERE `val` = ?",
+                [self.val])
+            if val_id is None:
+                return None
+            params = [key_id, val_id, None]
+        else:
+            params = [key_id, None, self.val]
+        if check:
+            sql = (
+                "SELECT sample_accession FROM annotation_values "
+                "WHERE sample_accession IN ({0}) "
+                "AND +key_id = ? AND +val_id IS ? AND +`val` IS ?")
+        else:
+            sql = (
+                "SELECT sample_accession FROM annotation_values "
+                "WHERE key_id = ? AND val_id IS ? AND `val` IS ?")
+        return sql, params
+
+
+class Between(_Predicate):
+    """Samples where an annotation is a number or date in a range.
+
+    Both bounds are included; a bound of None leaves that end open.
+    """
+    def __init__(self, key, low=None, high=None):
+        self.key = key
+        self.col, self.low, self.high = typed_range(low, high)
+
+    def __repr__(self):
+        return "Between({0!r}, {1!r}, {2!r})".format(
+            self.key, self.low, self.high)
+
+    def _sql(self, query, check=False):
+        prefix = "+" if check else ""
+        col = prefix + self.col
+        conditions = ["{0}`key` = ?".format(prefix)]
+        params = [self.key]
+        if self.low is not None:
+            conditions.append("{0} >= ?".format(col))
+            params.append(self.low)
+        if self.high is not None:
+            conditions.append("{0} <= ?".format(col))
+            params.append(self.high)
+        conditions.append("{0} IS NOT NULL".format(col))
+        if check:
+            conditions.insert(0, "sample_accession IN ({0})")
+        sql = "SELECT sample_accession FROM typed_annotations WHERE "
+        return sql + " AND ".join(conditions), params
+
+
+class All(object):
+    """Samples matching every one of several predicates."""
+    def __init__(self, *predicates):
+        if not predicates:
+            raise ValueError("No predicates to combine")
+        self.predicates = predicates
+
+    def __repr__(self):
+        return "All({0})".format(", ".join(map(repr, self.predicates)))
+
+    def _by_estimate(self, query):
+        return sorted(self.predicates, key=lambda p: p._estimate(query))
+
+    def _estimate(self, query):
+        return min(p._estimate(query) for p in self.predicates)
+
+    def _postings(self, query):
+        predicates = self._by_estimate(query)
+        sample_accessions = predicates[0]._postings(query)
+        return self._check_each(query, predicates[1:], sample_accessions)
+
+    def _check(self, query, sample_accessions):
+        predicates = self._by_estimate(query)
+        return self._check_each(query, predicates, sample_accessions)
+
+    @staticmethod
+    def _check_each(query, predicates, sample_accessions):
+        for p in predicates:
+            if not sample_accessions:
+                break
+            sample_accessions = p._check(query, sample_accessions)
+        return sample_accessions
+
+
+class Any(object):
+    """Samples matching at least one of several predicates."""
+    def __init__(self, *predicates):
+        if not predicates:
+            raise ValueError("No predicates to combine")
+        self.predicates = predicates
+
+    def __repr__(self):
+        return "Any({0})".format(", ".join(map(repr, self.predicates)))
+
+    def _estimate(self, query):
+        return min(
+            sum(p._estimate(query) for p in self.predicates),
+            ESTIMATE_LIMIT)
+
+    def _postings(self, query):
+        matches = set()
+        for p in self.predicates:
+            matches.update(p._postings(query))
+        return sorted(matches)
+
+    def _check(self, query, sample_accessions):
+        # Samples that already match are not checked again
+        matches = set()
+        for p in self.predicates:
+            remaining = [a for a in sample_accessions if a not in matches]
+            if not remaining:
+                break
+            matches.update(p._check(query, remaining))
+        return sorted(matches)
+
+
+class SampleQuery(object):
+    """Run predicates against the registry database."""
+    select_samples = (
+        "SELECT samples.sample_accession, sample_name, barcode_sequence, "
+        "primer_sequence, sample_type, subject_id, host_species, "
+        "runs.run_accession, run_date, machine_type, machine_kit, lane, "
+        "data_uri, runs.comment AS run_comment "
+        "FROM samples "
+        "JOIN runs ON runs.run_accession = samples.run_accession "
+        "WHERE samples.sample_accession IN ({0}) "
+        "ORDER BY samples.sample_accession"
+        )
+
+    def __init__(self, db):
+        self.db = db
+        self.annotations_encoded = migrations.annotations_encoded(db.con)
+
+    def fetch_row(self, sql, params):
+        cur = self.db.con.cursor()
+        cur.execute(sql, params)
+        res = cur.fetchone()
+        cur.close()
+        return res
+
+    def fetch_value(self, sql, params):
+        res = self.fetch_row(sql, params)
+        if res is not None:
+            return res[0]
+        else:
+            return None
+
+    def fetch_column(self, sql, params):
+        cur = self.db.con.cursor()
+        cur.execute(sql, params)
+        res = [r[0] for r in cur.fetchall()]
+        cur.close()
+        return res
+
+    def sample_accessions(self, predicate):
+        """Return the sorted accession numbers of matching samples."""
+        return predicate._postings(self)
+
+    def iter_samples(self, predicate):
+        """Generate a dict of sample and run info for each match.
+
+        Samples are read from the database in chunks, ordered by
+        accession number.
+        """
+        sample_accessions = self.sample_accessions(predicate)
+        cur = self.db.con.cursor()
+        try:
+            chunks = _chunks(sample_accessions, SQLITE_MAX_VARIABLE_NUMBER)
+            for chunk in chunks:
+                placeholders = ", ".join("?" for _ in chunk)
+                cur.execute(self.select_samples.format(placeholders), chunk)
+                keys = [d[0] for d in cur.description]
+                for row in cur.fetchall():
+                    yield dict(zip(keys, row))
+        finally:
+            cur.close()
+
+
+PREDICATE_RE = re.compile(r"^(.+?)(<=|>=|=)(.*)$")
+
+
+def parse_predicate(text):
+    """Parse a predicate written as KEY=VALUE, KEY>=VALUE, or KEY<=VALUE.
+    """
+    match = PREDICATE_RE.match(text)
+    if match is None:
+        raise ValueError("Not a predicate: {0}".format(text))
+    key, op, val = match.groups()
+    if op == ">=":
+        return Between(key, low=val)
+    if op == "<=":
+        return Between(key, high=val)
+    return Equals(key, val)
+
+
+def query_samples(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Find samples by their annotations, across all runs"))
+    p.add_argument(
+        "predicates", nargs="+", metavar="PREDICATE", help=(
+            "Annotation to match, as KEY=VALUE, or KEY>=VALUE or "
+            "KEY<=VALUE for numbers and dates.  Dates are written year "
+            "first, as YYYY-MM-DD; annotation values written as "
+            "MM/DD/YYYY or DD/MM/YYYY are not compared as dates."))
+    p.add_argument(
+        "--any", action="store_true",
+        help="Find samples matching any predicate (default: all)")
+    args = p.parse_args(argv)
+
+    try:
+        predicates = [parse_predicate(x) for x in args.predicates]
+    except ValueError as e:
+        p.error(str(e))
+    if args.any:
+        predicate = Any(*predicates)
+    else:
+        predicate = All(*predicates)
+
+    header = [
+        "SampleID", "sample_accession", "run_accession", "run_date",
+        "lane", "data_uri"]
+    out.write(u"\t".join(header) + u"\n")
+    for sample in SampleQuery(db).iter_samples(predicate):
+        vals = [
+            sample["sample_name"],
+            format_sample_accession(sample["sample_accession"]),
+            format_run_accession(sample["run_accession"]),
+            sample["run_date"],
+            str(sample["lane"]),
+            sample["data_uri"],
+            ]
+        out.write(u"\t".join(vals) + u"\n")
@@ -1,15 +1,26 @@
 """Add samples and runs to the registry"""
 
 import argparse
+import collections
+import datetime
 import itertools
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
 import sys
 import gzip
 
+from sample_registry import migrations
+from sample_registry.barcodes import index_kits
 from sample_registry.db import RegistryDatabase
 from sample_registry.mapping import SampleTable
-from sample_registry.illumina import IlluminaFastq
+from sample_registry.util import (
+    file_fingerprint, fingerprint_size, local_filepath,
+)
+from sample_registry.illumina import (
+    IlluminaFastq, read_fastq_info, read_fastq_stats, merge_read_stats,
+)
 
 
 REGISTRY_DATABASE = RegistryDatabase("/var/local/sample_registry/core.db")
@@ -38,6 +49,13 @@ character is ignored.  Other lines beginning with '#' are interpreted
 as comments.
 """
 
+INDEX_KIT_HELP = """\
+Additional index kit, used to look up barcode sequences from the
+barcode_index_fwd and barcode_index_rev fields.  Each line of the file
+holds an index name and a barcode sequence.  May be given more than
+once.
+"""
+
 
 def unregister_samples(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
     p = argparse.ArgumentParser(
@@ -75,17 +93,29 @@ def register_sample_annotations(
     p.add_argument(
         "sample_table", type=argparse.FileType('r'),
         help=SAMPLE_TABLE_HELP)
+    p.add_argument(
+        "--index-kit", type=argparse.FileType('r'), action="append",
+        default=[], help=INDEX_KIT_HELP)
     args = p.parse_args(argv)
 
-    sample_table = SampleTable.load(args.sample_table)
-    sample_table.look_up_nextera_barcodes()
-    sample_table.validate()
+    kits = index_kits().copy()
+    for f in args.index_kit:
+        kits.load_kit(f)
+
+    sample_table = SampleTable.load(args.sample_table, compact=True)
+    sample_table.look_up_nextera_barcodes(kits)
+    report = sample_table.check()
+    for warning in report.warnings:
+        out.write("Warning: {0}\n".format(warning))
+    report.raise_for_errors()
 
     registry = SampleRegistry(db)
     registry.check_run_accession(args.run_accession)
-    if register_samples:
-        registry.register_samples(args.run_accession, sample_table)
-    registry.register_annotations(args.run_accession, sample_table)
+    with db.transaction():
+        if register_samples:
+            registry.register_samples(
+                args.run_accession, sample_table, reindex=False)
+        registry.register_annotations(args.run_accession, sample_table)
 
 def parse_tsv_ncol(f, ncol):
     assert(ncol > 0)
@@ -112,8 +142,9 @@ def register_sample_types(
     args = p.parse_args(argv)
 
     sample_types = list(parse_tsv_ncol(args.file, 3))
-    db.remove_standard_sample_types()
-    db.register_standard_sample_types(sample_types)
+    with db.transaction():
+        db.remove_standard_sample_types()
+        db.register_standard_sample_types(sample_types)
 
 
 def register_host_species(
@@ -124,8 +155,9 @@ def register_host_species(
     args = p.parse_args(argv)
 
     host_species = list(parse_tsv_ncol(args.file, 3))
-    db.remove_standard_host_species()
-    db.register_standard_host_species(host_species)
+    with db.transaction():
+        db.remove_standard_host_species()
+        db.register_standard_host_species(host_species)
 
 
 def register_illumina_file(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
@@ -133,14 +165,160 @@ def register_illumina_file(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
         "Add a new run to the registry from a gzipped Illumina FASTQ file"))
     p.add_argument("file")
     p.add_argument("comment", help="Comment (free text)")
+    p.add_argument(
+        "--stats", action="store_true",
+        help="Compute read statistics for the run")
+    p.add_argument(
+        "--stats-file", action="append", default=[],
+        help=(
+            "Additional FASTQ file to include in the read statistics, "
+            "e.g. the file for the second read (can be repeated)"))
+    p.add_argument(
+        "--processes", type=int, default=4,
+        help="Number of files to read in parallel (default: %(default)s)")
     args = p.parse_args(argv)
 
     f = IlluminaFastq(gzip.open(args.file, "rt"))
-    acc = db.register_run(
-        f.date, f.machine_type, "Nextera XT", f.lane, f.filepath, args.comment)
+    fingerprint = file_fingerprint(args.file)
+    stats = None
+    if args.stats or args.stats_file:
+        stats = compute_read_stats(
+            [args.file] + args.stats_file, args.processes)
+    with db.transaction():
+        acc = db.register_run(
+            f.date, f.machine_type, "Nextera XT", f.lane, f.filepath,
+            args.comment, fingerprint)
+        if stats is not None:
+            db.register_read_stats(acc, stats)
     out.write("Registered run {0} in the database\n".format(acc))
 
 
+def _map_files(fcn, fps, processes):
+    if processes > 1 and len(fps) > 1:
+        pool = multiprocessing.Pool(min(processes, len(fps)))
+        try:
+            return pool.map(fcn, fps, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [fcn(fp) for fp in fps]
+
+
+def _thread_map(fcn, xs, threads):
+    # For work that waits on the file system rather than the CPU
+    if threads > 1 and len(xs) > 1:
+        pool = multiprocessing.pool.ThreadPool(min(threads, len(xs)))
+        try:
+            return pool.map(fcn, xs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return [fcn(x) for x in xs]
+
+
+def compute_read_stats(fps, processes=4):
+    """Compute combined read statistics for FASTQ files in parallel."""
+    return merge_read_stats(_map_files(read_fastq_stats, fps, processes))
+
+
+def register_illumina_dir(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Add new runs to the registry from a directory of gzipped "
+        "Illumina FASTQ files.  One run is registered for each flow cell "
+        "and lane."))
+    p.add_argument("run_dir", help="Directory to search for FASTQ files")
+    p.add_argument("comment", help="Comment (free text)")
+    p.add_argument(
+        "--processes", type=int, default=4,
+        help="Number of files to read in parallel (default: %(default)s)")
+    p.add_argument(
+        "--stats", action="store_true",
+        help="Compute read statistics for each new run")
+    args = p.parse_args(argv)
+
+    fps = sorted(find_fastq_files(args.run_dir))
+    infos = _map_files(read_fastq_info, fps, args.processes)
+
+    lanes = group_fastq_lanes(infos)
+    registered = db.query_runs_from_files(fps)
+    new_lanes = []
+    for (flowcell_id, lane), lane_infos in sorted(lanes.items()):
+        existing = [
+            registered[x["filepath"]] for x in lane_infos
+            if x["filepath"] in registered]
+        if existing:
+            out.write(
+                "Flow cell {0} lane {1} already registered as run "
+                "{2}\n".format(flowcell_id, lane, existing[0]))
+        else:
+            new_lanes.append(lane_infos)
+
+    # The same data may be registered under another path
+    fingerprints = _thread_map(
+        file_fingerprint, [xs[0]["filepath"] for xs in new_lanes],
+        args.processes)
+    # or appear twice in this directory
+    unique_lanes = []
+    seen = {}
+    for lane_infos, fingerprint in zip(new_lanes, fingerprints):
+        f = lane_infos[0]
+        existing_acc = db.query_run_from_fingerprint(fingerprint)
+        if existing_acc:
+            out.write(
+                "Flow cell {0} lane {1} already registered as run {2} "
+                "(matching fingerprint)\n".format(
+                    f.get("flowcell_id"), f.get("lane"), existing_acc))
+        elif fingerprint in seen:
+            first = seen[fingerprint]
+            out.write(
+                "Flow cell {0} lane {1} has the same data as flow cell {2} "
+                "lane {3} (matching fingerprint)\n".format(
+                    f.get("flowcell_id"), f.get("lane"),
+                    first.get("flowcell_id"), first.get("lane")))
+        else:
+            seen[fingerprint] = f
+            unique_lanes.append((lane_infos, fingerprint))
+
+    if args.stats:
+        # Read all files for the new runs in one pool, then split the
+        # results back out by run
+        stats_fps = [x["filepath"] for xs, _ in unique_lanes for x in xs]
+        file_stats = dict(zip(stats_fps, _map_files(
+            read_fastq_stats, stats_fps, args.processes)))
+
+    with db.transaction():
+        for lane_infos, fingerprint in unique_lanes:
+            f = lane_infos[0]
+            acc = db.register_run(
+                f["date"], f["machine_type"], "Nextera XT", f["lane"],
+                f["filepath"], args.comment, fingerprint)
+            if args.stats:
+                db.register_read_stats(acc, merge_read_stats(
+                    file_stats[x["filepath"]] for x in lane_infos))
+            out.write("Registered run {0} in the database\n".format(acc))
+
+
+def find_fastq_files(run_dir):
+    for dirpath, dirnames, filenames in os.walk(run_dir):
+        for filename in filenames:
+            if filename.endswith((".fastq.gz", ".fq.gz")):
+                yield os.path.join(dirpath, filename)
+
+
+def group_fastq_lanes(infos):
+    """Group FASTQ file info by flow cell and lane.
+
+    Within each group, files for the first read come first, so that
+    the first file in the group is used as the data file for the run.
+    """
+    lanes = collections.defaultdict(list)
+    for info in infos:
+        lanes[(info.get("flowcell_id"), info.get("lane"))].append(info)
+    for lane_infos in lanes.values():
+        lane_infos.sort(key=lambda x: (x.get("read") != "1", x["filepath"]))
+    return lanes
+
+
 def register_run(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
     p = argparse.ArgumentParser(
         description="Add a new run to the registry")
@@ -158,6 +336,178 @@ def register_run(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
     out.write(u"Registered run %s in the database\n" % acc)
 
 
+def fingerprint_runs(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Compute content fingerprints for runs registered without one, "
+        "and report runs that share the same data"))
+    p.add_argument(
+        "--local-mount",
+        help="Local directory where the data files are mounted")
+    p.add_argument(
+        "--remote-mount",
+        help="Directory of the data files, as registered in the database")
+    p.add_argument(
+        "--threads", type=int, default=8,
+        help="Number of files to read concurrently (default: %(default)s)")
+    args = p.parse_args(argv)
+
+    runs = db.query_runs_without_fingerprint()
+
+    def fingerprint_run(run):
+        acc, data_uri = run
+        fp = local_filepath(data_uri, args.local_mount, args.remote_mount)
+        try:
+            return acc, fp, file_fingerprint(fp)
+        except (IOError, OSError):
+            return acc, fp, None
+
+    results = _thread_map(fingerprint_run, runs, args.threads)
+    fingerprints = []
+    for acc, fp, fingerprint in results:
+        if fingerprint is None:
+            out.write("Data file for run {0} not found: {1}\n".format(acc, fp))
+        else:
+            fingerprints.append((acc, fingerprint))
+    db.register_run_fingerprints(fingerprints)
+    out.write("Fingerprinted {0} runs\n".format(len(fingerprints)))
+    for accs in db.query_duplicate_fingerprints():
+        out.write("Runs with the same data: {0}\n".format(
+            ", ".join(str(acc) for acc in accs)))
+
+
+def _file_size(fp):
+    try:
+        return os.stat(fp).st_size
+    except OSError:
+        return None
+
+
+def _audit_status(size, expected_size):
+    if size is None:
+        return "missing"
+    if expected_size is not None and size != expected_size:
+        return "changed"
+    return "ok"
+
+
+def audit_run_files(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Check that the data files for registered runs are available and "
+        "unchanged in size.  Runs checked recently are skipped, unless "
+        "their data file had a problem."))
+    p.add_argument(
+        "--local-mount",
+        help="Local directory where the data files are mounted")
+    p.add_argument(
+        "--remote-mount",
+        help="Directory of the data files, as registered in the database")
+    p.add_argument(
+        "--max-age", type=float, default=7,
+        help=(
+            "Re-check data files last checked more than this many days "
+            "ago (default: %(default)s)"))
+    p.add_argument(
+        "--threads", type=int, default=16,
+        help="Number of files to check concurrently (default: %(default)s)")
+    args = p.parse_args(argv)
+
+    # Timestamps are stored as UTC, without the offset
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    checked_before = now - datetime.timedelta(days=args.max_age)
+    runs = db.query_runs_to_audit(checked_before.isoformat(" "))
+    fps = [
+        local_filepath(data_uri, args.local_mount, args.remote_mount)
+        for _, data_uri, _, _ in runs]
+    # Stat calls on a network mount spend most of their time waiting
+    sizes = _thread_map(_file_size, fps, args.threads)
+
+    timestamp = now.isoformat(" ")
+    audits = []
+    num_problems = 0
+    for (acc, _, fingerprint, last_size), fp, size in zip(runs, fps, sizes):
+        # The fingerprint records the size at registration
+        if fingerprint is not None:
+            expected_size = fingerprint_size(fingerprint)
+        else:
+            expected_size = last_size
+        status = _audit_status(size, expected_size)
+        if status == "missing":
+            out.write("Run {0}: data file missing: {1}\n".format(acc, fp))
+        elif status == "changed":
+            out.write(
+                "Run {0}: data file size changed from {1} to {2}: "
+                "{3}\n".format(acc, expected_size, size, fp))
+        if status != "ok":
+            num_problems += 1
+            # Keep comparing against the last good size
+            size = expected_size
+        audits.append((acc, fp, size, status, timestamp))
+    db.register_file_audits(audits)
+    out.write("Checked {0} runs, found {1} problems\n".format(
+        len(audits), num_problems))
+
+
+def rebuild_statistics(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Recompute the summary tables used for registry statistics"))
+    p.parse_args(argv)
+
+    db.rebuild_statistics()
+    counts = db.query_registry_counts()
+    out.write("Rebuilt statistics for {0} samples\n".format(counts["samples"]))
+
+
+def encode_annotations(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Store annotation keys and repeated values in lookup tables, to "
+        "save space in a large registry.  The annotations view keeps "
+        "existing queries working."))
+    p.add_argument(
+        "--decode", action="store_true",
+        help="Switch back to storing annotations as plain text")
+    args = p.parse_args(argv)
+
+    if args.decode:
+        if db.decode_annotations():
+            out.write("Annotations are now stored as plain text\n")
+        else:
+            out.write("Annotations are already stored as plain text\n")
+    else:
+        if db.encode_annotations():
+            out.write("Annotations are now dictionary-encoded\n")
+        else:
+            out.write("Annotations are already dictionary-encoded\n")
+
+
+def migrate_database(argv=None, db=REGISTRY_DATABASE, out=sys.stdout):
+    p = argparse.ArgumentParser(description=(
+        "Upgrade the registry database to the latest schema version"))
+    p.add_argument(
+        "--timings", action="store_true",
+        help="Report query timings before and after the upgrade")
+    args = p.parse_args(argv)
+
+    if args.timings:
+        before = migrations.time_hot_queries(db.con)
+    old_version = db.query_schema_version()
+    applied = db.migrate()
+    if applied:
+        out.write("Upgraded database from version {0} to {1}\n".format(
+            old_version, applied[-1]))
+    else:
+        out.write("Database is up to date (version {0})\n".format(
+            old_version))
+    if args.timings:
+        after = migrations.time_hot_queries(db.con)
+        if before is None:
+            out.write("No samples in database, timings not available\n")
+            return
+        out.write("Query\tBefore (ms)\tAfter (ms)\n")
+        for (desc, before_ms), (_, after_ms) in zip(before, after):
+            out.write("{0}\t{1:.3f}\t{2:.3f}\n".format(
+                desc, before_ms, after_ms))
+
+
 class SampleRegistry(object):
     machines = [
         "Illumina-MiSeq",
@@ -175,13 +525,15 @@ class SampleRegistry(object):
         if not self.db.query_run_exists(acc):
             raise ValueError("Run does not exist %s" % acc)
 
-    def register_samples(self, run_accession, sample_table):
-        self.db.register_samples(run_accession, sample_table.core_info)
+    def register_samples(self, run_accession, sample_table, reindex=True):
+        self.db.register_samples(
+            run_accession, sample_table.core_info, reindex=reindex)
 
     def remove_samples(self, run_accession):
-        accessions = self.db.query_sample_accessions(run_accession)
-        self.db.remove_annotations(accessions)
-        self.db.remove_samples(accessions)
+        with self.db.transaction():
+            accessions = self.db.query_sample_accessions(run_accession)
+            self.db.remove_annotations(accessions, reindex=False)
+            self.db.remove_samples(accessions)
         return accessions
 
     def register_annotations(self, run_accession, sample_table):
@@ -190,11 +542,14 @@ class SampleRegistry(object):
         for a, pairs in zip(accessions, sample_table.annotations):
             for k, v in pairs:
                 annotation_args.append((a, k, v))
-        self.db.remove_annotations(accessions)
-        self.db.register_annotations(annotation_args)
+        # The search index is rebuilt once, after the annotations are
+        # replaced
+        with self.db.transaction():
+            self.db.remove_annotations(accessions, reindex=False)
+            self.db.register_annotations(annotation_args, reindex=False)
+            self.db.reindex_samples(accessions)
 
     def _get_sample_accessions(self, run_accession, sample_table):
-        args = [(run_accession, n, b) for n, b in sample_table.core_info]
         accessions = self.db.query_barcoded_sample_accessions(
             run_accession, sample_table.core_info
         )
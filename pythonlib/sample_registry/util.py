@@ -1,7 +1,15 @@
 import collections
+import datetime
+import gzip
+import hashlib
 import io
 import itertools
 import os
+import queue
+import re
+import shutil
+import subprocess
+import threading
 
 try:
     import itertools.izip as zip
@@ -35,6 +43,84 @@ def local_filepath(data_fp, local_mount, remote_mount):
     return os.path.join(local_mount, data_fp.lstrip("/"))
 
 
+FINGERPRINT_BLOCK_SIZE = 64 * 1024
+
+
+def file_fingerprint(fp, block_size=FINGERPRINT_BLOCK_SIZE, num_blocks=4):
+    """Compute a fast content fingerprint for a file.
+
+    Rather than hashing the whole file, we hash the file size and a
+    few blocks at fixed offsets, spread evenly from the start to the
+    end of the file.  Small files are hashed in full.  At least two
+    blocks are needed, for the start and the end.
+    """
+    if num_blocks < 2:
+        raise ValueError("At least 2 blocks needed for a fingerprint")
+    size = os.path.getsize(fp)
+    h = hashlib.sha1(str(size).encode("ascii"))
+    with open(fp, "rb") as f:
+        if size <= block_size * num_blocks:
+            h.update(f.read())
+        else:
+            step = (size - block_size) // (num_blocks - 1)
+            for n in range(num_blocks):
+                f.seek(n * step)
+                h.update(f.read(block_size))
+    return "{0}:{1}".format(size, h.hexdigest())
+
+
+def fingerprint_size(fingerprint):
+    """Return the file size recorded in a fingerprint."""
+    return int(fingerprint.split(":", 1)[0])
+
+
+NUMBER_RE = re.compile(r"^[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$")
+
+# Only year-first dates are recognized.  Dates such as 11/10/2015 are
+# read as month/day in some places and day/month in others, so they
+# are not indexed as dates.
+DATE_FORMATS = ["%Y-%m-%d", "%Y/%m/%d"]
+
+# A time after a date, as HH:MM or HH:MM:SS
+DATE_TIME_RE = re.compile(r"^(\S+?)[T ](\d{2}:\d{2}(:\d{2})?)$")
+
+
+def _strip_time(val):
+    match = DATE_TIME_RE.match(val)
+    if match is None:
+        return val
+    date_part, time_part, seconds = match.groups()
+    fmt = "%H:%M:%S" if seconds else "%H:%M"
+    try:
+        datetime.datetime.strptime(time_part, fmt)
+    except ValueError:
+        return val
+    return date_part
+
+
+def typed_value(val):
+    """Infer a number or a date from an annotation value.
+
+    Returns a (number, date) tuple, with None for a type that does
+    not apply.  Dates must be written year first, as YYYY-MM-DD or
+    YYYY/MM/DD, and are returned in ISO format, so they sort correctly
+    as text.  A date may be followed by a time, as HH:MM or HH:MM:SS,
+    which is ignored.  Returns None if the value is neither a number
+    nor a date.
+    """
+    val = val.strip()
+    if NUMBER_RE.match(val):
+        return float(val), None
+    date_part = _strip_time(val)
+    for fmt in DATE_FORMATS:
+        try:
+            d = datetime.datetime.strptime(date_part, fmt).date()
+        except ValueError:
+            continue
+        return None, d.isoformat()
+    return None
+
+
 def parse_fasta(f):
     f = iter(f)
     desc = next(f).strip()[1:]
@@ -65,6 +151,178 @@ def parse_fastq(f):
         yield desc, seq, qual
 
 
+FASTQ_BLOCK_SIZE = 4 * 1024 * 1024
+
+
+def parse_fastq_batches(f, block_size=FASTQ_BLOCK_SIZE, decode=False):
+    """Parse a FASTQ file in batches of records.
+
+    The file must be opened in binary mode.  It is read in large
+    blocks, which are split into lines all at once, rather than line
+    by line.  Lines are assumed to end in a single newline character.
+
+    Yields a list of (desc, seq, qual) tuples for each block.  Fields
+    are bytes, unless decode is True.
+    """
+    remainder = b""
+    for block in read_blocks(f, block_size):
+        lines = (remainder + block).split(b"\n")
+        # The last line is incomplete, or empty if the block ends in
+        # a newline.  Keep it, and any incomplete record, for later.
+        nlines = 4 * ((len(lines) - 1) // 4)
+        remainder = b"\n".join(lines[nlines:])
+        if nlines:
+            yield _fastq_batch(lines, nlines, decode)
+    lines = remainder.split(b"\n")
+    while lines and not lines[-1]:
+        lines.pop()
+    if lines:
+        if len(lines) % 4:
+            raise ValueError("Incomplete record at end of FASTQ file")
+        yield _fastq_batch(lines, len(lines), decode)
+
+
+def _fastq_batch(lines, nlines, decode):
+    descs = [d[1:] for d in lines[0:nlines:4]]
+    seqs = lines[1:nlines:4]
+    quals = lines[3:nlines:4]
+    if decode:
+        descs = [x.decode("ascii") for x in descs]
+        seqs = [x.decode("ascii") for x in seqs]
+        quals = [x.decode("ascii") for x in quals]
+    return list(zip(descs, seqs, quals))
+
+
+def count_fastq(f, block_size=FASTQ_BLOCK_SIZE):
+    """Count the records in a FASTQ file opened in binary mode."""
+    nlines = 0
+    last_byte = b"\n"
+    for block in read_blocks(f, block_size):
+        nlines += block.count(b"\n")
+        last_byte = block[-1:]
+    if last_byte != b"\n":
+        # Final line has no newline character
+        nlines += 1
+    return nlines // 4
+
+
+def read_blocks(f, block_size):
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        yield block
+
+
+class ThreadedReader(object):
+    """Read from a file in a background thread.
+
+    Reading a gzipped file spends most of its time in zlib, which
+    releases the GIL, so blocks can be decompressed in one thread
+    while they are parsed in another.
+    """
+
+    def __init__(self, f, block_size=FASTQ_BLOCK_SIZE, max_blocks=4):
+        self.file = f
+        self.block_size = block_size
+        self.blocks = queue.Queue(max_blocks)
+        self._stop = threading.Event()
+        self._buffer = b""
+        self._eof = False
+        self._thread = threading.Thread(target=self._read_blocks)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _read_blocks(self):
+        try:
+            for block in read_blocks(self.file, self.block_size):
+                if self._stop.is_set():
+                    return
+                self.blocks.put(block)
+        except Exception as e:
+            self.blocks.put(e)
+            return
+        self.blocks.put(b"")
+
+    def read(self, size=-1):
+        if self._eof:
+            return b""
+        if not self._buffer:
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self._eof = True
+                return b""
+            self._buffer = block
+        if size is None or size < 0 or size >= len(self._buffer):
+            res, self._buffer = self._buffer, b""
+        else:
+            res, self._buffer = self._buffer[:size], self._buffer[size:]
+        return res
+
+    def close(self):
+        self._stop.set()
+        # Unblock the reader thread if it is waiting on a full queue
+        while self._thread.is_alive():
+            try:
+                self.blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PipedReader(object):
+    """Read the output of a decompression command run in a subprocess."""
+
+    def __init__(self, args):
+        self.proc = subprocess.Popen(
+            args, stdout=subprocess.PIPE, bufsize=FASTQ_BLOCK_SIZE)
+
+    def read(self, size=-1):
+        data = self.proc.stdout.read(size)
+        if not data and self.proc.wait() != 0:
+            raise IOError("Decompression failed: {0}".format(
+                " ".join(self.proc.args)))
+        return data
+
+    def close(self):
+        self.proc.stdout.close()
+        self.proc.terminate()
+        self.proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_gzip(fp, method="auto"):
+    """Open a gzipped file for fast reading in binary mode.
+
+    With method "pipe", the file is decompressed by pigz (or gzip, if
+    pigz is not installed) in a separate process.  With method
+    "thread", it is decompressed by the gzip module in a background
+    thread.  With method "auto", a pipe is used only if pigz is
+    available, because single-threaded gzip is no faster than the
+    gzip module.
+    """
+    pigz = shutil.which("pigz")
+    if method == "pipe" or (method == "auto" and pigz is not None):
+        exe = pigz or shutil.which("gzip")
+        if exe is None:
+            raise ValueError("No gzip program found")
+        return PipedReader([exe, "-dc", fp])
+    return ThreadedReader(gzip.open(fp, "rb"))
+
+
 class FastaRead(object):
     def __init__(self, read):
         self.desc, self.seq = read
@@ -106,6 +364,59 @@ def deambiguate(seq):
     nt_choices = [AMBIGUOUS_BASES[x] for x in seq]
     return ["".join(c) for c in itertools.product(*nt_choices)]
 
+# Each base is one bit; an ambiguous base code is the union of its bases
+BASE_BITS = {"A": 1, "C": 2, "G": 4, "T": 8}
+
+IUPAC_BITS = dict(
+    (code, sum(BASE_BITS[b] for b in bases))
+    for code, bases in AMBIGUOUS_BASES.items())
+
+
+class AmbiguousPattern(object):
+    """Match sequences against a pattern with ambiguous base codes.
+
+    Matching takes time linear in the length of the pattern, without
+    expanding the pattern into every unambiguous sequence.  The
+    pattern is compared to the start of each sequence.  Bases in the
+    sequence other than A, C, G, and T never match.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern.upper()
+        self.masks = [IUPAC_BITS[x] for x in self.pattern]
+        self.regex = re.compile("".join(
+            "[{0}]".format(AMBIGUOUS_BASES[x]) for x in self.pattern))
+
+    def __len__(self):
+        return len(self.masks)
+
+    def mismatches(self, seq, max_mismatches=None):
+        """Count positions where the sequence does not match.
+
+        If max_mismatches is given, counting stops once it is
+        exceeded.  Missing positions at the end of a short sequence
+        count as mismatches.
+        """
+        n = max(len(self.masks) - len(seq), 0)
+        for mask, base in zip(self.masks, seq):
+            if not mask & BASE_BITS.get(base, 0):
+                n += 1
+                if max_mismatches is not None and n > max_mismatches:
+                    break
+        return n
+
+    def matches(self, seq, max_mismatches=0):
+        if max_mismatches == 0:
+            return self.regex.match(seq) is not None
+        return self.mismatches(seq, max_mismatches) <= max_mismatches
+
+    def match_many(self, seqs, max_mismatches=0):
+        """Test a batch of sequences, returning a list of booleans."""
+        if max_mismatches == 0:
+            match = self.regex.match
+            return [match(seq) is not None for seq in seqs]
+        return [self.matches(seq, max_mismatches) for seq in seqs]
+
 COMPLEMENT_BASES = {
     "T": "A",
     "C": "G",
@@ -113,7 +424,61 @@ COMPLEMENT_BASES = {
     "G": "C",
     }
 
+# Complements for all ambiguous base codes
+IUPAC_COMPLEMENT_BASES = {
+    "T": "A",
+    "C": "G",
+    "A": "T",
+    "G": "C",
+    "R": "Y",
+    "Y": "R",
+    "M": "K",
+    "K": "M",
+    "S": "S",
+    "W": "W",
+    "H": "D",
+    "B": "V",
+    "V": "B",
+    "D": "H",
+    "N": "N",
+    }
+
+
+def _complement_tables():
+    pairs = list(IUPAC_COMPLEMENT_BASES.items())
+    pairs += [(b.lower(), c.lower()) for b, c in pairs]
+    # Separator between the two halves of a dual-index barcode
+    pairs.append(("-", "-"))
+    bases = "".join(b for b, _ in pairs)
+    complements = "".join(c for _, c in pairs)
+    str_table = str.maketrans(bases, complements)
+    bytes_table = bytes.maketrans(
+        bases.encode("ascii"), complements.encode("ascii"))
+    return bases, str_table, bytes_table
+
+
+_COMPLEMENT_CHARS, _COMPLEMENT_TABLE, _COMPLEMENT_BYTES_TABLE = (
+    _complement_tables())
+_COMPLEMENT_CHARS_SET = frozenset(_COMPLEMENT_CHARS)
+_COMPLEMENT_BYTES = _COMPLEMENT_CHARS.encode("ascii")
+
+
 def reverse_complement(seq):
-    rc = [COMPLEMENT_BASES[x] for x in seq]
-    rc.reverse()
-    return ''.join(rc)
+    """Reverse complement a DNA sequence, given as str or bytes.
+
+    All ambiguous base codes are supported, in upper or lower case.
+    Raises KeyError if the sequence contains any other character.
+    """
+    if isinstance(seq, bytes):
+        invalid = seq.translate(None, _COMPLEMENT_BYTES)
+        if invalid:
+            raise KeyError(invalid[:1])
+        return seq.translate(_COMPLEMENT_BYTES_TABLE)[::-1]
+    if not _COMPLEMENT_CHARS_SET.issuperset(seq):
+        raise KeyError(next(x for x in seq if x not in _COMPLEMENT_CHARS_SET))
+    return seq.translate(_COMPLEMENT_TABLE)[::-1]
+
+
+def reverse_complement_many(seqs):
+    """Reverse complement a batch of sequences, returning a list."""
+    return [reverse_complement(seq) for seq in seqs]
@@ -14,12 +14,21 @@ setup(
     entry_points = {'console_scripts': [
         'register_run = sample_registry.register:register_run',
         'register_run_file = sample_registry.register:register_illumina_file',
+        'register_run_dir = sample_registry.register:register_illumina_dir',
         'unregister_samples = sample_registry.register:unregister_samples',
         'register_samples = sample_registry.register:register_samples',
         'register_annotations = sample_registry.register:register_annotations',
         'register_host_species = sample_registry.register:register_host_species',
         'register_sample_types = sample_registry.register:register_sample_types',
         'export_samples = sample_registry.export:export_samples',
+        'demultiplex_run = sample_registry.demultiplex:demultiplex_run',
+        'verify_barcodes = sample_registry.demultiplex:verify_barcodes',
+        'migrate_registry = sample_registry.register:migrate_database',
+        'fingerprint_runs = sample_registry.register:fingerprint_runs',
+        'audit_run_files = sample_registry.register:audit_run_files',
+        'rebuild_registry_statistics = sample_registry.register:rebuild_statistics',
+        'encode_annotations = sample_registry.register:encode_annotations',
+        'query_samples = sample_registry.query:query_samples',
         ]},
     )
 
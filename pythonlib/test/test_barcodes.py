@@ -0,0 +1,55 @@
+import io
+import unittest
+
+from sample_registry.barcodes import IndexKitRegistry, index_kits
+
+
+class IndexKitRegistryTests(unittest.TestCase):
+    def setUp(self):
+        self.kits = IndexKitRegistry()
+        self.kits.add_kit("Kit A", [("A1", "ACGT"), ("A2", "TTGG")])
+
+    def test_load_kit(self):
+        f = io.StringIO(KIT_TSV)
+        f.name = "/tmp/kit_b.tsv"
+        self.kits.load_kit(f)
+        self.assertEqual(
+            self.kits.kits["kit_b"], {"B1": "GGCC", "B2": "AATT"})
+        self.assertEqual(self.kits.barcodes["A1"], "ACGT")
+        self.assertEqual(self.kits.barcodes["B2"], "AATT")
+
+    def test_conflicting_kit(self):
+        self.assertRaises(
+            ValueError, self.kits.add_kit, "Kit C", [("A1", "CCCC")])
+        # Repeating an index with the same barcode is allowed
+        self.kits.add_kit("Kit D", [("A1", "ACGT")])
+
+    def test_copy(self):
+        kits = self.kits.copy()
+        kits.add_kit("Kit B", [("A1", "ACGT"), ("B1", "GGCC")])
+        self.assertEqual(kits.barcodes["B1"], "GGCC")
+        self.assertNotIn("B1", self.kits.barcodes)
+        self.assertEqual(list(self.kits.kits), ["Kit A"])
+
+    def test_resolve_pairs(self):
+        pairs = [("A1", "A2"), ("A1", "Z9"), (None, "A1"), ("A2", "A2")]
+        barcodes, unresolved = self.kits.resolve_pairs(pairs)
+        self.assertEqual(barcodes, ["ACGT-TTGG", None, None, "TTGG-TTGG"])
+        self.assertEqual(unresolved, [1, 2])
+
+    def test_index_kits(self):
+        kits = index_kits()
+        self.assertIs(kits, index_kits())
+        self.assertEqual(kits.barcodes["N716"], "ACTCGCTA")
+
+
+KIT_TSV = u"""\
+# Index name and sequence
+B1	GGCC
+
+B2	aatt
+"""
+
+
+if __name__ == "__main__":
+    unittest.main()
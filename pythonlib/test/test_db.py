@@ -1,6 +1,52 @@
+import datetime
+import os
+import shutil
+import tempfile
 import unittest
 
-from sample_registry.db import RegistryDatabase
+from sample_registry.db import (
+    RegistryDatabase, search_expression, typed_range,
+    )
+from sample_registry.illumina import ReadStats
+
+
+def read_fastq_stats_fixture():
+    s = ReadStats()
+    s.add_batch([b"ACGT", b"ACGTA", b"ACGTA"], [b"????", b"@@@@@", b"?@?@?"])
+    return {(1, 1): s}
+
+
+class ConnectionTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_connection_is_lazy(self):
+        db_fp = os.path.join(self.tmp_dir, "missing_dir", "core.db")
+        db = RegistryDatabase(db_fp)
+        self.assertFalse(os.path.exists(db_fp))
+        os.mkdir(os.path.dirname(db_fp))
+        db.create_tables()
+        self.assertTrue(os.path.exists(db_fp))
+        db.close()
+
+    def test_pragmas(self):
+        db_fp = os.path.join(self.tmp_dir, "core.db")
+        db = RegistryDatabase(db_fp, synchronous="FULL", busy_timeout=1234)
+        pragma = lambda name: db.con.execute(
+            "PRAGMA {0}".format(name)).fetchone()[0]
+        self.assertEqual(pragma("journal_mode"), "wal")
+        self.assertEqual(pragma("synchronous"), 2)
+        self.assertEqual(pragma("busy_timeout"), 1234)
+        self.assertEqual(pragma("foreign_keys"), 1)
+        db.close()
+
+        db = RegistryDatabase(db_fp, journal_mode=None, foreign_keys=False)
+        self.assertEqual(pragma("foreign_keys"), 0)
+        db.close()
+
 
 class RegistryDatabaseTests(unittest.TestCase):
     def setUp(self):
@@ -32,6 +78,35 @@ class RegistryDatabaseTests(unittest.TestCase):
         # Registering the run twice should raise an error
         self.assertRaises(ValueError, self.db.register_run, *self.run)
 
+    def test_register_read_stats(self):
+        stats = read_fastq_stats_fixture()
+        self.db.register_read_stats(self.run_acc, stats)
+        # Registering again replaces the existing statistics
+        self.db.register_read_stats(self.run_acc, stats)
+        self.assertEqual(self.db.query_read_stats(self.run_acc), [{
+            "lane": 1, "read_number": 1, "read_count": 3, "base_count": 14,
+            "mean_quality": 30.5, "lengths": {4: 1, 5: 2},
+        }])
+        self.assertEqual(self.db.query_read_stats(2), [])
+
+    def test_register_run_fingerprint(self):
+        run2 = self.run[:4] + (u"run2.fastq", u"Run 2", u"100:abc")
+        self.assertEqual(self.db.register_run(*run2), 2)
+        self.assertEqual(self.db.query_run_from_fingerprint(u"100:abc"), 2)
+        # Same data under a different path is rejected
+        run3 = self.run[:4] + (u"moved/run2.fastq", u"Run 2", u"100:abc")
+        self.assertRaises(ValueError, self.db.register_run, *run3)
+
+    def test_register_run_fingerprints(self):
+        run2 = self.run[:4] + (u"run2.fastq", u"Run 2")
+        self.db.register_run(*run2)
+        self.assertEqual(
+            self.db.query_runs_without_fingerprint(),
+            [(1, u"run_file.fastq"), (2, u"run2.fastq")])
+        self.db.register_run_fingerprints([(1, u"1:a"), (2, u"1:a")])
+        self.assertEqual(self.db.query_runs_without_fingerprint(), [])
+        self.assertEqual(self.db.query_duplicate_fingerprints(), [[1, 2]])
+
     def test_query_run_exists(self):
         self.assertTrue(self.db.query_run_exists(1))
 
@@ -46,12 +121,38 @@ class RegistryDatabaseTests(unittest.TestCase):
         self.assertRaises(
             ValueError, self.db.register_samples, 1, self.sample_bcs)
 
+    def test_register_samples_all_or_nothing(self):
+        self.db.register_samples(1, [self.single_sample])
+        self.assertRaises(
+            ValueError, self.db.register_samples, 1, self.sample_bcs)
+        self.assertEqual(self.db.query_sample_accessions(1), [1])
+
+    def test_register_samples_preserves_input_order(self):
+        # More samples than fit in one chunk of query parameters
+        sample_bcs = [
+            ("S{0}".format(n), "BC{0}".format(n)) for n in range(1200, 0, -1)]
+        registered_accessions = self.db.register_samples(1, sample_bcs)
+        self.assertEqual(registered_accessions, list(range(1, 1201)))
+        self.assertEqual(self.db.query_sample_barcodes(1), sample_bcs)
+
     def test_query_barcoded_sample_accessions(self):
         self.db.register_samples(1, self.sample_bcs)
         self.assertEqual(
             self.db.query_barcoded_sample_accessions(1, self.sample_bcs),
             [1, 2, 3])
 
+    def test_query_barcoded_sample_accessions_missing(self):
+        self.db.register_samples(1, self.sample_bcs[:2])
+        query_bcs = [
+            ("My.Sample3", "GHI"), ("Sample2", "DEF"), ("Sample1", "XYZ")]
+        self.assertEqual(
+            self.db.query_barcoded_sample_accessions(1, query_bcs),
+            [None, 2, None])
+        # Samples from a different run are not found
+        self.assertEqual(
+            self.db.query_barcoded_sample_accessions(2, self.sample_bcs),
+            [None, None, None])
+
     def test_query_sample_accessions(self):
         self.db.register_samples(1, self.sample_bcs)
         self.assertEqual(
@@ -84,6 +185,224 @@ class RegistryDatabaseTests(unittest.TestCase):
         self.assertEqual(
             self.db.query_sample_annotations(1), self.annotations)
 
+    def test_query_run_annotations(self):
+        sample_accessions = self.db.register_samples(1, self.sample_bcs)
+        ann = [(1, k, v) for k, v in self.annotations.items()]
+        ann.append((3, "HostSpecies", "Human"))
+        self.db.register_annotations(ann)
+        self.assertEqual(self.db.query_run_annotations(1), {
+            1: self.annotations,
+            2: {},
+            3: {"HostSpecies": "Human"},
+        })
+        self.assertEqual(
+            list(self.db.query_run_annotations(1)), sample_accessions)
+        self.assertEqual(self.db.query_run_annotations(2), {})
+
+    def test_query_multisample_annotations(self):
+        sample_bcs = [("S{0}".format(n), "A") for n in range(1200)]
+        self.db.register_samples(1, sample_bcs)
+        ann = [(acc, "study_day", str(acc)) for acc in range(1, 1201)]
+        self.db.register_annotations(ann)
+        # More accessions than fit in one chunk, with one unknown
+        query_accessions = list(range(1200, 0, -1)) + [2000]
+        obs = self.db.query_multisample_annotations(query_accessions)
+        self.assertEqual(list(obs), list(range(1200, 0, -1)))
+        self.assertEqual(obs[600], {"study_day": "600"})
+
+    def test_transaction_commits_once(self):
+        commits = []
+        self.db.con.set_trace_callback(
+            lambda sql: commits.append(sql) if sql == "COMMIT" else None)
+        with self.db.transaction():
+            accessions = self.db.register_samples(1, self.sample_bcs)
+            self.db.register_annotations(
+                [(accessions[0], "study_day", "1")])
+            self.db.query_run_annotations(1)
+            self.assertEqual(commits, [])
+        self.assertEqual(commits, ["COMMIT"])
+
+    def test_transaction_rollback(self):
+        accessions = self.db.register_samples(1, self.sample_bcs)
+        ann = [(accessions[0], "study_day", "1")]
+        self.db.register_annotations(ann)
+        try:
+            with self.db.transaction():
+                self.db.remove_annotations(accessions)
+                self.db.register_annotations([(accessions[1], "day", "2")])
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+        self.assertEqual(
+            self.db.query_sample_annotations(accessions[0]),
+            {"study_day": "1"})
+        self.assertEqual(self.db.query_sample_annotations(accessions[1]), {})
+
+    def test_statistics(self):
+        accessions = self.db.register_samples(1, self.sample_bcs)
+        self.db.register_annotations([
+            (accessions[0], "SampleType", "Feces"),
+            (accessions[0], "SubjectID", "Subj1"),
+            (accessions[1], "SampleType", "Feces"),
+            (accessions[1], "HostSpecies", "Human"),
+            (accessions[1], "study_day", "1"),
+            (accessions[2], "study_day", "2"),
+            ])
+        # Replace the annotations for one sample
+        self.db.remove_annotations([accessions[1]])
+        self.db.register_annotations([
+            (accessions[1], "SampleType", "Oral swab"),
+            (accessions[1], "study_group", "A"),
+            ])
+        self.db.remove_samples([accessions[2]])
+
+        def check_statistics():
+            self.assertEqual(self.db.query_registry_counts(), {
+                "samples": 2,
+                "samples_with_sample_type": 2,
+                "samples_with_host_species": 0,
+                "samples_with_subject_id": 1,
+                "samples_with_subject_id_and_host_species": 0,
+                "samples_with_primer": 0,
+                })
+            self.assertEqual(
+                self.db.query_sample_value_counts("sample_type"),
+                {"Feces": 1, "Oral swab": 1})
+            self.assertEqual(
+                self.db.query_sample_value_counts("host_species"), {})
+            self.assertEqual(self.db.query_run_sample_count(1), 2)
+            self.assertEqual(
+                self.db.query_annotation_key_counts(), {"study_group": 1})
+
+        check_statistics()
+        self.db.rebuild_statistics()
+        check_statistics()
+
+    def test_search_samples(self):
+        accessions = self.db.register_samples(1, self.sample_bcs)
+        self.db.register_annotations([
+            (accessions[0], "SubjectID", "Subj23"),
+            (accessions[1], "SampleType", "Oral swab"),
+            (accessions[2], "study_group", "Healthy"),
+            ])
+
+        def search(*args, **kwargs):
+            return [
+                r["sample_accession"]
+                for r in self.db.search_samples(*args, **kwargs)]
+
+        self.assertEqual(search("sample"), [3, 2, 1])
+        self.assertEqual(search("my.sam"), [3])
+        self.assertEqual(search("subj2"), [1])
+        self.assertEqual(search("oral"), [2])
+        self.assertEqual(search("sample health"), [3])
+        self.assertEqual(search("subj", fields=["sample_name"]), [])
+        # Quotes in the text do not break the query
+        self.assertEqual(search('"sample'), [3, 2, 1])
+        # Pages of results
+        self.assertEqual(search("sample", limit=2), [3, 2])
+        self.assertEqual(search("sample", limit=2, before=2), [1])
+        self.assertEqual(search("sample", limit=2, offset=2), [1])
+        self.assertEqual(
+            self.db.search_samples("subj")[0]["run_comment"], "Bob's run")
+
+        # The index follows changes to the samples and annotations
+        self.db.remove_annotations([accessions[0]])
+        self.assertEqual(search("subj2"), [])
+        self.db.remove_samples([accessions[2]])
+        self.assertEqual(search("sample"), [2, 1])
+
+    def test_search_expression(self):
+        self.assertEqual(search_expression("ab c"), '"ab"* "c"*')
+        self.assertEqual(search_expression('a"b'), '"a""b"*')
+        self.assertEqual(
+            search_expression("ab", ["subject_id"]), '{subject_id} : ("ab"*)')
+        self.assertRaises(ValueError, search_expression, "  ")
+        self.assertRaises(ValueError, search_expression, "a", ["run"])
+
+    def test_iter_run_samples(self):
+        accessions = self.db.register_samples(1, [
+            ("S2", "AAAA"), ("S1", "CCCC"), ("S3", "GGGG")])
+        self.db.register_annotations([
+            (accessions[0], "study_day", "1"),
+            (accessions[0], "study_group", "A"),
+            (accessions[1], "SampleType", "Feces"),
+            ])
+        samples = list(self.db.iter_run_samples(1))
+        self.assertEqual(
+            [s["sample_name"] for s, _ in samples], ["S1", "S2", "S3"])
+        self.assertEqual(samples[0][0]["sample_type"], "Feces")
+        self.assertEqual(
+            list(samples[1][1].items()),
+            [("study_day", "1"), ("study_group", "A")])
+        self.assertEqual(samples[2][1], {})
+
+        # Rows come from the indexes in order, without a sort
+        if self.db.query_annotations_encoded():
+            sql = self.db.select_run_samples_with_encoded_annotations
+        else:
+            sql = self.db.select_run_samples_with_annotations
+        plan = self.db.con.execute(
+            "EXPLAIN QUERY PLAN " + sql, (1, )).fetchall()
+        details = " ".join(row[-1] for row in plan)
+        self.assertNotIn("TEMP B-TREE", details)
+        self.assertNotIn("MATERIALIZE", details)
+
+    def test_query_annotation_range(self):
+        accessions = self.db.register_samples(1, self.sample_bcs)
+        self.db.register_annotations([
+            (accessions[0], "study_day", "7"),
+            (accessions[1], "study_day", "1.5"),
+            (accessions[2], "study_day", "NA"),
+            (accessions[0], "collected", "2015-10-01"),
+            (accessions[1], "collected", "2015/10/03"),
+            (accessions[2], "collected", "2015-09-28"),
+            (accessions[0], "SubjectID", "12"),
+            ])
+        self.assertEqual(
+            self.db.query_annotation_range("study_day", 1, 7),
+            [(accessions[1], 1.5), (accessions[0], 7.0)])
+        self.assertEqual(
+            self.db.query_annotation_range("study_day", high="2"),
+            [(accessions[1], 1.5)])
+        self.assertEqual(
+            self.db.query_annotation_range(
+                "collected", datetime.date(2015, 10, 1)),
+            [(accessions[0], "2015-10-01"), (accessions[1], "2015-10-03")])
+        self.assertEqual(
+            self.db.query_annotation_range("collected", high="2015-09-30"),
+            [(accessions[2], "2015-09-28")])
+        # Standard annotations are stored with the sample
+        self.assertEqual(self.db.query_annotation_range("SubjectID", 0), [])
+        self.assertRaises(
+            ValueError, self.db.query_annotation_range, "study_day")
+
+        # The index answers the query without scanning the table
+        plan = self.db.con.execute(
+            "EXPLAIN QUERY PLAN " +
+            self.db.select_annotation_range.format(
+                "num_val", " AND num_val >= ?"),
+            ("study_day", 1)).fetchall()
+        self.assertIn(
+            "COVERING INDEX typed_annotations_key_num", plan[0][-1])
+
+        # Typed values follow changes to the annotations
+        self.db.remove_annotations([accessions[0]])
+        self.assertEqual(
+            self.db.query_annotation_range("study_day", 0),
+            [(accessions[1], 1.5)])
+        self.db.remove_samples([accessions[1]])
+        self.assertEqual(self.db.query_annotation_range("study_day", 0), [])
+
+    def test_typed_range(self):
+        self.assertEqual(typed_range(1, "2.5"), ("num_val", 1.0, 2.5))
+        self.assertEqual(
+            typed_range(high=datetime.datetime(2015, 10, 11, 8, 30)),
+            ("date_val", None, "2015-10-11"))
+        self.assertRaises(ValueError, typed_range)
+        self.assertRaises(ValueError, typed_range, "Healthy")
+        self.assertRaises(ValueError, typed_range, 1, "2015-10-11")
+
     def test_collect_standard_annotations(self):
         a = [
             (1, "SampleType", "a"),
@@ -94,5 +413,39 @@ class RegistryDatabaseTests(unittest.TestCase):
         self.assertEqual(obs, {1: ["a", None, "b"], 2: [None, "c", None]})
 
 
+class EncodedAnnotationsTests(RegistryDatabaseTests):
+    """Repeat the tests with annotations in the dictionary-encoded layout."""
+    def setUp(self):
+        super(EncodedAnnotationsTests, self).setUp()
+        self.db.encode_annotations()
+
+    def test_encode_and_decode(self):
+        accessions = self.db.register_samples(1, self.sample_bcs)
+        self.db.register_annotations([
+            (acc, "study_group", "Healthy") for acc in accessions] + [
+            (acc, "note", "Sample %s" % acc) for acc in accessions])
+        annotations = self.db.query_run_annotations(1)
+        keys = self.db.query_run_annotation_keys(1)
+        self.assertTrue(self.db.query_annotations_encoded())
+        # Only values that repeat are interned
+        self.assertEqual(
+            self.db.con.execute(
+                "SELECT `val` FROM annotation_val_ids").fetchall(),
+            [("Healthy",)])
+
+        self.assertTrue(self.db.decode_annotations())
+        self.assertFalse(self.db.decode_annotations())
+        self.assertFalse(self.db.query_annotations_encoded())
+        self.assertEqual(self.db.query_run_annotations(1), annotations)
+        self.assertEqual(self.db.query_run_annotation_keys(1), keys)
+
+        self.assertTrue(self.db.encode_annotations())
+        self.assertFalse(self.db.encode_annotations())
+        self.assertEqual(self.db.query_run_annotations(1), annotations)
+        self.assertEqual(
+            self.db.query_annotation_key_counts(),
+            {"note": 3, "study_group": 3})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,211 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from sample_registry.db import RegistryDatabase
+from sample_registry.demultiplex import (
+    BarcodeIndex, header_index_seq, demultiplex, demultiplex_run,
+    sample_index_seqs, compare_index_seqs, verify_barcodes,
+)
+
+
+class BarcodeIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.index = BarcodeIndex([
+            ("S1", "AAAA-CCCC"),
+            ("S2", "AAAT-CCCC"),
+            ("S3", "GGGG-TTTT"),
+        ])
+
+    def test_assign_exact(self):
+        self.assertEqual(self.index.assign("AAAA+CCCC"), 0)
+        self.assertEqual(self.index.assign("aaat-cccc"), 1)
+
+    def test_assign_mismatch(self):
+        self.assertEqual(self.index.assign("GGGG+TTTA"), 2)
+        self.assertEqual(self.index.assign("NGGG+TTTT"), 2)
+        self.assertEqual(self.index.assign("GGGA+TTTA"), None)
+
+    def test_assign_ambiguous(self):
+        # One mismatch from both S1 and S2
+        self.assertEqual(self.index.assign("AAAG+CCCC"), None)
+
+    def test_no_mismatches(self):
+        index = BarcodeIndex([("S3", "GGGG-TTTT")], max_mismatches=0)
+        self.assertEqual(index.assign("GGGG+TTTT"), 0)
+        self.assertEqual(index.assign("GGGG+TTTA"), None)
+
+    def test_duplicate_barcode(self):
+        self.assertRaises(
+            ValueError, BarcodeIndex,
+            [("S1", "AAAA-CCCC"), ("S2", "aaaa+cccc")])
+
+    def test_header_index_seq(self):
+        self.assertEqual(
+            header_index_seq(
+                "M03543:47:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGT+TTGA"),
+            "ACGT+TTGA")
+
+
+def write_fastq(fp, index_seqs):
+    with gzip.open(fp, "wt") as f:
+        for n, index_seq in enumerate(index_seqs):
+            f.write(
+                "@M03543:47:C8LJ2ANXX:1:2209:{0}:2044 1:N:0:{1}\n"
+                "ACGTACGT\n+\nFFFFFFFF\n".format(n, index_seq))
+
+
+class DemultiplexTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fastq_fp = os.path.join(self.tmp_dir, "Undetermined_R1.fastq.gz")
+        write_fastq(
+            self.fastq_fp,
+            ["AAAA+CCCC", "GGGG+TTTT", "AAAA+CCCA", "TTTT+TTTT"] * 50)
+        self.index = BarcodeIndex([
+            ("S1", "AAAA-CCCC"),
+            ("S2", "GGGG-TTTT"),
+            ("S3", "CCCC-AAAA"),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_demultiplex(self):
+        for processes in [1, 2]:
+            counts = demultiplex(
+                self.index, [self.fastq_fp], processes=processes,
+                batch_size=7)
+            self.assertEqual(counts, {"S1": 100, "S2": 50, None: 50})
+
+    def test_demultiplex_revcomp_i2_in_header(self):
+        fastq_fp = os.path.join(self.tmp_dir, "Reversed_R1.fastq.gz")
+        # Reverse complement of the second index for S1 and S2
+        write_fastq(fastq_fp, ["AAAA+GGGG", "GGGG+AAAA", "GGGG+AANA"] * 5)
+        counts = demultiplex(
+            self.index, [fastq_fp], revcomp_i2=True, processes=1)
+        self.assertEqual(counts, {"S1": 5, "S2": 10})
+
+    def test_demultiplex_index_reads(self):
+        i1_fp = os.path.join(self.tmp_dir, "Undetermined_I1.fastq.gz")
+        i2_fp = os.path.join(self.tmp_dir, "Undetermined_I2.fastq.gz")
+        with gzip.open(i1_fp, "wt") as f:
+            f.write("@r1\nAAAA\n+\nFFFF\n@r2\nGGGG\n+\nFFFF\n")
+        with gzip.open(i2_fp, "wt") as f:
+            # Reverse complement of CCCC and TTTT
+            f.write("@r1\nGGGG\n+\nFFFF\n@r2\nAAAA\n+\nFFFF\n")
+        reads_fp = os.path.join(self.tmp_dir, "Undetermined_R1.fastq")
+        with open(reads_fp, "w") as f:
+            f.write("@r1\nACGT\n+\nFFFF\n@r2\nACGT\n+\nFFFF\n")
+        counts = demultiplex(
+            self.index, [reads_fp], [i1_fp, i2_fp], revcomp_i2=True,
+            processes=1)
+        self.assertEqual(counts, {"S1": 1, "S2": 1})
+
+        # The index reads end early
+        with gzip.open(i2_fp, "wt") as f:
+            f.write("@r1\nGGGG\n+\nFFFF\n")
+        with self.assertRaisesRegex(ValueError, i2_fp):
+            demultiplex(
+                self.index, [reads_fp], [i1_fp, i2_fp], processes=1)
+
+    def test_demultiplex_output_dir(self):
+        output_dir = os.path.join(self.tmp_dir, "samples")
+        os.mkdir(output_dir)
+        # Running again replaces the files from the first run
+        for processes in [1, 2]:
+            demultiplex(
+                self.index, [self.fastq_fp], output_dir=output_dir,
+                processes=processes, batch_size=7)
+        self.assertEqual(
+            sorted(os.listdir(output_dir)),
+            ["S1_R1.fastq.gz", "S2_R1.fastq.gz", "S3_R1.fastq.gz"])
+        with gzip.open(os.path.join(output_dir, "S2_R1.fastq.gz"), "rt") as f:
+            lines = f.readlines()
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(
+            lines[0], "@M03543:47:C8LJ2ANXX:1:2209:1:2044 1:N:0:GGGG+TTTT\n")
+        self.assertEqual(
+            lines[4], "@M03543:47:C8LJ2ANXX:1:2209:5:2044 1:N:0:GGGG+TTTT\n")
+        with gzip.open(os.path.join(output_dir, "S3_R1.fastq.gz"), "rt") as f:
+            self.assertEqual(f.read(), "")
+
+    def test_demultiplex_run(self):
+        db = RegistryDatabase(":memory:")
+        db.create_tables()
+        db.register_run(
+            u"2016-05-11", u"Illumina-MiSeq", u"Nextera XT", 1,
+            self.fastq_fp, u"")
+        db.register_samples(1, [("S1", "AAAA-CCCC"), ("S2", "GGGG-TTTT")])
+        out = io.StringIO()
+        demultiplex_run(
+            ["1", self.fastq_fp, "--processes", "1"], db, out)
+        self.assertEqual(
+            out.getvalue(),
+            "SampleID\tread_count\nS1\t100\nS2\t50\nUnassigned\t50\n")
+
+
+class VerifyBarcodesTests(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fastq_fp = os.path.join(self.tmp_dir, "Undetermined_R1.fastq.gz")
+        # Sample S2 was registered with the second index in the wrong
+        # orientation
+        write_fastq(self.fastq_fp, ["AAAA+CCCC", "GGGG+TTTT"] * 500)
+        self.db = RegistryDatabase(":memory:")
+        self.db.create_tables()
+        self.db.register_run(
+            u"2016-05-11", u"Illumina-MiSeq", u"Nextera XT", 1,
+            self.fastq_fp, u"")
+        self.db.register_samples(1, [
+            ("S1", "AAAA-CCCC"), ("S2", "GGGG-AAAA"), ("S3", "CCCC-CCCC")])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_sample_index_seqs(self):
+        seqs = sample_index_seqs(self.fastq_fp, max_reads=100)
+        self.assertEqual(len(seqs), 100)
+        seqs = sample_index_seqs(
+            self.fastq_fp, max_reads=500, sample_size=20)
+        self.assertEqual(len(seqs), 20)
+        self.assertEqual(set(seqs), set(["AAAA+CCCC", "GGGG+TTTT"]))
+
+    def test_compare_index_seqs(self):
+        index = BarcodeIndex([("S1", "AAAA-CCCC"), ("S2", "TTTT-TTTT")])
+        seqs = ["AAAA+CCCC"] * 90 + ["GGGG+GGGG"] * 9 + ["ACAC+ACAC"]
+        sample_counts, unexpected, missing = compare_index_seqs(
+            index, seqs, min_fraction=0.05)
+        self.assertEqual(sample_counts, {"S1": 90})
+        self.assertEqual(unexpected, [("GGGG-GGGG", 0.09)])
+        self.assertEqual(missing, ["S2"])
+
+    def test_verify_barcodes(self):
+        out = io.StringIO()
+        verify_barcodes(["1"], self.db, out)
+        self.assertEqual(out.getvalue(), (
+            "Sampled 1000 reads, 500 assigned to registered samples\n"
+            "Unexpected barcode GGGG-TTTT in 50.0% of reads (matches S2 "
+            "with second index reverse complemented)\n"
+            "No reads for sample S2\n"
+            "No reads for sample S3\n"))
+
+    def test_verify_barcodes_remote_path(self):
+        remote_fp = "/remote/runs/Undetermined_R1.fastq.gz"
+        self.db.register_run(
+            u"2016-05-12", u"Illumina-MiSeq", u"Nextera XT", 1,
+            remote_fp, u"")
+        self.db.register_samples(2, [("S1", "AAAA-CCCC")])
+        out = io.StringIO()
+        verify_barcodes([
+            "2", "--local-mount", self.tmp_dir,
+            "--remote-mount", "/remote/runs"], self.db, out)
+        self.assertTrue(out.getvalue().startswith(
+            "Sampled 1000 reads, 500 assigned to registered samples\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
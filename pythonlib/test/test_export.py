@@ -0,0 +1,72 @@
+import io
+import json
+import unittest
+
+from sample_registry.db import RegistryDatabase
+from sample_registry.export import export_samples
+
+
+class ExportTests(unittest.TestCase):
+    def setUp(self):
+        self.db = RegistryDatabase(":memory:")
+        self.db.create_tables()
+        self.db.register_run(
+            u"2015-10-11", u"Illumina-MiSeq", u"Nextera XT", 1,
+            u"/data/run_file.fastq.gz", u"Bob's run")
+        self.db.register_samples(1, [
+            ("Sample2", "gcat"),
+            ("Sample1", "gcct"),
+        ])
+        self.db.register_annotations([
+            (1, "SampleType", "Feces"),
+            (1, "study_day", "3"),
+            (2, "ReversePrimerSequence", "TTAG"),
+            (2, "study_day", "1"),
+        ])
+
+    def export(self, *args):
+        out = io.StringIO()
+        export_samples(list(args) + ["1"], self.db, out)
+        return out.getvalue()
+
+    def test_export_tsv(self):
+        self.assertEqual(self.export(), EXPORT_TSV)
+
+    def test_export_qiime(self):
+        self.assertEqual(self.export("--format", "qiime"), EXPORT_QIIME)
+
+    def test_export_json(self):
+        obs = json.loads(self.export("--format", "json"))
+        self.assertEqual(obs["run"]["data_uri"], "/data/run_file.fastq.gz")
+        self.assertEqual(
+            [s["sample_name"] for s in obs["samples"]],
+            ["Sample1", "Sample2"])
+        self.assertEqual(obs["samples"][1]["sample_type"], "Feces")
+        self.assertEqual(obs["samples"][1]["study_day"], "3")
+
+    def test_export_missing_run(self):
+        self.assertRaises(
+            ValueError, export_samples, ["2"], self.db, io.StringIO())
+
+
+EXPORT_TSV = u"""\
+SampleID	Barcode	Primer	SampleType	HostSpecies	SubjectID	study_day	ReversePrimerSequence	sample_accession
+Sample1	GCCT		NA	NA	NA	1	TTAG	CMS000002
+Sample2	GCAT		Feces	NA	NA	3	NA	CMS000001
+"""
+
+EXPORT_QIIME = u"""\
+#SampleID	BarcodeSequence	LinkerPrimerSequence	SampleType	HostSpecies	SubjectID	study_day	ReversePrimer	Description
+#Bob's run
+#Sequencing date: 2015-10-11
+#File name: run_file.fastq.gz
+#Lane: 1
+#Platform: Illumina-MiSeq Nextera XT
+#Run accession: CMR000001
+Sample1	GCCT		NA	NA	NA	1	TTAG	CMS000002
+Sample2	GCAT		Feces	NA	NA	3	NA	CMS000001
+"""
+
+
+if __name__ == "__main__":
+    unittest.main()
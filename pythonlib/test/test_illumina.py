@@ -1,7 +1,12 @@
+import gzip
+import os
+import tempfile
 import unittest
 from io import StringIO
 
-from sample_registry.illumina import IlluminaFastq
+from sample_registry.illumina import (
+    IlluminaFastq, read_fastq_stats, merge_read_stats,
+)
 
 
 class IlluminaTests(unittest.TestCase):
@@ -18,3 +23,37 @@ class IlluminaTests(unittest.TestCase):
         self.assertEqual(fq.date, "2016-05-11")
         self.assertEqual(fq.lane, "1")
         self.assertEqual(fq.filepath, fastq_filepath)
+
+
+class ReadStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.fastq_fp = tempfile.mkstemp(suffix=".fastq.gz")[1]
+        with gzip.open(self.fastq_fp, "wt") as f:
+            f.write(
+                "@M03543:47:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGT\n"
+                "ACGTA\n+\nIIIII\n"
+                "@M03543:47:C8LJ2ANXX:1:2209:1084:2045 1:N:0:ACGT\n"
+                "ACG\n+\n+++\n"
+                "@M03543:47:C8LJ2ANXX:2:2209:1084:2046 1:N:0:ACGT\n"
+                "ACGT\n+\n5555\n")
+
+    def tearDown(self):
+        os.remove(self.fastq_fp)
+
+    def test_read_fastq_stats(self):
+        stats = read_fastq_stats(self.fastq_fp)
+        self.assertEqual(sorted(stats), [(1, 1), (2, 1)])
+        s = stats[(1, 1)]
+        self.assertEqual(s.read_count, 2)
+        self.assertEqual(s.base_count, 8)
+        self.assertEqual(dict(s.lengths), {5: 1, 3: 1})
+        # Five bases at Q40 and three at Q10
+        self.assertAlmostEqual(s.mean_quality, 230.0 / 8)
+        self.assertEqual(stats[(2, 1)].mean_quality, 20.0)
+
+    def test_merge_read_stats(self):
+        stats = read_fastq_stats(self.fastq_fp)
+        merged = merge_read_stats([stats, stats])
+        self.assertEqual(merged[(1, 1)].read_count, 4)
+        self.assertEqual(dict(merged[(1, 1)].lengths), {5: 2, 3: 2})
+        self.assertAlmostEqual(merged[(1, 1)].mean_quality, 230.0 / 8)
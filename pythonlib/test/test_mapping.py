@@ -1,7 +1,10 @@
 import io
 import unittest
 
-from sample_registry.mapping import SampleTable
+from sample_registry.mapping import (
+    SampleTable, SampleRecord, SampleTableValidator, write_records,
+    near_barcode_pairs,
+)
 
 
 class SampleTableTests(unittest.TestCase):
@@ -25,11 +28,62 @@ class SampleTableTests(unittest.TestCase):
         t.write(output_file)
         self.assertEqual(output_file.getvalue(), NORMAL_TSV)
 
+    def test_write_records(self):
+        header = ["SampleID", "BarcodeSequence", "HostSpecies", "SubjectID"]
+        output_file = io.StringIO()
+        # Records from a generator are written in batches
+        write_records(
+            output_file, (r for r in self.recs), header, batch_size=1)
+        self.assertEqual(output_file.getvalue(), NORMAL_TSV)
+
     def test_parse(self):
         input_file = io.StringIO(NORMAL_TSV)
         t = SampleTable.load(input_file)
         self.assertEqual(t.recs, self.recs)
 
+    def test_parse_compact(self):
+        input_file = io.StringIO(NORMAL_TSV)
+        t = SampleTable.load(input_file, compact=True)
+        self.assertEqual(t.recs, self.recs)
+        self.assertTrue(all(isinstance(r, SampleRecord) for r in t.recs))
+        # Field names are shared between records
+        self.assertIs(t.recs[0].fields, t.recs[1].fields)
+        self.assertEqual(list(t.core_info), [("S1", "GCCT"), ("S2", "GCAT")])
+
+    def test_sample_record(self):
+        input_file = io.StringIO(NORMAL_TSV)
+        r1, r2 = SampleTable.load(input_file, compact=True).recs
+        self.assertNotIn("HostSpecies", r2)
+        self.assertEqual(r2.get("HostSpecies", "x"), "x")
+        r2["study_day"] = "3"
+        self.assertEqual(dict(r2), {
+            "SampleID": "S2", "BarcodeSequence": "GCAT", "study_day": "3"})
+        self.assertNotIn("study_day", r1)
+        del r1["HostSpecies"]
+        self.assertEqual(len(r1), 3)
+        self.assertRaises(KeyError, r1.__delitem__, "HostSpecies")
+
+    def test_stream(self):
+        input_file = io.StringIO(NEXTERA_TSV)
+        recs = list(SampleTable.stream(input_file))
+        self.assertEqual(len(recs), 3)
+        self.assertEqual(recs[1]["BarcodeSequence"], u"ACTCGCTA-TATCCTCT")
+
+    def test_stream_near_barcodes(self):
+        input_file = io.StringIO(NORMAL_TSV)
+        validator = SampleTableValidator()
+        recs = list(SampleTable.stream(input_file, validator=validator))
+        self.assertEqual(len(recs), 2)
+        self.assertEqual(validator.report.warnings, [
+            "Barcodes for samples S2 (GCAT) and S1 (GCCT) differ at "
+            "only 1 position(s)"])
+
+    def test_stream_invalid(self):
+        input_file = io.StringIO(NORMAL_TSV.replace("S2", "S1"))
+        recs = SampleTable.stream(input_file)
+        self.assertEqual(next(recs)["SampleID"], "S1")
+        self.assertRaises(ValueError, next, recs)
+
     def test_validate(self):
         t = SampleTable(self.recs)
         self.assertEqual(t.validate(), None)
@@ -39,6 +93,41 @@ class SampleTableTests(unittest.TestCase):
         t = SampleTable(self.recs)
         self.assertRaises(ValueError, t.validate)
 
+    def test_validate_reports_all_errors(self):
+        self.recs[0]["SampleID"] = "1S"
+        self.recs[1]["SampleID"] = "S_2"
+        self.recs[1]["BarcodeSequence"] = "GCCT"
+        t = SampleTable(self.recs)
+        with self.assertRaises(ValueError) as cm:
+            t.validate()
+        msg = str(cm.exception)
+        self.assertIn("Found 3 errors", msg)
+        self.assertIn("Sample ID must begin with a letter", msg)
+        self.assertIn("Illegal characters in sample ID", msg)
+        self.assertIn("Duplicated barcode", msg)
+
+    def test_check_near_barcodes(self):
+        t = SampleTable(self.recs)
+        report = t.check()
+        self.assertEqual(report.errors, [])
+        self.assertEqual(report.warnings, [
+            "Barcodes for samples S2 (GCAT) and S1 (GCCT) differ at "
+            "only 1 position(s)"])
+
+    def test_near_barcode_pairs(self):
+        barcodes = ["AAAAAAAA", "AAAAAAAT", "AAAAAATT", "TTTTAAAA",
+                    "CCCCCCCC", "AAAAAAA"]
+        self.assertEqual(near_barcode_pairs(barcodes, 2), [
+            ("AAAAAAAA", "AAAAAAAT", 1),
+            ("AAAAAAAA", "AAAAAATT", 2),
+            ("AAAAAAAT", "AAAAAATT", 1),
+        ])
+        self.assertEqual(near_barcode_pairs(barcodes, 1), [
+            ("AAAAAAAA", "AAAAAAAT", 1),
+            ("AAAAAAAT", "AAAAAATT", 1),
+        ])
+        self.assertEqual(near_barcode_pairs(barcodes, 0), [])
+
     def test_look_up_nextera_barcodes(self):
         input_file = io.StringIO(NEXTERA_TSV)
         t = SampleTable.load(input_file)
@@ -46,6 +135,18 @@ class SampleTableTests(unittest.TestCase):
         self.assertEqual(t.recs[1]["BarcodeSequence"], u"ACTCGCTA-TATCCTCT")
         self.assertEqual(t.validate(), None)
 
+    def test_look_up_nextera_barcodes_reports_all_records(self):
+        input_file = io.StringIO(
+            NEXTERA_TSV.replace("N716\tS502", "N799\tS502").replace(
+                "N716\tS505", "N716\tS599"))
+        t = SampleTable.load(input_file)
+        with self.assertRaises(KeyError) as cm:
+            t.look_up_nextera_barcodes()
+        msg = str(cm.exception)
+        self.assertIn("HC.1.1.0.NA.1", msg)
+        self.assertNotIn("HC.2.2.0.NA.1", msg)
+        self.assertIn("HC.3.3.0.NA.1", msg)
+
 
 NORMAL_TSV = u"""\
 SampleID	BarcodeSequence	HostSpecies	SubjectID
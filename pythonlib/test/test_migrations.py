@@ -0,0 +1,110 @@
+import sqlite3
+import unittest
+
+from sample_registry import migrations
+
+
+class MigrationTests(unittest.TestCase):
+    def setUp(self):
+        self.con = sqlite3.connect(":memory:")
+
+    def index_names(self):
+        res = self.con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND name NOT LIKE 'sqlite_autoindex%'").fetchall()
+        return set(r[0] for r in res)
+
+    def test_migrate_new_database(self):
+        applied = migrations.migrate(self.con)
+        self.assertEqual(applied, list(range(1, migrations.LATEST_VERSION + 1)))
+        self.assertEqual(
+            migrations.schema_version(self.con), migrations.LATEST_VERSION)
+        self.assertIn("samples_run_name_barcode", self.index_names())
+        self.assertIn("samples_run_name_accession", self.index_names())
+        # Migrating again does nothing
+        self.assertEqual(migrations.migrate(self.con), [])
+
+    def test_encode_annotations_needs_latest_version(self):
+        migrations.migrate(self.con, 2)
+        self.assertRaises(
+            ValueError, migrations.encode_annotations, self.con)
+        migrations.migrate(self.con)
+        self.assertTrue(migrations.encode_annotations(self.con))
+        self.assertIn("annotation_values_key_val", self.index_names())
+
+    def test_migrate_unversioned_database(self):
+        self.con.executescript(migrations._baseline_schema())
+        self.con.execute(
+            "INSERT INTO runs "
+            "(run_date, machine_type, machine_kit, lane, data_uri, comment) "
+            "VALUES ('2015-10-11', 'HiSeq', 'Nextera XT', 1, 'a.fastq', '')")
+        self.con.commit()
+        self.assertEqual(migrations.schema_version(self.con), 0)
+
+        applied = migrations.migrate(self.con)
+        self.assertEqual(applied, list(range(2, migrations.LATEST_VERSION + 1)))
+        self.assertIn("runs_data_uri", self.index_names())
+        # Existing data is preserved
+        self.assertEqual(
+            self.con.execute("SELECT data_uri FROM runs").fetchall(),
+            [("a.fastq",)])
+
+    def test_migrate_typed_annotations(self):
+        migrations.migrate(self.con, 7)
+        self.con.execute(
+            "INSERT INTO runs "
+            "(run_date, machine_type, machine_kit, lane, data_uri, comment) "
+            "VALUES ('2015-10-11', 'HiSeq', 'Nextera XT', 1, 'a.fastq', '')")
+        self.con.execute(
+            "INSERT INTO samples (run_accession, sample_name, "
+            "barcode_sequence) VALUES (1, 'S1', 'GCCT')")
+        self.con.executemany(
+            "INSERT INTO annotations (sample_accession, `key`, `val`) "
+            "VALUES (1, ?, ?)",
+            [("day", "3"), ("collected", "2015/10/11"), ("group", "A"),
+             ("visit", "10/11/2015")])
+        self.con.commit()
+        self.assertEqual(migrations.migrate(self.con, 8), [8])
+        self.assertEqual(
+            self.con.execute(
+                "SELECT `key`, num_val, date_val FROM typed_annotations "
+                "ORDER BY `key`").fetchall(),
+            [("collected", None, "2015-10-11"), ("day", 3.0, None)])
+
+    def test_migrate_to_target(self):
+        self.assertEqual(migrations.migrate(self.con, 1), [1])
+        self.assertEqual(self.index_names(), set())
+        self.assertRaises(
+            ValueError, migrations.migrate, self.con,
+            migrations.LATEST_VERSION + 1)
+
+    def test_failed_script_is_rolled_back(self):
+        migrations.migrate(self.con)
+        self.assertRaises(
+            sqlite3.OperationalError, migrations._execute_in_transaction,
+            self.con, "CREATE TABLE t (x);\nINSERT INTO missing VALUES (1);")
+        self.assertFalse(self.con.in_transaction)
+        self.assertEqual(self.con.execute(
+            "SELECT COUNT(*) FROM sqlite_master WHERE name = 't'").fetchone(),
+            (0,))
+
+    def test_time_hot_queries(self):
+        # A new database has no tables yet
+        self.assertEqual(migrations.time_hot_queries(self.con), None)
+        migrations.migrate(self.con)
+        self.assertEqual(migrations.time_hot_queries(self.con), None)
+        self.con.execute(
+            "INSERT INTO runs "
+            "(run_date, machine_type, machine_kit, lane, data_uri, comment) "
+            "VALUES ('2015-10-11', 'HiSeq', 'Nextera XT', 1, 'a.fastq', '')")
+        self.con.execute(
+            "INSERT INTO samples (run_accession, sample_name, "
+            "barcode_sequence) VALUES (1, 'S1', 'GCCT')")
+        timings = migrations.time_hot_queries(self.con, number=1)
+        self.assertEqual(
+            [desc for desc, _ in timings],
+            [desc for desc, _ in migrations.HOT_QUERIES])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import io
+import unittest
+
+from sample_registry.db import RegistryDatabase
+from sample_registry.query import (
+    All, Any, Between, Equals, SampleQuery, parse_predicate, query_samples,
+    )
+
+
+class SampleQueryTests(unittest.TestCase):
+    def setUp(self):
+        self.db = RegistryDatabase(":memory:")
+        self.db.create_tables()
+        self.db.register_run(
+            u"2015-10-11", u"Illumina-MiSeq", u"Nextera XT", 1,
+            u"/data/run1.fastq.gz", u"Bob's run")
+        self.db.register_run(
+            u"2015-11-12", u"Illumina-MiSeq", u"Nextera XT", 1,
+            u"/data/run2.fastq.gz", u"Alice's run")
+        self.db.register_samples(1, [("S1", "AAAA"), ("S2", "CCCC")])
+        self.db.register_samples(2, [("S3", "GGGG"), ("S4", "TTTT")])
+        self.db.register_annotations([
+            (1, "SampleType", "Feces"),
+            (1, "study_group", "A"),
+            (1, "study_day", "3"),
+            (2, "SampleType", "Oral swab"),
+            (2, "study_group", "A"),
+            (2, "study_day", "10"),
+            (3, "SampleType", "Feces"),
+            (3, "study_group", "B"),
+            (3, "study_day", "7"),
+            (4, "SampleType", "Feces"),
+            (4, "SubjectID", "Subj1"),
+            (4, "study_group", "A"),
+            ])
+        self.query = SampleQuery(self.db)
+
+    def accessions(self, predicate):
+        return self.query.sample_accessions(predicate)
+
+    def test_equals(self):
+        self.assertEqual(
+            self.accessions(Equals("SampleType", "Feces")), [1, 3, 4])
+        self.assertEqual(
+            self.accessions(Equals("sample_type", "Feces")), [1, 3, 4])
+        self.assertEqual(
+            self.accessions(Equals("study_group", "A")), [1, 2, 4])
+        self.assertEqual(self.accessions(Equals("study_group", "C")), [])
+        self.assertEqual(self.accessions(Equals("missing_key", "A")), [])
+
+    def test_between(self):
+        self.assertEqual(self.accessions(Between("study_day", 3, 7)), [1, 3])
+        self.assertEqual(self.accessions(Between("study_day", low=5)), [2, 3])
+
+    def test_check_in_chunks(self):
+        sample_accessions = list(range(1, 2001))
+        self.assertEqual(
+            Between("study_day", 3, 7)._check(self.query, sample_accessions),
+            [1, 3])
+        self.assertEqual(
+            Equals("study_group", "A")._check(self.query, sample_accessions),
+            [1, 2, 4])
+
+    def test_all_and_any(self):
+        feces_a = All(
+            Equals("SampleType", "Feces"), Equals("study_group", "A"))
+        self.assertEqual(self.accessions(feces_a), [1, 4])
+        self.assertEqual(
+            self.accessions(All(feces_a, Between("study_day", high=5))), [1])
+        self.assertEqual(
+            self.accessions(Any(
+                Equals("SubjectID", "Subj1"), Between("study_day", 8, 20))),
+            [2, 4])
+        self.assertEqual(
+            self.accessions(All(
+                Equals("study_group", "A"),
+                Any(Equals("SubjectID", "Subj1"),
+                    Equals("SampleType", "Oral swab")))),
+            [2, 4])
+        self.assertEqual(
+            self.accessions(All(
+                Equals("study_group", "B"), Equals("study_group", "A"))),
+            [])
+        self.assertRaises(ValueError, All)
+
+    def test_iter_samples(self):
+        samples = list(self.query.iter_samples(
+            All(Equals("SampleType", "Feces"), Equals("study_group", "A"))))
+        self.assertEqual(
+            [(s["sample_name"], s["run_accession"], s["run_comment"])
+             for s in samples],
+            [("S1", 1, "Bob's run"), ("S4", 2, "Alice's run")])
+        self.assertEqual(samples[1]["subject_id"], "Subj1")
+
+    def test_encoded_annotations(self):
+        self.db.encode_annotations()
+        query = SampleQuery(self.db)
+        self.assertEqual(
+            query.sample_accessions(All(
+                Equals("SampleType", "Feces"), Equals("study_group", "A"))),
+            [1, 4])
+        self.assertEqual(
+            query.sample_accessions(Equals("study_group", "C")), [])
+
+    def test_parse_predicate(self):
+        self.assertEqual(
+            repr(parse_predicate("study_group=A=B")),
+            "Equals('study_group', 'A=B')")
+        self.assertEqual(
+            repr(parse_predicate("study_day>=3")),
+            "Between('study_day', 3.0, None)")
+        self.assertEqual(
+            repr(parse_predicate("collected<=2015-10-11")),
+            "Between('collected', None, '2015-10-11')")
+        self.assertRaises(ValueError, parse_predicate, "study_group")
+
+    def test_query_samples(self):
+        out = io.StringIO()
+        query_samples(["SampleType=Feces", "study_day<=5"], self.db, out)
+        self.assertEqual(out.getvalue(), (
+            "SampleID\tsample_accession\trun_accession\trun_date\tlane\t"
+            "data_uri\n"
+            "S1\tCMS000001\tCMR000001\t2015-10-11\t1\t/data/run1.fastq.gz\n"))
+
+        out = io.StringIO()
+        query_samples(
+            ["--any", "study_group=B", "SubjectID=Subj1"], self.db, out)
+        self.assertEqual(
+            [line.split("\t")[0] for line in out.getvalue().splitlines()],
+            ["SampleID", "S3", "S4"])
+
+
+if __name__ == "__main__":
+    unittest.main()
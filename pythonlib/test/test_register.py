@@ -4,14 +4,19 @@ import os
 import shutil
 import tempfile
 import unittest
+from unittest import mock
 
+from sample_registry import migrations
+from sample_registry.barcodes import index_kits
 from sample_registry.db import RegistryDatabase
 from sample_registry.mapping import SampleTable
 from sample_registry.register import (
     register_run, register_sample_annotations,
-    unregister_samples, register_illumina_file,
+    unregister_samples, register_illumina_file, register_illumina_dir,
     register_sample_types,
     register_host_species,
+    migrate_database, fingerprint_runs, audit_run_files,
+    rebuild_statistics, encode_annotations,
 )
 
 
@@ -80,6 +85,213 @@ class RegisterScriptTests(unittest.TestCase):
 
         self.assertEqual(self.db.query_run_file(1), relative_fp)
 
+    def test_register_illumina_file_with_stats(self):
+        tmp_dir = tempfile.mkdtemp()
+        fastq_dir = (
+            "Miseq/160511_M03543_0047_000000000-APE6Y/Data/Intensities/"
+            "BaseCalls")
+        os.makedirs(os.path.join(tmp_dir, fastq_dir))
+        fps = []
+        for read in ["1", "2"]:
+            fp = os.path.join(
+                fastq_dir, "Undetermined_S0_L001_R{0}_001.fastq.gz".format(read))
+            f = gzip.open(os.path.join(tmp_dir, fp), "wt")
+            f.write(
+                "@M03543:21:C8LJ2ANXX:1:2209:1084:2044 {0}:N:0:ACGT\n"
+                "ACGTAC\n+\nIIIII5\n".format(read))
+            f.close()
+            fps.append(fp)
+
+        out = io.StringIO()
+        original_cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            register_illumina_file(
+                [fps[0], "abcd efg", "--stats", "--stats-file", fps[1]],
+                self.db, out)
+        finally:
+            os.chdir(original_cwd)
+            shutil.rmtree(tmp_dir)
+
+        stats = self.db.query_read_stats(1)
+        self.assertEqual(
+            [(s["lane"], s["read_number"]) for s in stats], [(1, 1), (1, 2)])
+        self.assertEqual(stats[0]["read_count"], 1)
+        self.assertEqual(stats[0]["base_count"], 6)
+        self.assertAlmostEqual(stats[0]["mean_quality"], 220.0 / 6)
+        self.assertEqual(stats[1]["lengths"], {6: 1})
+
+    def test_register_illumina_dir(self):
+        tmp_dir = tempfile.mkdtemp()
+        run_dir = "Miseq/160511_M03543_0047_000000000-APE6Y"
+        fastq_dir = os.path.join(run_dir, "Data/Intensities/BaseCalls")
+        os.makedirs(os.path.join(tmp_dir, fastq_dir))
+        headers = {
+            "Undetermined_S0_L001_R2_001.fastq.gz":
+            "@M03543:47:C8LJ2ANXX:1:2209:1084:2044 2:N:0:NNNNNNNN+NNNNNNNN",
+            "Undetermined_S0_L001_R1_001.fastq.gz":
+            "@M03543:47:C8LJ2ANXX:1:2209:1084:2044 1:N:0:NNNNNNNN+NNNNNNNN",
+            "Undetermined_S0_L002_R1_001.fastq.gz":
+            "@M03543:47:C8LJ2ANXX:2:2209:1084:2044 1:N:0:NNNNNNNN+NNNNNNNN",
+        }
+        for fastq_name, header in headers.items():
+            f = gzip.open(os.path.join(tmp_dir, fastq_dir, fastq_name), "wt")
+            f.write(header)
+            f.close()
+
+        out = io.StringIO()
+        original_cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            register_illumina_dir(
+                [run_dir, "abcd efg", "--processes", "2"], self.db, out)
+            # Registering the directory again skips both lanes
+            out2 = io.StringIO()
+            register_illumina_dir([run_dir, "abcd efg"], self.db, out2)
+        finally:
+            os.chdir(original_cwd)
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(
+            self.db.query_run_file(1),
+            os.path.join(fastq_dir, "Undetermined_S0_L001_R1_001.fastq.gz"))
+        self.assertEqual(
+            self.db.query_run_file(2),
+            os.path.join(fastq_dir, "Undetermined_S0_L002_R1_001.fastq.gz"))
+        self.assertEqual(self.db.query_run(2)["lane"], 2)
+        self.assertEqual(self.db.query_run(2)["run_date"], "2016-05-11")
+        self.assertFalse(self.db.query_run_exists(3))
+        self.assertEqual(out2.getvalue(), (
+            "Flow cell C8LJ2ANXX lane 1 already registered as run 1\n"
+            "Flow cell C8LJ2ANXX lane 2 already registered as run 2\n"))
+
+    def test_register_illumina_dir_moved_data(self):
+        tmp_dir = tempfile.mkdtemp()
+        fastq_name = "Undetermined_S0_L001_R1_001.fastq.gz"
+        run_dirs = [
+            "Miseq/160511_M03543_0047_000000000-APE6Y",
+            "Moved/160511_M03543_0047_000000000-APE6Y",
+        ]
+        for run_dir in run_dirs:
+            os.makedirs(os.path.join(tmp_dir, run_dir))
+            f = gzip.open(os.path.join(tmp_dir, run_dir, fastq_name), "wt")
+            f.write(
+                "@M03543:47:C8LJ2ANXX:1:2209:1084:2044 1:N:0:ACGT\n"
+                "ACGT\n+\nIIII\n")
+            f.close()
+
+        out = io.StringIO()
+        original_cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            register_illumina_dir([run_dirs[0], "abcd efg"], self.db, out)
+            out = io.StringIO()
+            register_illumina_dir([run_dirs[1], "abcd efg"], self.db, out)
+        finally:
+            os.chdir(original_cwd)
+            shutil.rmtree(tmp_dir)
+
+        self.assertFalse(self.db.query_run_exists(2))
+        self.assertEqual(out.getvalue(), (
+            "Flow cell C8LJ2ANXX lane 1 already registered as run 1 "
+            "(matching fingerprint)\n"))
+
+    def test_register_illumina_dir_duplicated_data(self):
+        tmp_dir = tempfile.mkdtemp()
+        run_dir = "Miseq/160511_M03543_0047_000000000-APE6Y"
+        os.makedirs(os.path.join(tmp_dir, run_dir))
+        for lane in ["1", "2"]:
+            fastq_name = "Undetermined_S0_L00{0}_R1_001.fastq.gz".format(lane)
+            f = gzip.open(os.path.join(tmp_dir, run_dir, fastq_name), "wt")
+            f.write("@M03543:47:C8LJ2ANXX:{0}:2209:1084:2044 1:N:0:ACGT\n"
+                    "ACGT\n+\nIIII\n".format(lane))
+            f.close()
+
+        out = io.StringIO()
+        original_cwd = os.getcwd()
+        os.chdir(tmp_dir)
+        try:
+            # Both lanes have the same fingerprint
+            with mock.patch(
+                    "sample_registry.register.file_fingerprint",
+                    return_value="100:abc"):
+                register_illumina_dir([run_dir, "abcd efg"], self.db, out)
+        finally:
+            os.chdir(original_cwd)
+            shutil.rmtree(tmp_dir)
+
+        self.assertTrue(self.db.query_run_exists(1))
+        self.assertFalse(self.db.query_run_exists(2))
+        self.assertEqual(out.getvalue(), (
+            "Flow cell C8LJ2ANXX lane 2 has the same data as flow cell "
+            "C8LJ2ANXX lane 1 (matching fingerprint)\n"
+            "Registered run 1 in the database\n"))
+
+    def test_fingerprint_runs(self):
+        tmp_dir = tempfile.mkdtemp()
+        for fp in ["abc", "def"]:
+            with open(os.path.join(tmp_dir, fp), "w") as f:
+                f.write("Same data")
+        for fp in ["/data/abc", "/data/def", "/data/ghi"]:
+            self.db.register_run(
+                "2008-09-21", "Illumina-MiSeq", "Nextera XT", 1, fp, "")
+
+        out = io.StringIO()
+        try:
+            fingerprint_runs([
+                "--local-mount", tmp_dir, "--remote-mount", "/data",
+                "--threads", "2"], self.db, out)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertEqual(out.getvalue(), (
+            "Data file for run 3 not found: {0}/ghi\n"
+            "Fingerprinted 2 runs\n"
+            "Runs with the same data: 1, 2\n".format(tmp_dir)))
+        self.assertEqual(
+            self.db.query_runs_without_fingerprint(), [(3, "/data/ghi")])
+
+    def test_audit_run_files(self):
+        tmp_dir = tempfile.mkdtemp()
+        for fp in ["abc", "def"]:
+            with open(os.path.join(tmp_dir, fp), "w") as f:
+                f.write("Data")
+        for fp in ["/data/abc", "/data/def", "/data/ghi"]:
+            self.db.register_run(
+                "2008-09-21", "Illumina-MiSeq", "Nextera XT", 1, fp, "")
+        args = ["--local-mount", tmp_dir, "--remote-mount", "/data"]
+
+        try:
+            out = io.StringIO()
+            audit_run_files(args, self.db, out)
+            self.assertEqual(out.getvalue(), (
+                "Run 3: data file missing: {0}/ghi\n"
+                "Checked 3 runs, found 1 problems\n".format(tmp_dir)))
+
+            # Only the run with a problem is checked again
+            with open(os.path.join(tmp_dir, "def"), "a") as f:
+                f.write("More data")
+            out = io.StringIO()
+            audit_run_files(args, self.db, out)
+            self.assertEqual(out.getvalue(), (
+                "Run 3: data file missing: {0}/ghi\n"
+                "Checked 1 runs, found 1 problems\n".format(tmp_dir)))
+
+            # Stale entries are checked again
+            out = io.StringIO()
+            audit_run_files(args + ["--max-age", "0"], self.db, out)
+            self.assertEqual(out.getvalue(), (
+                "Run 2: data file size changed from 4 to 13: {0}/def\n"
+                "Run 3: data file missing: {0}/ghi\n"
+                "Checked 3 runs, found 2 problems\n".format(tmp_dir)))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        audits = self.db.query_file_audits()
+        self.assertEqual(
+            [(a["status"], a["file_size"]) for a in audits],
+            [("ok", 4), ("changed", 4), ("missing", None)])
+
     def test_register_samples(self):
         register_run(self.run_args, self.db)
         out = io.StringIO()
@@ -97,6 +309,25 @@ class RegisterScriptTests(unittest.TestCase):
             self.db.query_sample_annotations(1),
             {"SampleType": "Oral swab", "bb": "cd e29"})
 
+    def test_register_samples_index_kit(self):
+        register_run(self.run_args, self.db)
+        samples = [{
+            "SampleID": "abc123",
+            "barcode_index_fwd": "X1",
+            "barcode_index_rev": "S502",
+            }]
+        sample_file = temp_sample_file(samples)
+        kit_file = tempfile.NamedTemporaryFile(mode="wt", suffix=".tsv")
+        kit_file.write("X1\tACGTACGT\n")
+        kit_file.flush()
+        args = ["1", sample_file.name, "--index-kit", kit_file.name]
+        register_sample_annotations(args, True, self.db)
+        self.assertEqual(
+            self.db.query_sample_barcodes(1),
+            [("abc123", "ACGTACGT-CTCTCTAT")])
+        # Kits from the command line are not kept for later calls
+        self.assertNotIn("X1", index_kits().barcodes)
+
     def test_register_annotations(self):
         register_run(self.run_args, self.db)
         sample_file = temp_sample_file(self.samples)
@@ -111,10 +342,19 @@ class RegisterScriptTests(unittest.TestCase):
         del modified_samples[0]["bb"]
         sample_file = temp_sample_file(modified_samples)
         args = ["1", sample_file.name]
+        statements = []
+        self.db.con.set_trace_callback(statements.append)
         register_sample_annotations(args, False, self.db)
+        self.db.con.set_trace_callback(None)
 
         self.assertEqual(
             self.db.query_sample_annotations(1), new_annotations)
+        # The search index is rebuilt once, with the new annotations
+        self.assertEqual(
+            len([x for x in statements
+                 if x.startswith("DELETE FROM sample_search")]), 1)
+        self.assertEqual(len(self.db.search_samples("hi5")), 1)
+        self.assertEqual(self.db.search_samples("e29"), [])
 
     def test_unregister_samples(self):
         register_run(self.run_args, self.db)
@@ -127,6 +367,47 @@ class RegisterScriptTests(unittest.TestCase):
         self.assertEqual(self.db._query_nonstandard_annotations(1), {})
         self.assertEqual(self.db.query_sample_accessions(1), [])
 
+    def test_migrate_database(self):
+        out = io.StringIO()
+        migrate_database(["--timings"], self.db, out)
+        self.assertTrue(out.getvalue().startswith("Database is up to date"))
+
+        # A new database is created from scratch
+        out = io.StringIO()
+        migrate_database(["--timings"], RegistryDatabase(":memory:"), out)
+        self.assertEqual(out.getvalue(), (
+            "Upgraded database from version 0 to {0}\n"
+            "No samples in database, timings not available\n".format(
+                migrations.LATEST_VERSION)))
+
+    def test_rebuild_statistics(self):
+        register_run(self.run_args, self.db)
+        sample_file = temp_sample_file(self.samples)
+        register_sample_annotations(
+            ["1", sample_file.name], True, self.db, io.StringIO())
+        out = io.StringIO()
+        rebuild_statistics([], self.db, out)
+        self.assertEqual(out.getvalue(), "Rebuilt statistics for 1 samples\n")
+        self.assertEqual(
+            self.db.query_sample_value_counts("sample_type"), {"Oral swab": 1})
+
+    def test_encode_annotations(self):
+        register_run(self.run_args, self.db)
+        sample_file = temp_sample_file(self.samples)
+        register_sample_annotations(
+            ["1", sample_file.name], True, self.db, io.StringIO())
+        out = io.StringIO()
+        encode_annotations([], self.db, out)
+        encode_annotations(["--decode"], self.db, out)
+        encode_annotations(["--decode"], self.db, out)
+        self.assertEqual(out.getvalue(), (
+            "Annotations are now dictionary-encoded\n"
+            "Annotations are now stored as plain text\n"
+            "Annotations are already stored as plain text\n"))
+        self.assertEqual(
+            self.db.query_sample_annotations(1),
+            {"SampleType": "Oral swab", "bb": "cd e29"})
+
     def test_register_sample_types(self):
         f = tempfile.NamedTemporaryFile("wt")
         f.write(SAMPLE_TYPES_TSV)
@@ -1,10 +1,15 @@
 import collections
+import gzip
 import io
+import os
+import tempfile
 import unittest
 
 from sample_registry.util import (
     key_by_attr, dict_from_eav, local_filepath,
     parse_fasta, parse_fastq, deambiguate, reverse_complement,
+    parse_fastq_batches, count_fastq, open_gzip, AmbiguousPattern,
+    reverse_complement_many, file_fingerprint, fingerprint_size, typed_value,
     )
 
 class UtilTests(unittest.TestCase):
@@ -43,6 +48,53 @@ class UtilTests(unittest.TestCase):
         self.assertEqual(
             local_filepath("/abc/def", None, "/jhsdf"), "/abc/def")
 
+    def test_file_fingerprint(self):
+        fd, fp = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(b"A" * 1000)
+            before = file_fingerprint(fp, block_size=10)
+            self.assertEqual(fingerprint_size(before), 1000)
+            # Bytes between the sampled blocks are not part of the
+            # fingerprint
+            with open(fp, "r+b") as f:
+                f.seek(500)
+                f.write(b"G")
+            self.assertEqual(file_fingerprint(fp, block_size=10), before)
+            # Bytes in the last block are
+            with open(fp, "r+b") as f:
+                f.seek(999)
+                f.write(b"T")
+            self.assertNotEqual(file_fingerprint(fp, block_size=10), before)
+            # Small files are hashed in full
+            self.assertNotEqual(
+                file_fingerprint(fp, block_size=1000),
+                file_fingerprint(fp, block_size=10))
+            self.assertRaises(
+                ValueError, file_fingerprint, fp, block_size=10,
+                num_blocks=1)
+        finally:
+            os.remove(fp)
+
+    def test_typed_value(self):
+        self.assertEqual(typed_value("12"), (12.0, None))
+        self.assertEqual(typed_value(" -1.5e2 "), (-150.0, None))
+        self.assertEqual(typed_value("2015-10-11"), (None, "2015-10-11"))
+        self.assertEqual(typed_value("2015/10/11"), (None, "2015-10-11"))
+        # Month and day are ambiguous unless the year comes first
+        self.assertEqual(typed_value("10/11/2015"), None)
+        self.assertEqual(
+            typed_value("2015/10/11 08:30"), (None, "2015-10-11"))
+        self.assertEqual(
+            typed_value("2015-10-11T08:30:15"), (None, "2015-10-11"))
+        # Only a time is dropped after the date
+        self.assertEqual(typed_value("2015-10-11 foo"), None)
+        self.assertEqual(typed_value("2015-10-11 25:00"), None)
+        self.assertEqual(typed_value("NA"), None)
+        self.assertEqual(typed_value("nan"), None)
+        self.assertEqual(typed_value("1,000"), None)
+        self.assertEqual(typed_value("2015-02-30"), None)
+
     def test_parse_fasta(self):
         obs = parse_fasta(io.StringIO(fasta1))
         self.assertEqual(next(obs), ("seq1 hello", "ACGTGGGTTAA"))
@@ -58,6 +110,53 @@ class UtilTests(unittest.TestCase):
             "Seq2:with spaces", "GCTNNNNNNNNNNNNNNN", "##################"))
         self.assertRaises(StopIteration, next, obs)
 
+    def test_parse_fastq_batches(self):
+        exp = [
+            (b"YesYes", b"AGGGCCTTGGTGGTTAG", b";234690GSDF092384"),
+            (b"Seq2:with spaces", b"GCTNNNNNNNNNNNNNNN",
+             b"##################"),
+        ]
+        # Blocks smaller than a record
+        batches = parse_fastq_batches(
+            io.BytesIO(fastq1.encode("ascii")), block_size=7)
+        self.assertEqual([r for b in batches for r in b], exp)
+        # No newline at end of file
+        batches = parse_fastq_batches(
+            io.BytesIO(fastq1.rstrip().encode("ascii")))
+        self.assertEqual([r for b in batches for r in b], exp)
+        # Decoded to text
+        batches = list(parse_fastq_batches(
+            io.BytesIO(fastq1.encode("ascii")), decode=True))
+        self.assertEqual(batches[0][0], (
+            "YesYes", "AGGGCCTTGGTGGTTAG", ";234690GSDF092384"))
+
+    def test_parse_fastq_batches_incomplete(self):
+        f = io.BytesIO(fastq1.encode("ascii")[:-25])
+        self.assertRaises(ValueError, list, parse_fastq_batches(f))
+
+    def test_count_fastq(self):
+        data = fastq1.encode("ascii")
+        self.assertEqual(count_fastq(io.BytesIO(data), block_size=5), 2)
+        self.assertEqual(count_fastq(io.BytesIO(data.rstrip())), 2)
+        self.assertEqual(count_fastq(io.BytesIO(b"")), 0)
+
+    def test_open_gzip(self):
+        tmp_dir = tempfile.mkdtemp()
+        fp = os.path.join(tmp_dir, "reads.fastq.gz")
+        with gzip.open(fp, "wt") as f:
+            f.write(fastq1 * 1000)
+        try:
+            for method in ["auto", "thread"]:
+                with open_gzip(fp, method) as f:
+                    self.assertEqual(count_fastq(f, block_size=1000), 2000)
+            # Close before reading to the end
+            f = open_gzip(fp, "thread")
+            f.read(10)
+            f.close()
+        finally:
+            os.remove(fp)
+            os.rmdir(tmp_dir)
+
     def test_deambiguate(self):
         obs = set(deambiguate("AYGR"))
         exp = set(["ACGA", "ACGG", "ATGA", "ATGG"])
@@ -67,9 +166,45 @@ class UtilTests(unittest.TestCase):
         exp = set(["AGA", "AGC", "AGG", "AGT"])
         self.assertEqual(obs, exp)
 
+    def test_ambiguous_pattern(self):
+        p = AmbiguousPattern("aygr")
+        for seq in deambiguate("AYGR"):
+            self.assertTrue(p.matches(seq))
+            self.assertTrue(p.matches(seq + "TTT"))
+        self.assertFalse(p.matches("AAGA"))
+        self.assertFalse(p.matches("ACG"))
+        self.assertFalse(p.matches("NCGA"))
+
+    def test_ambiguous_pattern_mismatches(self):
+        p = AmbiguousPattern("NNNNACGTRY")
+        self.assertEqual(p.mismatches("GGGGACGTGC"), 0)
+        self.assertEqual(p.mismatches("GGGGTCGTCC"), 2)
+        self.assertEqual(p.mismatches("GGGGTCGTCC", max_mismatches=0), 1)
+        self.assertEqual(p.mismatches("GGGGACGT"), 2)
+        self.assertTrue(p.matches("GGGGTCGTGC", max_mismatches=1))
+        self.assertFalse(p.matches("GGGGTCGTCC", max_mismatches=1))
+        self.assertEqual(
+            p.match_many(["AAAAACGTAT", "AAAAACGTAA", "CCCCTCGTGC"]),
+            [True, False, False])
+        self.assertEqual(
+            p.match_many(
+                ["AAAAACGTAT", "AAAAACGTAA", "CCCCTCGTTA"],
+                max_mismatches=1),
+            [True, True, False])
+
     def test_reverse_complement(self):
         self.assertEqual(reverse_complement("AGATC"), "GATCT")
-        self.assertRaises(KeyError, reverse_complement, "ANCC")
+        self.assertEqual(reverse_complement("ANCC"), "GGNT")
+        self.assertEqual(reverse_complement("RYKMSWBDHVN"), "NBDHVWSKMRY")
+        self.assertEqual(reverse_complement("acgT-Ggn"), "ncC-Acgt")
+        self.assertEqual(reverse_complement(b"AGATCN"), b"NGATCT")
+        self.assertRaises(KeyError, reverse_complement, "AXCC")
+        self.assertRaises(KeyError, reverse_complement, b"AXCC")
+
+    def test_reverse_complement_many(self):
+        self.assertEqual(
+            reverse_complement_many(["AGATC", "TTGN"]), ["GATCT", "NCAA"])
+        self.assertEqual(reverse_complement_many([b"AAC"]), [b"GTT"])
 
 
 fasta1 = u"""\
@@ -129,6 +129,7 @@ function show_run() {
     $keyed_metadata = key_by_attribute(
         $sample_metadata, "sample_accession");
     set('run', $run);
+    set('read_stats', query_run_read_stats($run_accession));
     set('samples', $samples);
     set('sample_metadata', $keyed_metadata);
     return html('show_run_samples.html.php');
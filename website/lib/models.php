@@ -15,6 +15,14 @@ function query_run($run_accession) {
         ->find_one();
 }
 
+function query_run_read_stats($run_accession) {
+    return ORM::for_table('run_read_stats')
+        ->where_equal('run_accession', $run_accession)
+        ->order_by_asc('lane')
+        ->order_by_asc('read_number')
+        ->find_many();
+}
+
 /* Sample */
 
 function query_sample($sample_accession) {
@@ -41,7 +49,13 @@ function query_samples_list($sample_accessions) {
 }
 
 function query_sample_match($partial_name) {
+    # The full-text index narrows the search to samples with a matching
+    # sequence of words in their name, then LIKE checks the start.
+    $match = '{sample_name} : ("' . str_replace('"', '""', $partial_name) . '"*)';
     return ORM::for_table('runs_samples')
+        ->where_raw(
+            'sample_accession IN (SELECT rowid FROM sample_search WHERE sample_search MATCH ?)',
+            array($match))
         ->where_like('sample_name', $partial_name . "%")
         ->find_many();
 }
@@ -122,108 +136,111 @@ function query_tags() {
 
 /* Stats */
 
+# Counts are read from summary tables, which the database keeps up to
+# date as samples and annotations are registered.
+
+function query_registry_count($name) {
+    $row = ORM::for_table('registry_counts')
+        ->where_equal('name', $name)
+        ->find_one();
+    return $row ? (int) $row->value : 0;
+}
+
 function query_total_samples() {
-    return ORM::for_table('samples')->count();
+    return query_registry_count('samples');
 }
 
 function query_total_sampletypes() {
-    return ORM::for_table('samples')
-        ->where_not_null('sample_type')
-        ->count();
+    return query_registry_count('samples_with_sample_type');
 }
 
 function query_total_standard_sampletypes() {
-    return ORM::for_table('samples')
+    return (int) ORM::for_table('sample_value_counts')
         ->join('standard_sample_types', array(
-            'samples.sample_type', '=', 'standard_sample_types.sample_type'))
-        ->count();
+            'sample_value_counts.value', '=', 'standard_sample_types.sample_type'))
+        ->where_equal('sample_value_counts.field', 'sample_type')
+        ->sum('sample_value_counts.sample_count');
 }
 
 function query_standard_sampletype_counts() {
     return ORM::for_table('standard_sample_types')
         ->select_many_expr(array(
             'sample_type' => 'standard_sample_types.sample_type',
-            'num_samples' => 'COUNT(samples.sample_accession)',
+            'num_samples' => 'COALESCE(sample_value_counts.sample_count, 0)',
             'host_associated' => 'standard_sample_types.host_associated'))
-        ->left_outer_join('samples', array(
-            'standard_sample_types.sample_type', '=', 'samples.sample_type'))
-        ->group_by('standard_sample_types.sample_type')
+        ->left_outer_join('sample_value_counts',
+            "sample_value_counts.field = 'sample_type' AND " .
+            "sample_value_counts.value = standard_sample_types.sample_type")
         ->order_by_desc('num_samples')
         ->find_many();
 }
 
 function query_nonstandard_sampletype_counts() {
-    return ORM::for_table('samples')
+    return ORM::for_table('sample_value_counts')
         ->select_many_expr(array(
-            'sample_type' => 'samples.sample_type',
-            'num_samples' => 'COUNT(samples.sample_accession)'))
+            'sample_type' => 'sample_value_counts.value',
+            'num_samples' => 'sample_value_counts.sample_count'))
         ->left_outer_join('standard_sample_types', array(
-            'samples.sample_type', '=', 'standard_sample_types.sample_type'))
-	->where_null('standard_sample_types.sample_type')
-        ->group_by('samples.sample_type')
+            'sample_value_counts.value', '=', 'standard_sample_types.sample_type'))
+        ->where_equal('sample_value_counts.field', 'sample_type')
+        ->where_null('standard_sample_types.sample_type')
         ->order_by_desc('num_samples')
         ->find_many();
 }
 
 function query_num_subjectid() {
-    return ORM::for_table('samples')->where_not_null('subject_id')->count();
+    return query_registry_count('samples_with_subject_id');
 }
 
 function query_num_subjectid_with_hostspecies() {
-    return ORM::for_table('samples')
-        ->where_not_null('subject_id')
-        ->where_not_null('host_species')
-        ->count();
+    return query_registry_count('samples_with_subject_id_and_host_species');
 }
 
 function query_total_hostspecies() {
-    return ORM::for_table('samples')->where_not_null('host_species')->count();
+    return query_registry_count('samples_with_host_species');
 }
 
 function query_total_standard_hostspecies() {
-    return ORM::for_table('samples')
+    return (int) ORM::for_table('sample_value_counts')
         ->join('standard_host_species', array(
-            'samples.host_species', '=', 'standard_host_species.host_species'))
-        ->count();
+            'sample_value_counts.value', '=', 'standard_host_species.host_species'))
+        ->where_equal('sample_value_counts.field', 'host_species')
+        ->sum('sample_value_counts.sample_count');
 }
 
 function query_standard_hostspecies_counts() {
     return ORM::for_table('standard_host_species')
         ->select_many_expr(array(
             'host_species' => 'standard_host_species.host_species',
-            'num_samples' => 'COUNT(samples.sample_accession)',
+            'num_samples' => 'COALESCE(sample_value_counts.sample_count, 0)',
             'ncbi_taxon_id' => 'standard_host_species.ncbi_taxon_id'))
-        ->left_outer_join('samples', array(
-            'standard_host_species.host_species', '=', 'samples.host_species'))
-        ->group_by('standard_host_species.host_species')
+        ->left_outer_join('sample_value_counts',
+            "sample_value_counts.field = 'host_species' AND " .
+            "sample_value_counts.value = standard_host_species.host_species")
         ->order_by_desc('num_samples')
         ->find_many();
 }
 
 function query_nonstandard_hostspecies_counts() {
-    return ORM::for_table('samples')
+    return ORM::for_table('sample_value_counts')
         ->select_many_expr(array(
-            'host_species' => 'samples.host_species',
-            'num_samples' => 'COUNT(samples.sample_accession)'))
+            'host_species' => 'sample_value_counts.value',
+            'num_samples' => 'sample_value_counts.sample_count'))
         ->left_outer_join('standard_host_species', array(
-            'samples.host_species', '=', 'standard_host_species.host_species'))
+            'sample_value_counts.value', '=', 'standard_host_species.host_species'))
+        ->where_equal('sample_value_counts.field', 'host_species')
         ->where_null('standard_host_species.host_species')
-        ->where_not_null('samples.host_species')
-        ->group_by('samples.host_species')
         ->order_by_desc('num_samples')
         ->find_many();
 }
 
 function query_num_primer() {
-    return ORM::for_table('samples')
-        ->where_not_equal('primer_sequence', '')
-        ->count();
+    return query_registry_count('samples_with_primer');
 }
 
 function query_num_reverse_primer() {
-    return ORM::for_table('annotations')
-        ->distinct()
-        ->select('sample_accession')
-        ->where('key', 'ReversePrimerSequence')
-        ->count();
+    $row = ORM::for_table('annotation_key_counts')
+        ->where_equal('key', 'ReversePrimerSequence')
+        ->find_one();
+    return $row ? (int) $row->key_count : 0;
 }
@@ -9,6 +9,13 @@
     <li><strong>Lane:</strong> <?= $run->lane ?></li>
     <li><strong>Platform:</strong> <?= $run->machine_type ?> <?= $run->machine_kit ?></li>
     <li><strong>Data file:</strong> <a href="respublica.research.chop.edu:/mnt/isilon/microbiome/<?= $run->data_uri ?>"><?= basename($run->data_uri) ?></a></li>
+<?php
+foreach ($read_stats as $s) {
+?>
+    <li><strong>Lane <?= $s->lane ?>, read <?= $s->read_number ?>:</strong> <?= number_format($s->read_count) ?> reads, <?= number_format($s->base_count) ?> bases, mean quality <?= is_null($s->mean_quality) ? "NA" : number_format($s->mean_quality, 1) ?></li>
+<?php
+} // read_stats
+?>
   </ul>
   <p>
     <strong>Export metadata for all samples:</strong><br />